@@ -279,7 +279,11 @@ class QWenAttention(nn.Module):
             query = apply_rotary_pos_emb(query, q_pos_emb)
             key = apply_rotary_pos_emb(key, k_pos_emb)
 
-        if layer_past is not None:
+        if hasattr(layer_past, "update"):
+            # utils.static_kv_cache: append in place, attend over the filled part
+            # (dequantized here for an int8 QuantizedKVCache)
+            key, value = layer_past.update(key, value)
+        elif layer_past is not None:
             past_key, past_value = layer_past[0], layer_past[1]
             key = torch.cat((past_key, key), dim=1)
             value = torch.cat((past_value, value), dim=1)
@@ -551,7 +555,13 @@ class QWenModel(QWenPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         images_tensor=None,
+        exit_layer=None,
     ):
+        # A preallocated cache (utils.static_kv_cache) is written in place; while empty it means "no past"
+        static_cache = past_key_values if hasattr(past_key_values, "get_seq_length") else None
+        if static_cache is not None and static_cache.get_seq_length() == 0:
+            past_key_values = None
+
         if past_key_values is None and torch.any(input_ids == self.config.visual['image_start_id']):
             bos_pos = torch.where(input_ids == self.config.visual['image_start_id'])
             eos_pos = torch.where(input_ids == self.config.visual['image_start_id'] + 1)
@@ -612,11 +622,20 @@ class QWenModel(QWenPreTrainedModel):
         if position_ids is not None:
             position_ids = position_ids.view(-1, input_shape[-1])
 
+        # Early exit (sample_vcd_agla's branch_exit_layers): only the first exit_layer blocks run before ln_f
+        blocks = self.h[:exit_layer] if exit_layer is not None else self.h
+
         if past_key_values is None:
             past_length = 0
-            past_key_values = tuple([None] * len(self.h))
+            past_key_values = tuple([None] * len(blocks))
+        elif static_cache is not None:
+            past_length = static_cache.get_seq_length()
         else:
-            past_length = past_key_values[0][0].size(-2)
+            # [batch, seq, heads, head_dim]: the causal mask of a multi-token
+            # forward on top of a cache (prefix reuse, branch catch-up) needs the real length
+            past_length = past_key_values[0][0].size(1)
+        if static_cache is not None:
+            past_key_values = [static_cache.layer(i) for i in range(len(blocks))]
 
         if position_ids is None:
             position_ids = torch.arange(
@@ -641,10 +660,7 @@ class QWenModel(QWenPreTrainedModel):
 
         hidden_states = inputs_embeds
 
-        kv_seq_len = hidden_states.size()[1]
-        if past_key_values[0] is not None:
-            # past key values[0][0] shape: bs * seq_len * head_num * dim
-            kv_seq_len += past_key_values[0][0].shape[1]
+        kv_seq_len = hidden_states.size()[1] + past_length
         if (
             self.use_dynamic_ntk
             and kv_seq_len == hidden_states.size()[1]
@@ -678,7 +694,7 @@ class QWenModel(QWenPreTrainedModel):
         presents = () if use_cache else None
         all_self_attentions = () if output_attentions else None
         all_hidden_states = () if output_hidden_states else None
-        for i, (block, layer_past) in enumerate(zip(self.h, past_key_values)):
+        for i, (block, layer_past) in enumerate(zip(blocks, past_key_values)):
 
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
@@ -724,6 +740,9 @@ class QWenModel(QWenPreTrainedModel):
             if output_attentions:
                 all_self_attentions = all_self_attentions + (outputs[2 if use_cache else 1],)
 
+        if use_cache is True and static_cache is not None:
+            presents = static_cache
+
         hidden_states = self.ln_f(hidden_states)
         hidden_states = hidden_states.view(output_shape)
         # Add last hidden state
@@ -746,6 +765,10 @@ class QWenModel(QWenPreTrainedModel):
 class QWenLMHeadModel(QWenPreTrainedModel):
     _keys_to_ignore_on_load_missing = [r"h\.\d+\.attn\.rotary_emb\.inv_freq"]
     _keys_to_ignore_on_load_unexpected = [r"h\.\d+\.attn\.masked_bias"]
+    # past_key_values layout is [batch, seq, heads, head_dim]
+    kv_cache_seq_dim = 1
+    # Understands utils.static_kv_cache.StaticKVCache as past_key_values
+    supports_static_kv_cache = True
 
     def __init__(self, config):
         super().__init__(config)
@@ -857,7 +880,22 @@ class QWenLMHeadModel(QWenPreTrainedModel):
         cd_beta=None,
         cd_alpha=None,
         agla_beta=None,
-        agla_alpha=None
+        agla_alpha=None,
+        batch_branches=None,
+        branch_skip_policy=None,
+        prefix_cache=None,
+        prefix_cache_keys=None,
+        prefix_length=None,
+        last_logits_only=None,
+        sampling_generator=None,
+        sparse_candidates=None,
+        static_kv_caches=None,
+        branch_exit_layers=None,
+        prior_cache=None,
+        prior_cache_key=None,
+        prior_input_ids=None,
+        prior_images=None,
+        exit_layer=None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
 
         return_dict = (
@@ -878,9 +916,12 @@ class QWenLMHeadModel(QWenPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
-            images_tensor=images
+            images_tensor=images,
+            exit_layer=exit_layer,
         )
         hidden_states = transformer_outputs[0]
+        if last_logits_only and labels is None:
+            hidden_states = hidden_states[:, -1:, :]
 
         lm_logits = self.lm_head(hidden_states)
 
@@ -351,6 +351,7 @@ class VisionTransformer(nn.Module):
 
         mean = (0.48145466, 0.4578275, 0.40821073)
         std = (0.26862954, 0.26130258, 0.27577711)
+        self.image_mean, self.image_std = mean, std
         self.image_transform = transforms.Compose([
             transforms.Resize(
                 (image_size, image_size),
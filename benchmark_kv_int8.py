@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the int8 VCD/AGLA KV Caches (--aux-kv-int8)
+
+Runs the same questions twice through a runner with one model load: once with
+full-precision static KV caches for every branch, once with the VCD and AGLA
+branch caches in int8. During the int8 pass every VCD/AGLA forward is
+repeated on a full-precision shadow cache fed the same tokens, so the branch
+logits are compared step by step on identical inputs.
+
+Reported per branch:
+    - cache memory, full precision vs int8 (bytes of the preallocated buffers)
+    - KL(p_fp16 || p_int8) of the next-token distributions (mean and max)
+    - largest absolute logit difference
+    - top-1 agreement
+and, over the questions, how often the final answers of both passes agree
+(the decoding is seeded per question, see utils.seeding).
+
+Usage:
+    python benchmark_kv_int8.py --runner llava --question-file pope_coco_val.jsonl \\
+        --num-questions 200 --output-dir output/kv_int8 -- \\
+        --model-path /path/to/llava --image-folder /path/to/coco --use-vcd --use-agla
+"""
+
+import argparse
+import importlib
+import json
+import os
+
+from run_matrix import RUNNERS, release
+
+
+class ShadowDivergence:
+    """
+    Wraps ``model.forward``: a forward on one of the int8 branch caches is
+    repeated on a full-precision shadow cache, and the divergence of the two
+    next-token logits is accumulated per branch.
+
+    Args:
+        model: The runner's model (its ``forward`` is replaced until ``remove``)
+        caches (dict): Branch name -> QuantizedKVCache of the int8 pass
+    """
+
+    def __init__(self, model, caches):
+        from utils.static_kv_cache import StaticKVCache
+
+        self.model = model
+        self.forward = model.forward
+        self.names = {id(cache): name for name, cache in caches.items()}
+        self.shadows = {id(cache): StaticKVCache(cache.max_new_tokens, cache.seq_dim) for cache in caches.values()}
+        self.stats = {
+            name: {"steps": 0, "kl_sum": 0.0, "kl_max": 0.0, "max_abs_diff": 0.0, "top1_agree": 0}
+            for name in caches
+        }
+        model.forward = self
+
+    def remove(self):
+        del self.model.forward
+
+    def __call__(self, *args, **kwargs):
+        import torch
+        import torch.nn.functional as F
+
+        cache = kwargs.get("past_key_values")
+        if id(cache) not in self.names:
+            return self.forward(*args, **kwargs)
+        shadow = self.shadows[id(cache)]
+        if not cache:
+            # Prefill of a new question
+            shadow.reset()
+        outputs = self.forward(*args, **kwargs)
+        with torch.no_grad():
+            reference = self.forward(*args, **{**kwargs, "past_key_values": shadow})
+
+        logits = outputs.logits[:, -1, :].float()
+        reference_logits = reference.logits[:, -1, :].float()
+        kl = F.kl_div(
+            F.log_softmax(logits, dim=-1), F.log_softmax(reference_logits, dim=-1),
+            reduction="none", log_target=True,
+        ).sum(dim=-1)
+        stats = self.stats[self.names[id(cache)]]
+        stats["steps"] += logits.shape[0]
+        stats["kl_sum"] += kl.sum().item()
+        stats["kl_max"] = max(stats["kl_max"], kl.max().item())
+        stats["max_abs_diff"] = max(stats["max_abs_diff"], (logits - reference_logits).abs().max().item())
+        stats["top1_agree"] += (logits.argmax(dim=-1) == reference_logits.argmax(dim=-1)).sum().item()
+        return outputs
+
+    def summary(self):
+        """Divergence and cache memory per branch."""
+        summary = {}
+        for cache_id, name in self.names.items():
+            stats = self.stats[name]
+            steps = max(stats["steps"], 1)
+            summary[name] = {
+                "steps": stats["steps"],
+                "kl_mean": stats["kl_sum"] / steps,
+                "kl_max": stats["kl_max"],
+                "max_abs_logit_diff": stats["max_abs_diff"],
+                "top1_agreement": stats["top1_agree"] / steps,
+                "fp_bytes": self.shadows[cache_id].nbytes(),
+            }
+        return summary
+
+
+def load_answers(answers_file):
+    """question_id -> answer text (first answer of a question)."""
+    answers = {}
+    with open(answers_file, "r") as f:
+        for line in f:
+            if line.strip():
+                gen_line = json.loads(line)
+                answers.setdefault(gen_line["question_id"], gen_line["text"].strip())
+    return answers
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Memory and logit divergence of int8 VCD/AGLA KV caches versus full precision",
+        epilog="Arguments after '--' are passed to the runner for both passes.",
+    )
+    parser.add_argument("--runner", type=str, default="llava", choices=sorted(RUNNERS), help="Model runner")
+    parser.add_argument("--question-file", type=str, required=True, help="Questions to decode")
+    parser.add_argument("--num-questions", type=int, default=200, help="First N questions of the file")
+    parser.add_argument("--output-dir", type=str, required=True, help="Answers of both passes and the report")
+    parser.add_argument("--seed", type=int, default=55, help="Random seed (decoding)")
+    args, runner_args = parser.parse_known_args()
+    if runner_args and runner_args[0] == "--":
+        runner_args = runner_args[1:]
+    for option in ["--question-file", "--answers-file", "--seed", "--static-kv-cache", "--aux-kv-int8"]:
+        if option in runner_args:
+            parser.error(f"{option} is set by the benchmark")
+    for option in ["--score-yes-no", "--record-logits", "--prefix-cache", "--batch-branches", "--resume"]:
+        if option in runner_args:
+            parser.error(f"{option} does not decode with per-branch KV caches")
+    if "--use-vcd" not in runner_args and "--use-agla" not in runner_args:
+        parser.error("the runner arguments need --use-vcd and/or --use-agla")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.expanduser(args.question_file), "r") as f:
+        lines = [line if line.endswith("\n") else line + "\n" for line in f if line.strip()][:args.num_questions]
+    subset_file = os.path.join(args.output_dir, "questions.jsonl")
+    with open(subset_file, "w") as f:
+        f.writelines(lines)
+
+    from transformers import set_seed
+
+    from utils.static_kv_cache import AUX_BRANCHES
+
+    runner = importlib.import_module(RUNNERS[args.runner])
+    session = None
+    answers_files = {}
+    for mode, flags in (("fp", ["--static-kv-cache"]), ("int8", ["--static-kv-cache", "--aux-kv-int8"])):
+        answers_files[mode] = os.path.join(args.output_dir, f"answers_{mode}.jsonl")
+        job_args = runner.parse_args(runner_args + flags + [
+            "--question-file", subset_file, "--answers-file", answers_files[mode], "--seed", str(args.seed),
+        ])
+        if session is None:
+            session = runner.load_model(job_args)
+        if mode == "fp":
+            set_seed(job_args.seed)
+            runner.eval_model(job_args, session)
+            continue
+
+        # Create the int8 caches up front so the shadow can tell their forwards apart
+        from utils.static_kv_cache import BRANCHES, make_static_kv_caches
+
+        session["static_kv_caches_key"] = (True, True)
+        session["static_kv_caches"] = make_static_kv_caches(
+            session["model"], runner.MAX_NEW_TOKENS, branches=BRANCHES, int8_branches=AUX_BRANCHES,
+        )
+        shadow = ShadowDivergence(
+            session["model"], {name: session["static_kv_caches"][name] for name in AUX_BRANCHES}
+        )
+        try:
+            set_seed(job_args.seed)
+            runner.eval_model(job_args, session)
+        finally:
+            shadow.remove()
+        branches = shadow.summary()
+        for name in AUX_BRANCHES:
+            branches[name]["int8_bytes"] = session["static_kv_caches"][name].nbytes()
+
+    release(session)
+
+    answers_fp = load_answers(answers_files["fp"])
+    answers_int8 = load_answers(answers_files["int8"])
+    common = [idx for idx in answers_fp if idx in answers_int8]
+    agreement = sum(answers_fp[idx] == answers_int8[idx] for idx in common) / max(len(common), 1)
+    branches = {name: stats for name, stats in branches.items() if stats["steps"] > 0}
+    fp_bytes = sum(stats["fp_bytes"] for stats in branches.values())
+    int8_bytes = sum(stats["int8_bytes"] for stats in branches.values())
+    report = {
+        "runner": args.runner,
+        "questions": len(common),
+        "branches": branches,
+        "aux_fp_bytes": fp_bytes,
+        "aux_int8_bytes": int8_bytes,
+        "memory_saved_bytes": fp_bytes - int8_bytes,
+        "answer_agreement": agreement,
+    }
+    report_path = os.path.join(args.output_dir, "kv_int8_benchmark.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n{'=' * 60}")
+    print(f"{'branch':<8} {'steps':>7} {'KL mean':>10} {'KL max':>10} {'max |dz|':>10} {'top-1':>8} {'fp MB':>9} {'int8 MB':>9}")
+    for name, stats in branches.items():
+        print(f"{name:<8} {stats['steps']:7d} {stats['kl_mean']:10.2e} {stats['kl_max']:10.2e} "
+              f"{stats['max_abs_logit_diff']:10.4f} {stats['top1_agreement']:8.2%} "
+              f"{stats['fp_bytes'] / 1024 ** 2:9.1f} {stats['int8_bytes'] / 1024 ** 2:9.1f}")
+    if fp_bytes:
+        print(f"VCD/AGLA KV memory: {fp_bytes / 1024 ** 2:.1f} MB -> {int8_bytes / 1024 ** 2:.1f} MB "
+              f"({1 - int8_bytes / fp_bytes:.1%} saved)")
+    print(f"Answers identical to full precision: {agreement:.2%} of {len(common)} questions")
+    print(f"Report saved to {report_path}")
+
+
+if __name__ == "__main__":
+    main()
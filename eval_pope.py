@@ -10,83 +10,29 @@ This script evaluates model outputs on the POPE dataset and calculates:
 
 Usage:
     python eval_pope.py --gt_file <ground_truth.json> --gen_file <predictions.jsonl>
+    python eval_pope.py --gt_file <ground_truth.json> --gen_file results/*.jsonl   # metrics table
 """
 
 import os
 import json
 import argparse
-from tqdm import tqdm
 
+import numpy as np
 
-def evaluate_pope(gt_file, gen_file, verbose=True):
+
+def compute_pope_metrics(true_pos, true_neg, false_pos, false_neg, yes_answers, unknown, total_questions):
     """
-    Evaluate POPE predictions
+    POPE metrics from confusion counts
     
     Args:
-        gt_file: Path to ground truth JSON file
-        gen_file: Path to generated predictions JSONL file
-        verbose: Whether to print results
+        true_pos, true_neg, false_pos, false_neg: Confusion counts
+        yes_answers: Number of "yes" predictions
+        unknown: Questions without a usable answer or label
+        total_questions: Number of ground truth questions
         
     Returns:
         dict: Dictionary containing evaluation metrics
     """
-    # Load ground truth answers
-    gt_data = [json.loads(q) for q in open(os.path.expanduser(gt_file), "r")]
-    
-    # Load generated answers
-    gen_data = [json.loads(q) for q in open(os.path.expanduser(gen_file), "r")]
-    
-    # Initialize counters
-    true_pos = 0
-    true_neg = 0
-    false_pos = 0
-    false_neg = 0
-    unknown = 0
-    total_questions = len(gt_data)
-    yes_answers = 0
-    
-    # Compare answers
-    for index, gt_line in enumerate(gt_data):
-        idx = gt_line["question_id"]
-        gt_answer = gt_line["label"]
-        
-        # Find matching generated answer
-        gen_line = None
-        for gen in gen_data:
-            if gen["question_id"] == idx:
-                gen_line = gen
-                break
-        
-        if gen_line is None:
-            print(f"Warning: No generated answer for question_id {idx}")
-            unknown += 1
-            continue
-            
-        gen_answer = gen_line["text"]
-        
-        # Convert to lowercase and strip
-        gt_answer = gt_answer.lower().strip()
-        gen_answer = gen_answer.lower().strip()
-        
-        # Evaluate (pos = 'yes', neg = 'no')
-        if gt_answer == 'yes':
-            if 'yes' in gen_answer:
-                true_pos += 1
-                yes_answers += 1
-            else:
-                false_neg += 1
-        elif gt_answer == 'no':
-            if 'no' in gen_answer:
-                true_neg += 1
-            else:
-                yes_answers += 1
-                false_pos += 1
-        else:
-            if verbose:
-                print(f'Warning: unknown gt_answer: {gt_answer}')
-            unknown += 1
-    
-    # Calculate metrics
     precision = true_pos / (true_pos + false_pos) if (true_pos + false_pos) > 0 else 0
     recall = true_pos / (true_pos + false_neg) if (true_pos + false_neg) > 0 else 0
     f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0
@@ -94,7 +40,7 @@ def evaluate_pope(gt_file, gen_file, verbose=True):
     yes_proportion = yes_answers / total_questions
     unknown_prop = unknown / total_questions
     
-    results = {
+    return {
         'precision': precision,
         'recall': recall,
         'f1': f1,
@@ -107,37 +53,225 @@ def evaluate_pope(gt_file, gen_file, verbose=True):
         'false_neg': false_neg,
         'total': total_questions
     }
+
+
+def load_ground_truth(gt_file):
+    """
+    Stream a POPE ground truth file into label arrays
+    
+    Args:
+        gt_file: Path to ground truth JSON(L) file
+        
+    Returns:
+        tuple: (question_ids list, index dict question_id -> row,
+                labels np.int8 array with 1 = yes, 0 = no, -1 = other)
+    """
+    question_ids = []
+    labels = []
+    with open(os.path.expanduser(gt_file), "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            gt_line = json.loads(line)
+            question_ids.append(gt_line["question_id"])
+            label = gt_line["label"].lower().strip()
+            labels.append(1 if label == 'yes' else 0 if label == 'no' else -1)
+    # The first ground truth line of a question_id is the one evaluated
+    index = {}
+    for row, idx in enumerate(question_ids):
+        index.setdefault(idx, row)
+    return question_ids, index, np.asarray(labels, dtype=np.int8)
+
+
+def answer_flags(text):
+    """Whether a generated answer contains 'yes' and 'no' (lowercased)"""
+    gen_answer = text.lower().strip()
+    return 'yes' in gen_answer, 'no' in gen_answer
+
+
+def load_predictions(gen_file, index):
+    """
+    Stream a predictions JSONL file and join it to the ground truth rows
+    
+    Args:
+        gen_file: Path to generated predictions JSONL file
+        index: question_id -> ground truth row from load_ground_truth
+        
+    Returns:
+        tuple of bool arrays over the ground truth rows:
+        (answered, answer contains 'yes', answer contains 'no')
+    """
+    num_rows = max(index.values(), default=-1) + 1
+    answered = np.zeros(num_rows, dtype=bool)
+    has_yes = np.zeros(num_rows, dtype=bool)
+    has_no = np.zeros(num_rows, dtype=bool)
+    with open(os.path.expanduser(gen_file), "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            gen_line = json.loads(line)
+            row = index.get(gen_line["question_id"])
+            # Like a scan of the predictions, the first answer of a question counts
+            if row is None or answered[row]:
+                continue
+            answered[row] = True
+            has_yes[row], has_no[row] = answer_flags(gen_line["text"])
+    return answered, has_yes, has_no
+
+
+def correct_answers(labels, answered, has_yes, has_no):
+    """
+    Per-row correctness: a 'yes' question needs 'yes' in the answer, a 'no'
+    question needs 'no'. Unanswered rows and unknown labels are not correct.
+    
+    Returns:
+        np.ndarray: bool array over the ground truth rows
+    """
+    return answered & (((labels == 1) & has_yes) | ((labels == 0) & has_no))
+
+
+def confusion_counts(labels, answered, has_yes, has_no):
+    """
+    Vectorized POPE confusion counts (pos = 'yes', neg = 'no')
+    
+    A 'yes' question is a true positive when the answer contains 'yes'; a 'no'
+    question is a true negative when the answer contains 'no'. Unanswered
+    questions and unknown labels count as unknown.
+    
+    Returns:
+        dict: true_pos, true_neg, false_pos, false_neg, yes_answers, unknown
+    """
+    correct = correct_answers(labels, answered, has_yes, has_no)
+    is_yes = answered & (labels == 1)
+    is_no = answered & (labels == 0)
+    true_pos = int((is_yes & correct).sum())
+    false_neg = int((is_yes & ~correct).sum())
+    true_neg = int((is_no & correct).sum())
+    false_pos = int((is_no & ~correct).sum())
+    return {
+        'true_pos': true_pos,
+        'true_neg': true_neg,
+        'false_pos': false_pos,
+        'false_neg': false_neg,
+        'yes_answers': true_pos + false_pos,
+        'unknown': int((~answered).sum() + (answered & (labels == -1)).sum()),
+    }
+
+
+def print_metrics(results):
+    """Print the metrics of one evaluation"""
+    print("=" * 60)
+    print("POPE Evaluation Results")
+    print("=" * 60)
+    print(f"Accuracy:   {results['accuracy']:.4f} ({results['accuracy']*100:.2f}%)")
+    print(f"Precision:  {results['precision']:.4f} ({results['precision']*100:.2f}%)")
+    print(f"Recall:     {results['recall']:.4f} ({results['recall']*100:.2f}%)")
+    print(f"F1 Score:   {results['f1']:.4f} ({results['f1']*100:.2f}%)")
+    print(f"Yes Prop:   {results['yes_proportion']:.4f} ({results['yes_proportion']*100:.2f}%)")
+    print("-" * 60)
+    print(f"TP: {results['true_pos']}, TN: {results['true_neg']}, "
+          f"FP: {results['false_pos']}, FN: {results['false_neg']}")
+    print(f"Total: {results['total']}, Unknown: {results['unknown']}")
+    print("=" * 60)
+
+
+def _evaluate_files(gt_file, gen_files, verbose):
+    """
+    Metrics of each predictions file against one ground truth file
+    
+    The ground truth is read once; each predictions file is streamed and
+    joined to it through a question_id index.
+    
+    Yields:
+        tuple: (gen_file, metrics dict of compute_pope_metrics, unknown count)
+    """
+    question_ids, index, labels = load_ground_truth(gt_file)
+    total_questions = len(question_ids)
+    # Repeated ground truth lines of a question_id are evaluated like the first one
+    rows = np.fromiter((index[idx] for idx in question_ids), dtype=np.int64, count=total_questions)
     
-    # Print results
     if verbose:
-        print("=" * 60)
-        print("POPE Evaluation Results")
-        print("=" * 60)
-        print(f"Accuracy:   {accuracy:.4f} ({accuracy*100:.2f}%)")
-        print(f"Precision:  {precision:.4f} ({precision*100:.2f}%)")
-        print(f"Recall:     {recall:.4f} ({recall*100:.2f}%)")
-        print(f"F1 Score:   {f1:.4f} ({f1*100:.2f}%)")
-        print(f"Yes Prop:   {yes_proportion:.4f} ({yes_proportion*100:.2f}%)")
-        print("-" * 60)
-        print(f"TP: {true_pos}, TN: {true_neg}, FP: {false_pos}, FN: {false_neg}")
-        print(f"Total: {total_questions}, Unknown: {unknown}")
-        print("=" * 60)
+        for idx, label in zip(question_ids, labels):
+            if label == -1:
+                print(f'Warning: unknown gt_answer for question_id {idx}')
+    
+    for gen_file in gen_files:
+        answered, has_yes, has_no = load_predictions(gen_file, index)
+        answered, has_yes, has_no = answered[rows], has_yes[rows], has_no[rows]
+        if verbose:
+            for row in np.flatnonzero(~answered):
+                print(f"Warning: No generated answer for question_id {question_ids[row]}")
+        counts = confusion_counts(labels, answered, has_yes, has_no)
+        results = compute_pope_metrics(
+            counts['true_pos'], counts['true_neg'], counts['false_pos'], counts['false_neg'],
+            counts['yes_answers'], counts['unknown'], total_questions,
+        )
+        if verbose:
+            print_metrics(results)
+        yield gen_file, results, counts['unknown']
+
+
+def evaluate_pope(gt_file, gen_file, verbose=True):
+    """
+    Evaluate POPE predictions
     
+    Args:
+        gt_file: Path to ground truth JSON file
+        gen_file: Path to generated predictions JSONL file
+        verbose: Whether to print results
+        
+    Returns:
+        dict: Dictionary containing evaluation metrics
+    """
+    _, results, _ = next(_evaluate_files(gt_file, [gen_file], verbose))
     return results
 
 
+def evaluate_pope_many(gt_file, gen_files, verbose=False):
+    """
+    Evaluate several prediction files against one ground truth file
+    
+    Args:
+        gt_file: Path to ground truth JSON file
+        gen_files: Paths to generated predictions JSONL files
+        verbose: Print missing answers, unknown labels and the metrics of each file
+        
+    Returns:
+        list of dicts: Metrics per predictions file, with its path under
+        'gen_file' and the unknown count under 'unknown' (for the table)
+    """
+    return [
+        {'gen_file': gen_file, **results, 'unknown': unknown}
+        for gen_file, results, unknown in _evaluate_files(gt_file, gen_files, verbose)
+    ]
+
+
+def print_metrics_table(all_results):
+    """Print one row of metrics per predictions file"""
+    name_width = max(len(os.path.basename(r['gen_file'])) for r in all_results)
+    print(f"{'file':<{name_width}} {'Acc':>8} {'Prec':>8} {'Rec':>8} {'F1':>8} {'Yes':>8} {'Unk':>8}")
+    print("-" * (name_width + 54))
+    for r in all_results:
+        print(f"{os.path.basename(r['gen_file']):<{name_width}} {r['accuracy']:8.4f} {r['precision']:8.4f} "
+              f"{r['recall']:8.4f} {r['f1']:8.4f} {r['yes_proportion']:8.4f} {r['unknown_proportion']:8.4f}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Evaluate POPE predictions")
     parser.add_argument("--gt_file", type=str, required=True,
                         help="Path to ground truth JSON file")
-    parser.add_argument("--gen_file", type=str, required=True,
-                        help="Path to generated predictions JSONL file")
+    parser.add_argument("--gen_file", type=str, nargs="+", required=True,
+                        help="Path(s) to generated predictions JSONL file(s)")
     parser.add_argument("--output", type=str, default=None,
                         help="Path to save results JSON (optional)")
     args = parser.parse_args()
     
     # Evaluate
-    results = evaluate_pope(args.gt_file, args.gen_file, verbose=True)
+    if len(args.gen_file) == 1:
+        results = evaluate_pope(args.gt_file, args.gen_file[0], verbose=True)
+    else:
+        results = evaluate_pope_many(args.gt_file, args.gen_file)
+        print_metrics_table(results)
     
     # Save results if output path specified
     if args.output:
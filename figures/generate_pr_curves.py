@@ -2,6 +2,9 @@
 """
 Generate precision-recall curves for VCD+AGLA paper.
 Shows precision-recall trade-offs for different methods.
+
+Answers produced with ``--score-yes-no`` carry P(yes)/P(no) per question,
+so the threshold-swept curves below need no model re-runs.
 """
 
 import json
@@ -23,6 +26,13 @@ data_path = '../combined_results/comprehensive_results.json'
 with open(data_path, 'r') as f:
     data = json.load(f)
 
+# Scored runs (--score-yes-no) for threshold-swept PR curves: (label, answers, ground truth)
+POPE_GT_FILE = '/root/autodl-tmp/VCD/experiments/data/POPE/coco/coco_pope_popular.json'
+SCORED_RUNS = [
+    ('Baseline', '../combined_results/llava15_coco_pope_baseline_scored_seed55.jsonl', POPE_GT_FILE),
+    ('VCD+AGLA', '../combined_results/llava15_coco_pope_combined_scored_seed55.jsonl', POPE_GT_FILE),
+]
+
 def plot_pr_scatter():
     """Plot precision-recall scatter plot for all methods and models."""
     fig, axes = plt.subplots(1, 2, figsize=(12, 5))
@@ -196,6 +206,71 @@ def plot_precision_recall_bars():
     print("Generated: precision_recall_bars.png/pdf")
     plt.close()
 
+def load_scored_run(answers_file, gt_file):
+    """Return (yes-scores, binary labels) for a scored answers file joined on question_id."""
+    gt = {}
+    with open(gt_file, 'r') as f:
+        for line in f:
+            item = json.loads(line)
+            gt[item['question_id']] = 1 if item['label'].lower().strip() == 'yes' else 0
+
+    scores, labels = [], []
+    with open(answers_file, 'r') as f:
+        for line in f:
+            item = json.loads(line)
+            if item['question_id'] not in gt or 'p_yes' not in item:
+                continue
+            total = item['p_yes'] + item['p_no']
+            scores.append(item['p_yes'] / total if total > 0 else 0.5)
+            labels.append(gt[item['question_id']])
+    return np.array(scores), np.array(labels)
+
+
+def threshold_pr_curve(scores, labels):
+    """Precision/recall (%) for every threshold on the yes-score, highest threshold first."""
+    order = np.argsort(-scores, kind='stable')
+    sorted_labels = labels[order]
+    true_pos = np.cumsum(sorted_labels)
+    predicted_pos = np.arange(1, len(sorted_labels) + 1)
+    precision = 100 * true_pos / predicted_pos
+    recall = 100 * true_pos / max(sorted_labels.sum(), 1)
+    return precision, recall
+
+
+def plot_threshold_pr_curves():
+    """Plot threshold-swept precision-recall curves from --score-yes-no answer files."""
+    runs = [run for run in SCORED_RUNS if os.path.exists(run[1]) and os.path.exists(run[2])]
+    if not runs:
+        print("Skipped: threshold_pr_curves (no scored answer files found)")
+        return
+
+    fig, ax = plt.subplots(figsize=(6, 5))
+    colors = {'Baseline': '#3498db', 'VCD+AGLA': '#e74c3c'}
+
+    for label, answers_file, gt_file in runs:
+        scores, labels = load_scored_run(answers_file, gt_file)
+        precision, recall = threshold_pr_curve(scores, labels)
+        ax.plot(recall, precision, color=colors.get(label), linewidth=1.5, label=label)
+
+        # Mark the argmax (threshold 0.5) operating point
+        predicted_yes = scores >= 0.5
+        tp = np.sum(predicted_yes & (labels == 1))
+        op_precision = 100 * tp / max(predicted_yes.sum(), 1)
+        op_recall = 100 * tp / max(labels.sum(), 1)
+        ax.scatter(op_recall, op_precision, s=60, color=colors.get(label), marker='*', zorder=3)
+
+    ax.set_xlabel('Recall (%)')
+    ax.set_ylabel('Precision (%)')
+    ax.set_title('Threshold-Swept PR Curves: LLaVA-1.5-7B, COCO-POPE')
+    ax.legend(loc='lower left', fontsize=8)
+    ax.grid(True, alpha=0.3)
+
+    plt.tight_layout()
+    plt.savefig('threshold_pr_curves.png', bbox_inches='tight')
+    plt.savefig('threshold_pr_curves.pdf', bbox_inches='tight')
+    print("Generated: threshold_pr_curves.png/pdf")
+    plt.close()
+
 def main():
     """Generate all precision-recall figures."""
     print("Generating precision-recall figures...")
@@ -206,12 +281,14 @@ def main():
     plot_pr_scatter()
     plot_pr_improvement_vectors()
     plot_precision_recall_bars()
+    plot_threshold_pr_curves()
     
     print("\nAll precision-recall figures generated successfully!")
     print("Output files:")
     print("  - pr_scatter_comparison.png/pdf")
     print("  - pr_improvement_vectors_llava15.png/pdf")
     print("  - precision_recall_bars.png/pdf")
+    print("  - threshold_pr_curves.png/pdf (requires --score-yes-no answer files)")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Live POPE Evaluation of a Running Experiment
+
+Tails growing answers JSONL files and keeps running confusion counts, one
+O(1) update per new answer. After every poll the current metrics, Wilson
+confidence intervals and progress are written to a small JSON status file
+next to each answers file (``<answers>.status.json``).
+
+With ``--min-accuracy`` a run whose accuracy interval lies entirely below the
+threshold is flagged (``"verdict": "stop"``) and, with ``--kill-pid``, its
+process is terminated, so a bad parameter setting does not run the full
+three-branch pass.
+
+Usage:
+    python live_eval_pope.py --gt-file pope_coco_random.jsonl \\
+        --answers-file combined_results/llava15_coco_pope_combined_seed55.jsonl
+
+    # Stop the run once it is clearly below 80% accuracy
+    python live_eval_pope.py --gt-file pope.jsonl --answers-file answers.jsonl \\
+        --min-accuracy 0.80 --min-answers 200 --kill-pid 12345
+"""
+
+import argparse
+import json
+import math
+import os
+import signal
+import time
+from datetime import datetime
+
+from eval_pope import answer_flags, compute_pope_metrics, correct_answers, load_ground_truth
+
+
+def wilson_interval(successes, n, z=1.96):
+    """
+    Wilson score interval of a binomial proportion.
+
+    Args:
+        successes (int): Number of successes
+        n (int): Number of trials
+        z (float): Normal quantile (1.96 = 95%)
+
+    Returns:
+        tuple: (low, high); (0.0, 1.0) without trials
+    """
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+class LivePOPEEvaluator:
+    """
+    Running POPE confusion counts over a growing answers file.
+
+    Only complete lines are consumed; the read offset is kept between polls,
+    so each answer is parsed once. The decision rules are those of
+    eval_pope.evaluate_pope (the first answer of a question counts).
+
+    Args:
+        answers_file (str): Answers JSONL written by a runner
+        ground_truth (tuple): Result of eval_pope.load_ground_truth
+    """
+
+    def __init__(self, answers_file, ground_truth):
+        self.answers_file = answers_file
+        _, self.index, self.labels = ground_truth
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.seen = set()
+        self.counts = {
+            "true_pos": 0, "true_neg": 0, "false_pos": 0, "false_neg": 0, "yes_answers": 0, "unknown": 0,
+        }
+        self.started = time.time()
+        self.first_answers = None
+
+    def update(self, gen_line):
+        """Count one answer."""
+        idx = gen_line["question_id"]
+        if idx in self.seen:
+            return
+        self.seen.add(idx)
+        row = self.index.get(idx)
+        label = self.labels[row] if row is not None else -1
+        if label == -1:
+            self.counts["unknown"] += 1
+            return
+        has_yes, has_no = answer_flags(gen_line["text"])
+        correct = bool(correct_answers(label, True, has_yes, has_no))
+        if label == 1:
+            self.counts["true_pos" if correct else "false_neg"] += 1
+        else:
+            self.counts["true_neg" if correct else "false_pos"] += 1
+        self.counts["yes_answers"] += int((label == 1) == correct)
+
+    def poll(self):
+        """
+        Consume the answers appended since the last poll.
+
+        Returns:
+            int: Number of new answers
+        """
+        if not os.path.exists(self.answers_file):
+            return 0
+        if os.path.getsize(self.answers_file) < self.offset:
+            # Rewritten from the start (a new run without --resume)
+            self.reset()
+        new = 0
+        with open(self.answers_file, "rb") as f:
+            f.seek(self.offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # partially written line, read it on the next poll
+                self.offset += len(raw)
+                if raw.strip():
+                    self.update(json.loads(raw))
+                    new += 1
+        if self.first_answers is None:
+            # Answers present at the first poll do not count towards the rate
+            self.first_answers = len(self.seen)
+        return new
+
+    def status(self):
+        """Current metrics, 95% Wilson intervals and progress."""
+        c = self.counts
+        answered = len(self.seen)
+        labeled = answered - c["unknown"]
+        yes_answers = c["yes_answers"]
+        metrics = compute_pope_metrics(
+            c["true_pos"], c["true_neg"], c["false_pos"], c["false_neg"], yes_answers, c["unknown"], max(answered, 1)
+        )
+        total = len(self.index)
+        elapsed = time.time() - self.started
+        rate = (answered - (self.first_answers or 0)) / elapsed if elapsed > 0 else 0.0
+        return {
+            "answers_file": self.answers_file,
+            "updated": datetime.now().isoformat(timespec="seconds"),
+            "answered": answered,
+            "total": total,
+            "progress": answered / total if total else 0.0,
+            "answers_per_second": rate,
+            "eta_seconds": (total - answered) / rate if rate > 0 else None,
+            "metrics": metrics,
+            "intervals": {
+                "accuracy": wilson_interval(c["true_pos"] + c["true_neg"], labeled),
+                "precision": wilson_interval(c["true_pos"], yes_answers),
+                "recall": wilson_interval(c["true_pos"], c["true_pos"] + c["false_neg"]),
+                "yes_proportion": wilson_interval(yes_answers, labeled),
+            },
+        }
+
+
+def write_status(path, status):
+    """Write the status JSON atomically (readers never see a partial file)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live POPE metrics of running experiments")
+    parser.add_argument("--gt-file", type=str, required=True, help="POPE ground truth file (JSONL)")
+    parser.add_argument("--answers-file", type=str, nargs="+", required=True, help="Answers file(s) being written")
+    parser.add_argument("--interval", type=float, default=10.0, help="Seconds between polls")
+    parser.add_argument("--once", action='store_true', help="Poll once and exit")
+    parser.add_argument("--min-accuracy", type=float, default=None,
+                        help="Flag a run whose accuracy upper bound falls below this")
+    parser.add_argument("--min-answers", type=int, default=100, help="Answers before a run can be flagged")
+    parser.add_argument("--kill-pid", type=int, nargs="+", default=None,
+                        help="Process id of each answers file's runner, terminated when its run is flagged")
+    args = parser.parse_args()
+    if args.kill_pid is not None and len(args.kill_pid) != len(args.answers_file):
+        parser.error("--kill-pid needs one process id per answers file")
+
+    ground_truth = load_ground_truth(args.gt_file)
+    evaluators = [LivePOPEEvaluator(os.path.expanduser(path), ground_truth) for path in args.answers_file]
+    stopped = set()
+
+    while True:
+        for i, evaluator in enumerate(evaluators):
+            evaluator.poll()
+            status = evaluator.status()
+            accuracy_high = status["intervals"]["accuracy"][1]
+            status["verdict"] = "continue"
+            if (args.min_accuracy is not None and status["answered"] >= args.min_answers
+                    and accuracy_high < args.min_accuracy):
+                status["verdict"] = "stop"
+                if args.kill_pid is not None and i not in stopped:
+                    try:
+                        os.kill(args.kill_pid[i], signal.SIGTERM)
+                        print(f"✗ Stopped PID {args.kill_pid[i]}: accuracy <= {accuracy_high:.4f}")
+                    except ProcessLookupError:
+                        pass
+                    stopped.add(i)
+            if status["answered"] >= status["total"]:
+                status["verdict"] = "complete"
+            write_status(evaluator.answers_file + ".status.json", status)
+
+            m, ci = status["metrics"], status["intervals"]
+            print(f"[{status['updated']}] {os.path.basename(evaluator.answers_file)}: "
+                  f"{status['answered']}/{status['total']} | "
+                  f"Acc {m['accuracy']:.4f} [{ci['accuracy'][0]:.4f}, {ci['accuracy'][1]:.4f}] | "
+                  f"F1 {m['f1']:.4f} | Yes {m['yes_proportion']:.4f} | {status['verdict']}")
+
+        finished = all(e.status()["answered"] >= len(ground_truth[1]) for e in evaluators)
+        if args.once or finished or len(stopped) == len(evaluators):
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -84,16 +84,36 @@ class KeywordsStoppingCriteria(StoppingCriteria):
             self.keyword_ids.append(torch.tensor(cur_keyword_ids))
         self.tokenizer = tokenizer
         self.start_len = input_ids.shape[1]
+        # Sticky per-sequence state: finished rows are padded afterwards, so the keyword is not at their end anymore
+        self.finished = None
+        # Sequence length the flags were last updated for
+        self.checked_length = None
 
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        assert output_ids.shape[0] == 1, "Only support batch size 1 (yet)"  # TODO
+    def call_for_batch(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
         offset = min(output_ids.shape[1] - self.start_len, 3)
         self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
         for keyword_id in self.keyword_ids:
-            if output_ids[0, -keyword_id.shape[0]:] == keyword_id:
+            if torch.equal(output_ids[0, -keyword_id.shape[0]:], keyword_id):
                 return True
         outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
         for keyword in self.keywords:
             if keyword in outputs:
                 return True
         return False
+
+    def sequences_finished(self, output_ids: torch.LongTensor, scores: torch.FloatTensor = None) -> torch.BoolTensor:
+        """Per-sequence stop flags [B]; sample_vcd_agla pads the finished rows."""
+        if self.finished is None or self.finished.shape[0] != output_ids.shape[0]:
+            self.finished = torch.zeros(output_ids.shape[0], dtype=torch.bool, device=output_ids.device)
+        for i in range(output_ids.shape[0]):
+            if not self.finished[i] and self.call_for_batch(output_ids[i:i + 1], scores):
+                self.finished[i] = True
+        self.checked_length = output_ids.shape[1]
+        return self.finished
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        # sample_vcd_agla already updated the flags for this step: do not decode the rows again
+        if (self.finished is not None and self.finished.shape[0] == output_ids.shape[0]
+                and self.checked_length == output_ids.shape[1]):
+            return bool(self.finished.all())
+        return bool(self.sequences_finished(output_ids, scores).all())
@@ -71,6 +71,21 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
         cd_alpha: Optional[torch.FloatTensor] = None,
         agla_beta: Optional[torch.FloatTensor] = None,
         agla_alpha: Optional[torch.FloatTensor] = None,
+        batch_branches: Optional[bool] = None,
+        branch_skip_policy: Optional[object] = None,
+        prefix_cache: Optional[object] = None,
+        prefix_cache_keys: Optional[dict] = None,
+        prefix_length: Optional[int] = None,
+        last_logits_only: Optional[bool] = None,
+        sampling_generator: Optional[object] = None,
+        sparse_candidates: Optional[int] = None,
+        static_kv_caches: Optional[dict] = None,
+        branch_exit_layers: Optional[dict] = None,
+        prior_cache: Optional[object] = None,
+        prior_cache_key: Optional[tuple] = None,
+        prior_input_ids: Optional[list] = None,
+        prior_images: Optional[torch.FloatTensor] = None,
+        exit_layer: Optional[int] = None,
         return_dict: Optional[bool] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -81,19 +96,31 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
 
         input_ids, attention_mask, past_key_values, inputs_embeds, labels = self.prepare_inputs_labels_for_multimodal(input_ids, attention_mask, past_key_values, labels, images)
 
+        # Left-padded batches: positions count only the attended tokens
+        position_ids = None
+        if attention_mask is not None and not attention_mask.bool().all():
+            seq_length = inputs_embeds.shape[1] if inputs_embeds is not None else input_ids.shape[1]
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            position_ids = position_ids[:, -seq_length:]
+
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
-        outputs = self.model(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            past_key_values=past_key_values,
-            inputs_embeds=inputs_embeds,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict
-        )
+        with self.early_exit(exit_layer):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                inputs_embeds=inputs_embeds,
+                position_ids=position_ids,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict
+            )
 
         hidden_states = outputs[0]
+        if last_logits_only and labels is None:
+            hidden_states = hidden_states[:, -1:, :]
         logits = self.lm_head(hidden_states)
 
         loss = None
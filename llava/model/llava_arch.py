@@ -14,6 +14,7 @@
 
 
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
@@ -84,13 +85,36 @@ class LlavaMetaForCausalLM(ABC):
         image_features = self.get_model().mm_projector(image_features)
         return image_features
 
+    @contextmanager
+    def early_exit(self, exit_layer):
+        """Run only the first ``exit_layer`` decoder layers inside the block (None: all of them)."""
+        model = self.get_model()
+        layers = model.layers
+        if exit_layer is not None:
+            # The final norm and lm_head are applied to the truncated stack's output
+            model.layers = layers[:exit_layer]
+        try:
+            yield
+        finally:
+            model.layers = layers
+
     def prepare_inputs_labels_for_multimodal(
         self, input_ids, attention_mask, past_key_values, labels, images
     ):
         vision_tower = self.get_vision_tower()
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             if past_key_values is not None and vision_tower is not None and images is not None and input_ids.shape[1] == 1:
-                attention_mask = torch.ones((attention_mask.shape[0], past_key_values[-1][-1].shape[-2] + 1), dtype=attention_mask.dtype, device=attention_mask.device)
+                # The text-level mask does not count the expanded image tokens; the only zeros are
+                # left padding before the image, so extending it with ones on the right keeps them in place
+                if hasattr(past_key_values, "get_seq_length"):
+                    # Cache objects (utils.static_kv_cache) report their length without a layer read
+                    target_length = past_key_values.get_seq_length() + 1
+                else:
+                    target_length = past_key_values[-1][-1].shape[-2] + 1
+                if attention_mask is None or attention_mask.shape[1] > target_length:
+                    attention_mask = torch.ones((input_ids.shape[0], target_length), dtype=torch.long, device=input_ids.device)
+                elif attention_mask.shape[1] < target_length:
+                    attention_mask = torch.cat((attention_mask, attention_mask.new_ones((attention_mask.shape[0], target_length - attention_mask.shape[1]))), dim=1)
             return input_ids, attention_mask, past_key_values, None, labels
 
         if type(images) is list or images.ndim == 5:
@@ -104,6 +128,8 @@ class LlavaMetaForCausalLM(ABC):
 
         new_input_embeds = []
         new_labels = [] if labels is not None else None
+        # Attention mask expanded alongside the embeddings (keeps left padding where it is)
+        new_attention_masks = [] if attention_mask is not None else None
         cur_image_idx = 0
         for batch_idx, cur_input_ids in enumerate(input_ids):
             if (cur_input_ids == IMAGE_TOKEN_INDEX).sum() == 0:
@@ -117,10 +143,15 @@ class LlavaMetaForCausalLM(ABC):
                 new_input_embeds.append(cur_input_embeds)
                 if labels is not None:
                     new_labels.append(labels[batch_idx])
+                if attention_mask is not None:
+                    new_attention_masks.append(attention_mask[batch_idx])
                 cur_image_idx += 1
                 continue
             image_token_indices = torch.where(cur_input_ids == IMAGE_TOKEN_INDEX)[0]
             cur_new_input_embeds = []
+            if attention_mask is not None:
+                cur_attention_mask = attention_mask[batch_idx]
+                cur_new_attention_mask = []
             if labels is not None:
                 cur_labels = labels[batch_idx]
                 cur_new_labels = []
@@ -138,6 +169,11 @@ class LlavaMetaForCausalLM(ABC):
                         cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=labels.device, dtype=labels.dtype))
                         cur_new_labels.append(cur_labels[image_token_start:image_token_start+1])
                         cur_labels = cur_labels[image_token_start+2:]
+                    if attention_mask is not None:
+                        cur_new_attention_mask.append(cur_attention_mask[:image_token_start])
+                        cur_new_attention_mask.append(cur_attention_mask[image_token_start].repeat(cur_image_features.shape[0]))
+                        cur_new_attention_mask.append(cur_attention_mask[image_token_start+1:image_token_start+2])
+                        cur_attention_mask = cur_attention_mask[image_token_start+2:]
                 else:
                     cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids[:image_token_start]))
                     cur_new_input_embeds.append(cur_image_features)
@@ -145,6 +181,10 @@ class LlavaMetaForCausalLM(ABC):
                         cur_new_labels.append(cur_labels[:image_token_start])
                         cur_new_labels.append(torch.full((cur_image_features.shape[0],), IGNORE_INDEX, device=labels.device, dtype=labels.dtype))
                         cur_labels = cur_labels[image_token_start+1:]
+                    if attention_mask is not None:
+                        cur_new_attention_mask.append(cur_attention_mask[:image_token_start])
+                        cur_new_attention_mask.append(cur_attention_mask[image_token_start].repeat(cur_image_features.shape[0]))
+                        cur_attention_mask = cur_attention_mask[image_token_start+1:]
                 cur_image_idx += 1
                 if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
                     cur_input_ids = cur_input_ids[image_token_start+2:]
@@ -158,6 +198,10 @@ class LlavaMetaForCausalLM(ABC):
                     cur_new_input_embeds.append(self.get_model().embed_tokens(cur_input_ids))
                 if labels is not None:
                     cur_new_labels.append(cur_labels)
+                if attention_mask is not None:
+                    cur_new_attention_mask.append(cur_attention_mask)
+            if attention_mask is not None:
+                new_attention_masks.append(torch.cat(cur_new_attention_mask, dim=0))
             cur_new_input_embeds = [x.to(device=self.device) for x in cur_new_input_embeds]
             cur_new_input_embeds = torch.cat(cur_new_input_embeds, dim=0)
             new_input_embeds.append(cur_new_input_embeds)
@@ -176,29 +220,24 @@ class LlavaMetaForCausalLM(ABC):
 
             if labels is not None:
                 new_labels_align = []
-                _new_labels = new_labels
                 for cur_new_label in new_labels:
                     cur_new_label = torch.cat((cur_new_label, torch.full((max_len - cur_new_label.shape[0],), IGNORE_INDEX, dtype=cur_new_label.dtype, device=cur_new_label.device)), dim=0)
                     new_labels_align.append(cur_new_label)
                 new_labels = torch.stack(new_labels_align, dim=0)
 
             if attention_mask is not None:
-                new_attention_mask = []
-                for cur_attention_mask, cur_new_labels, cur_new_labels_align in zip(attention_mask, _new_labels, new_labels):
-                    new_attn_mask_pad_left = torch.full((cur_new_labels.shape[0] - labels.shape[1],), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                    new_attn_mask_pad_right = torch.full((cur_new_labels_align.shape[0] - cur_new_labels.shape[0],), False, dtype=attention_mask.dtype, device=attention_mask.device)
-                    cur_new_attention_mask = torch.cat((new_attn_mask_pad_left, cur_attention_mask, new_attn_mask_pad_right), dim=0)
-                    new_attention_mask.append(cur_new_attention_mask)
-                attention_mask = torch.stack(new_attention_mask, dim=0)
-                assert attention_mask.shape == new_labels.shape
+                attention_mask = torch.stack([
+                    torch.cat((cur_attention_mask, cur_attention_mask.new_zeros((max_len - cur_attention_mask.shape[0],))), dim=0)
+                    for cur_attention_mask in new_attention_masks
+                ], dim=0)
+                assert attention_mask.shape == new_input_embeds.shape[:2]
         else:
             new_input_embeds = torch.stack(new_input_embeds, dim=0)
             if labels is not None:
                 new_labels  = torch.stack(new_labels, dim=0)
 
             if attention_mask is not None:
-                new_attn_mask_pad_left = torch.full((attention_mask.shape[0], new_input_embeds.shape[1] - input_ids.shape[1]), True, dtype=attention_mask.dtype, device=attention_mask.device)
-                attention_mask = torch.cat((new_attn_mask_pad_left, attention_mask), dim=1)
+                attention_mask = torch.stack(new_attention_masks, dim=0)
                 assert attention_mask.shape == new_input_embeds.shape[:2]
 
         return None, attention_mask, past_key_values, new_input_embeds, new_labels
@@ -91,6 +91,21 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
         cd_alpha: Optional[float] = None,
         agla_beta: Optional[float] = None,
         agla_alpha: Optional[float] = None,
+        batch_branches: Optional[bool] = None,
+        branch_skip_policy: Optional[object] = None,
+        prefix_cache: Optional[object] = None,
+        prefix_cache_keys: Optional[dict] = None,
+        prefix_length: Optional[int] = None,
+        last_logits_only: Optional[bool] = None,
+        sampling_generator: Optional[object] = None,
+        sparse_candidates: Optional[int] = None,
+        static_kv_caches: Optional[dict] = None,
+        branch_exit_layers: Optional[dict] = None,
+        prior_cache: Optional[object] = None,
+        prior_cache_key: Optional[tuple] = None,
+        prior_input_ids: Optional[list] = None,
+        prior_images: Optional[torch.FloatTensor] = None,
+        exit_layer: Optional[int] = None,
         return_dict: Optional[bool] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         """
@@ -104,6 +119,21 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
             cd_beta: VCD plausibility threshold
             agla_alpha: AGLA enhancement strength
             agla_beta: AGLA plausibility threshold
+            batch_branches: Consumed by sample_vcd_agla (stacked 3×B branches)
+            branch_skip_policy: Consumed by sample_vcd_agla (entropy-gated branch skipping)
+            prefix_cache, prefix_cache_keys, prefix_length: Consumed by sample_vcd_agla
+                (image-prefix KV cache reuse)
+            last_logits_only: Apply lm_head to the last position only (generation
+                reads only the next-token logits; ignored when labels are given)
+            sampling_generator: Consumed by sample_vcd_agla (per-question sampling RNG)
+            sparse_candidates: Consumed by sample_vcd_agla (candidate-set combination and sampling)
+            static_kv_caches: Consumed by sample_vcd_agla (preallocated per-branch KV caches;
+                an int8 QuantizedKVCache is dequantized by its update() inside LlamaAttention)
+            branch_exit_layers: Consumed by sample_vcd_agla (decoder depth of the VCD/AGLA branches)
+            exit_layer: Run only the first ``exit_layer`` decoder layers, then the final
+                norm and lm_head (set per branch by sample_vcd_agla; default: all layers)
+            prior_cache, prior_cache_key, prior_input_ids, prior_images: Consumed by
+                sample_vcd_agla (cached language prior in place of the VCD branch)
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -117,19 +147,31 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
                 input_ids, attention_mask, past_key_values, labels, images
             )
 
+        # Left-padded batches: positions count only the attended tokens
+        position_ids = None
+        if attention_mask is not None and not attention_mask.bool().all():
+            seq_length = inputs_embeds.shape[1] if inputs_embeds is not None else input_ids.shape[1]
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            position_ids = position_ids[:, -seq_length:]
+
         # Forward through language model
-        outputs = self.model(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            past_key_values=past_key_values,
-            inputs_embeds=inputs_embeds,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict
-        )
+        with self.early_exit(exit_layer):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                inputs_embeds=inputs_embeds,
+                position_ids=position_ids,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict
+            )
 
         hidden_states = outputs[0]
+        if last_logits_only and labels is None:
+            hidden_states = hidden_states[:, -1:, :]
         logits = self.lm_head(hidden_states)
 
         loss = None
@@ -51,6 +51,9 @@ IMAGE_FOLDER="/root/autodl-tmp/VCD/experiments/data/coco/val2014"
 OUTPUT_DIR="/root/autodl-tmp/COMBINED/combined_results"
 mkdir -p "$OUTPUT_DIR"
 
+# AGLA mask 缓存（mask 取决于图像、问题和 BLIP 变体：LLaVA 各模型共用，Qwen-VL 用 base 变体单独缓存）
+AGLA_MASK_CACHE="/root/autodl-tmp/COMBINED/agla_mask_cache"
+
 # 日志文件
 LOG_FILE="$OUTPUT_DIR/experiment_log.txt"
 echo "实验开始时间: $(date)" | tee "$LOG_FILE"
@@ -86,7 +89,7 @@ run_experiment() {
     
     local output_file="$OUTPUT_DIR/${model_name}_${dataset_name}_${method}_seed${SEED}.jsonl"
     
-    # 检查是否已完成
+    # 检查是否已完成 (未完成的文件由 --resume 续跑)
     if [ -f "$output_file" ]; then
         local line_count=$(wc -l < "$output_file")
         if [ "$line_count" -ge 2900 ]; then
@@ -106,7 +109,7 @@ run_experiment() {
                 --model-path "$model_path" \
                 --image-folder "$IMAGE_FOLDER" \
                 --question-file "$dataset_file" \
-                --answers-file "$output_file" \
+                --answers-file "$output_file" --resume \
                 --conv-mode "$conv_mode" \
                 --temperature 1.0 \
                 --seed $SEED
@@ -115,7 +118,7 @@ run_experiment() {
                 --model-path "$model_path" \
                 --image-folder "$IMAGE_FOLDER" \
                 --question-file "$dataset_file" \
-                --answers-file "$output_file" \
+                --answers-file "$output_file" --resume \
                 --temperature 1.0 \
                 --seed $SEED
         fi
@@ -126,11 +129,12 @@ run_experiment() {
                 --model-path "$model_path" \
                 --image-folder "$IMAGE_FOLDER" \
                 --question-file "$dataset_file" \
-                --answers-file "$output_file" \
+                --answers-file "$output_file" --resume \
                 --conv-mode "$conv_mode" \
                 --use-vcd --use-agla \
                 --cd-alpha $CD_ALPHA --cd-beta $CD_BETA --noise-step $NOISE_STEP \
                 --agla-alpha $AGLA_ALPHA --agla-beta $AGLA_BETA \
+                --agla-mask-cache "$AGLA_MASK_CACHE" \
                 --temperature 1.0 \
                 --seed $SEED
         else
@@ -138,10 +142,11 @@ run_experiment() {
                 --model-path "$model_path" \
                 --image-folder "$IMAGE_FOLDER" \
                 --question-file "$dataset_file" \
-                --answers-file "$output_file" \
+                --answers-file "$output_file" --resume \
                 --use-vcd --use-agla \
                 --cd-alpha $CD_ALPHA --cd-beta $CD_BETA --noise-step $NOISE_STEP \
                 --agla-alpha $AGLA_ALPHA --agla-beta $AGLA_BETA \
+                --agla-mask-cache "$AGLA_MASK_CACHE" \
                 --temperature 1.0 \
                 --seed $SEED
         fi
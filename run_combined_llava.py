@@ -41,6 +41,12 @@ from sample_vcd_agla import evolve_vcd_agla_sampling
 
 # Import utilities
 from utils.vcd_add_noise import add_diffusion_noise
+from utils.prefix_cache import hash_image_file
+from utils.agla_cache import AGLAMaskCache, AGLAMaskProvider
+from utils.prefetch import AGLAMaskPrefetcher, ImagePrefetcher
+from utils.seeding import question_generator, sampling_generators
+from utils.resume import remaining_questions
+from utils.static_kv_cache import AUX_BRANCHES, BRANCHES, make_static_kv_caches
 
 # Try to import AGLA augmentation (requires LAVIS)
 try:
@@ -63,14 +69,6 @@ except ImportError:
     print("You may need to add the AGLA or VCD llava directory to your Python path.")
     sys.exit(1)
 
-# Import BLIP-ITM for AGLA
-try:
-    from lavis.models import load_model_and_preprocess
-    from torchvision import transforms
-except ImportError:
-    print("Warning: Could not import lavis. AGLA functionality will not be available.")
-    print("Install with: pip install salesforce-lavis")
-
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -91,6 +89,8 @@ def parse_args():
     parser.add_argument("--image-folder", type=str, required=True, help="Path to image folder")
     parser.add_argument("--question-file", type=str, required=True, help="Path to question file (JSONL)")
     parser.add_argument("--answers-file", type=str, required=True, help="Path to save answers (JSONL)")
+    parser.add_argument("--resume", action='store_true',
+                        help="Keep the answers already in --answers-file and only run the missing questions")
     
     # Generation arguments
     parser.add_argument("--conv-mode", type=str, default="llava_v1", help="Conversation mode")
@@ -107,12 +107,52 @@ def parse_args():
     parser.add_argument("--use-agla", action='store_true', help="Enable AGLA")
     parser.add_argument("--agla-alpha", type=float, default=1.0, help="AGLA enhancement strength")
     parser.add_argument("--agla-beta", type=float, default=0.5, help="AGLA plausibility threshold")
+    parser.add_argument("--agla-mask-cache", type=str, default=None,
+                        help="Directory of the AGLA mask cache shared across LLaVA models and runs")
+    parser.add_argument("--agla-device-mask", action='store_true',
+                        help="Compute AGLA masks on the GPU and apply them to the preprocessed image tensor")
+    parser.add_argument("--agla-workers", type=int, default=0,
+                        help="Worker processes computing AGLA masks ahead of the LVLM (0 = inline)")
+    parser.add_argument("--agla-prefetch", type=int, default=None,
+                        help="Same-image question groups prefetched ahead (default: 2 x workers)")
+
+    # Input pipeline arguments
+    parser.add_argument("--loader-workers", type=int, default=0,
+                        help="Threads decoding and preprocessing images ahead of the LVLM (0 = inline)")
+    parser.add_argument("--loader-prefetch", type=int, default=None,
+                        help="Same-image question groups loaded ahead (default: 2 x loader workers)")
+
+    # Decoding arguments
+    parser.add_argument("--batch-branches", action='store_true',
+                        help="Run original/VCD/AGLA branches as one stacked batch per decode step")
+    parser.add_argument("--sparse-candidates", type=int, default=None,
+                        help="Combine and sample within the K tokens passing the plausibility cutoff "
+                             "(falls back to the full vocabulary when more survive)")
+    parser.add_argument("--static-kv-cache", action='store_true',
+                        help="Preallocate one KV cache per branch, written in place and reused across questions")
+    parser.add_argument("--aux-kv-int8", action='store_true',
+                        help="Keep the VCD/AGLA branch KV caches in int8 with a per-head, per-position scale "
+                             "(about half the memory)")
+    parser.add_argument("--vcd-exit-layer", type=int, default=None,
+                        help="Run the VCD branch through its first K decoder layers only (default: all layers)")
+    parser.add_argument("--agla-exit-layer", type=int, default=None,
+                        help="Run the AGLA branch through its first K decoder layers only (default: all layers)")
     
     # Other arguments
     parser.add_argument("--num-gpus", type=int, default=1, help="Number of GPUs")
     parser.add_argument("--debug", action='store_true', help="Enable debug logging")
+    parser.add_argument("--seed", type=int, default=55,
+                        help="Seed of the per-question VCD noise and sampling generators")
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.aux_kv_int8 and args.batch_branches:
+        parser.error("--aux-kv-int8 cannot be combined with --batch-branches")
+    for option in ("vcd_exit_layer", "agla_exit_layer"):
+        if getattr(args, option) is not None and getattr(args, option) < 1:
+            parser.error(f"--{option.replace('_', '-')} must be at least 1")
+    if (args.vcd_exit_layer is not None or args.agla_exit_layer is not None) and args.batch_branches:
+        parser.error("--vcd-exit-layer / --agla-exit-layer cannot be combined with --batch-branches")
+    return args
 
 
 def load_models(args):
@@ -124,72 +164,64 @@ def load_models(args):
         args.model_path, args.model_base, args.model_name
     )
     
-    # Load BLIP-ITM if AGLA is enabled
-    model_itm = None
-    vis_processors = None
-    text_processors = None
+    # AGLA masks come from the disk cache; BLIP-ITM is loaded on the first miss
+    agla_provider = None
 
     if args.use_agla:
+        agla_mask_cache = AGLAMaskCache(args.agla_mask_cache) if args.agla_mask_cache else None
         if not AGLA_AVAILABLE:
-            logger.error("AGLA requested but not available. Please install LAVIS:")
-            logger.error("  pip install salesforce-lavis")
-            sys.exit(1)
-
-        try:
-            logger.info("Loading BLIP-ITM model for AGLA")
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
-            model_itm, vis_processors, text_processors = load_model_and_preprocess(
-                "blip_image_text_matching", "large", device=device, is_eval=True
-            )
-        except Exception as e:
-            logger.error(f"Failed to load BLIP-ITM: {e}")
-            logger.error("AGLA will be disabled")
-            args.use_agla = False
+            if agla_mask_cache is None:
+                logger.error("AGLA requested but not available. Please install LAVIS:")
+                logger.error("  pip install salesforce-lavis")
+                sys.exit(1)
+            logger.warning("LAVIS not available, only cached AGLA masks can be used")
+        agla_provider = AGLAMaskProvider(agla_mask_cache, blip_variant="large", device_masks=args.agla_device_mask)
     
-    return tokenizer, model, image_processor, context_len, model_itm, vis_processors, text_processors
+    return tokenizer, model, image_processor, context_len, agla_provider
 
 
-def prepare_images(raw_image, question, image_processor, args, model_itm, vis_processors, text_processors):
+def prepare_images(raw_image, question, image_processor, args, agla_provider, image_hash=None, agla_mask=None,
+                   loaded=None, noise_generator=None):
     """
     Prepare three types of images:
     1. Original image
     2. VCD noisy image (if use_vcd)
-    3. AGLA augmented image (if use_agla)
-    """
-    # Original image
-    image_tensor = image_processor.preprocess(raw_image, return_tensors='pt')['pixel_values'][0]
+    3. AGLA augmented image (if use_agla; ``agla_mask`` is a prefetched keep-mask)
     
-    # VCD noisy image
-    image_tensor_vcd = None
-    if args.use_vcd:
-        image_tensor_vcd = add_diffusion_noise(image_tensor, args.noise_step)
-        logger.debug(f"Added VCD noise at step {args.noise_step}")
+    ``loaded`` is an ImagePrefetcher item that already holds 1. and 2.;
+    otherwise the VCD noise is drawn from ``noise_generator``.
+    """
+    if loaded is not None:
+        image_tensor, image_tensor_vcd = loaded["pixel_values"], loaded["pixel_values_cd"]
+    else:
+        # Original image
+        image_tensor = image_processor.preprocess(raw_image, return_tensors='pt')['pixel_values'][0]
+        
+        # VCD noisy image
+        image_tensor_vcd = None
+        if args.use_vcd:
+            image_tensor_vcd = add_diffusion_noise(image_tensor, args.noise_step, generator=noise_generator)
+            logger.debug(f"Added VCD noise at step {args.noise_step}")
     
     # AGLA augmented image
     image_tensor_agla = None
-    if args.use_agla and model_itm is not None:
+    if agla_provider is not None:
         try:
-            # Prepare image for BLIP
-            loader = transforms.Compose([transforms.ToTensor()])
-            tensor_image = loader(raw_image.resize((384, 384)))
-            image_blip = vis_processors["eval"](raw_image).unsqueeze(0).to('cuda')
-            
-            # Prepare text for BLIP
-            question_blip = text_processors["eval"](question)
-            tokenized_text = model_itm.tokenizer(
-                question_blip, padding='longest', truncation=True, return_tensors="pt"
-            ).to('cuda')
-            
-            # Generate augmented image
-            augmented_image = augmentation(
-                image_blip, question_blip, tensor_image, 
-                model_itm, tokenized_text, raw_image
-            )
-            
-            # Preprocess augmented image
-            image_tensor_agla = image_processor.preprocess(
-                augmented_image, return_tensors='pt'
-            )['pixel_values'][0]
+            if args.agla_device_mask:
+                # Mask the preprocessed tensor directly (CLIP center-crop view)
+                image_tensor_agla = agla_provider.augment_pixel_values(
+                    image_tensor.unsqueeze(0).cuda(), raw_image, question,
+                    image_processor.image_mean, image_processor.image_std,
+                    image_hash, center_crop=True, mask=agla_mask,
+                )[0]
+            else:
+                # Generate augmented image (cached mask or BLIP-ITM GradCAM)
+                augmented_image = agla_provider.augment(raw_image, question, image_hash, mask=agla_mask)
+                
+                # Preprocess augmented image
+                image_tensor_agla = image_processor.preprocess(
+                    augmented_image, return_tensors='pt'
+                )['pixel_values'][0]
             
             logger.debug("Generated AGLA augmented image")
         except Exception as e:
@@ -206,25 +238,77 @@ def evaluate(args):
     logger.info("Evolved sampling function to VCD+AGLA")
     
     # Load models
-    tokenizer, model, image_processor, context_len, model_itm, vis_processors, text_processors = load_models(args)
+    tokenizer, model, image_processor, context_len, agla_provider = load_models(args)
     
     # Load questions
     logger.info(f"Loading questions from {args.question_file}")
     questions = [json.loads(q) for q in open(args.question_file, "r")]
+    for i, line in enumerate(questions):
+        line.setdefault("question_id", i)
     
-    # Open answers file
+    # Open answers file (--resume appends the questions an interrupted run did not answer)
     os.makedirs(os.path.dirname(args.answers_file) if os.path.dirname(args.answers_file) else '.', exist_ok=True)
-    ans_file = open(args.answers_file, "w")
+    num_questions = len(questions)
+    questions, answers_mode = remaining_questions(questions, args.answers_file, args.resume)
+    if args.resume:
+        logger.info(f"Resuming: {num_questions - len(questions)} questions already answered")
+    ans_file = open(args.answers_file, answers_mode)
     
     logger.info(f"Starting evaluation on {len(questions)} questions")
     logger.info(f"VCD: {args.use_vcd}, AGLA: {args.use_agla}")
     
+    # Early exit of the VCD/AGLA branches after their first K decoder layers
+    branch_exit_layers = {
+        name: layer for name, layer in (("vcd", args.vcd_exit_layer), ("agla", args.agla_exit_layer))
+        if layer is not None
+    }
+    
+    # Preallocated per-branch KV caches reused by every question (int8 VCD/AGLA caches with --aux-kv-int8)
+    static_kv_caches = None
+    if args.static_kv_cache or args.aux_kv_int8:
+        static_kv_caches = make_static_kv_caches(
+            model, args.max_new_tokens,
+            branches=BRANCHES if args.static_kv_cache else AUX_BRANCHES,
+            int8_branches=AUX_BRANCHES if args.aux_kv_int8 else (),
+        )
+    
+    # AGLA masks computed ahead of the LVLM in worker processes
+    agla_prefetcher = None
+    agla_masks = None
+    if agla_provider is not None and args.agla_workers > 0:
+        agla_prefetcher = AGLAMaskPrefetcher(agla_provider, num_workers=args.agla_workers, depth=args.agla_prefetch)
+        agla_masks = agla_prefetcher.iter_masks(
+            [(os.path.join(args.image_folder, line["image"]), line["text"]) for line in questions]
+        )
+    
+    # Images decoded, preprocessed and noised ahead of the LVLM in loader threads
+    image_loader = None
+    loaded_images = None
+    if args.loader_workers > 0:
+        image_loader = ImagePrefetcher(
+            lambda image: image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0],
+            num_workers=args.loader_workers, depth=args.loader_prefetch,
+            noise_step=args.noise_step if args.use_vcd else None, seed=args.seed,
+            hash_images=agla_provider is not None,
+        )
+        loaded_images = image_loader.iter_images(
+            [os.path.join(args.image_folder, line["image"]) for line in questions],
+            noise_keys=[line.get("question_id", i) for i, line in enumerate(questions)],
+        )
+    
     # Process each question
     for i, line in enumerate(tqdm(questions, desc="Evaluating")):
         idx = line.get("question_id", i)
         image_file = line["image"]
         question = line["text"]
         
+        # Consume the prefetched mask first so skipped questions stay aligned
+        agla_mask = agla_error = None
+        if agla_masks is not None:
+            agla_mask, _, agla_error = next(agla_masks)
+            if agla_error is not None:
+                logger.error(f"Error generating AGLA mask for question {idx}: {agla_error}")
+        
         # Prepare prompt
         qs = f"<image>\n{question}"
         conv = conv_templates[args.conv_mode].copy()
@@ -238,16 +322,26 @@ def evaluate(args):
         ).unsqueeze(0).cuda()
         
         # Load and prepare images
-        try:
-            image_path = os.path.join(args.image_folder, image_file)
-            raw_image = Image.open(image_path).convert('RGB')
-        except Exception as e:
-            logger.error(f"Error loading image {image_file}: {e}")
-            continue
-        
+        loaded = None
+        if loaded_images is not None:
+            loaded = next(loaded_images)
+            if loaded["error"] is not None:
+                logger.error(loaded["error"])
+                continue
+            raw_image, image_hash = loaded["raw_image"], loaded["image_hash"]
+        else:
+            try:
+                image_path = os.path.join(args.image_folder, image_file)
+                raw_image = Image.open(image_path).convert('RGB')
+            except Exception as e:
+                logger.error(f"Error loading image {image_file}: {e}")
+                continue
+            
+            image_hash = hash_image_file(image_path) if agla_provider is not None else None
         image_tensor, image_tensor_vcd, image_tensor_agla = prepare_images(
-            raw_image, question, image_processor, args, 
-            model_itm, vis_processors, text_processors
+            raw_image, question, image_processor, args,
+            agla_provider if agla_error is None else None, image_hash, agla_mask, loaded,
+            noise_generator=question_generator(args.seed, idx, "vcd"),
         )
         
         # Generate
@@ -255,15 +349,21 @@ def evaluate(args):
             with torch.inference_mode():
                 output_ids = model.generate(
                     input_ids,
-                    images=image_tensor.unsqueeze(0).half().cuda(),
-                    images_cd=(image_tensor_vcd.unsqueeze(0).half().cuda() 
+                    images=image_tensor.unsqueeze(0).cuda(non_blocking=True).half(),
+                    images_cd=(image_tensor_vcd.unsqueeze(0).cuda(non_blocking=True).half()
                               if image_tensor_vcd is not None else None),
-                    images_agla=(image_tensor_agla.unsqueeze(0).half().cuda() 
+                    images_agla=(image_tensor_agla.unsqueeze(0).cuda(non_blocking=True).half()
                                 if image_tensor_agla is not None else None),
                     cd_alpha=args.cd_alpha,
                     cd_beta=args.cd_beta,
                     agla_alpha=args.agla_alpha,
                     agla_beta=args.agla_beta,
+                    batch_branches=args.batch_branches,
+                    last_logits_only=True,
+                    sparse_candidates=args.sparse_candidates,
+                    static_kv_caches=static_kv_caches,
+                    branch_exit_layers=branch_exit_layers,
+                    sampling_generator=sampling_generators(args.seed, [idx], input_ids.device),
                     do_sample=True,
                     temperature=args.temperature,
                     max_new_tokens=args.max_new_tokens,
@@ -292,6 +392,10 @@ def evaluate(args):
             logger.debug(f"A: {outputs}")
     
     ans_file.close()
+    if agla_prefetcher is not None:
+        agla_prefetcher.close()
+    if image_loader is not None:
+        image_loader.close()
     logger.info(f"Evaluation complete. Results saved to {args.answers_file}")
 
 
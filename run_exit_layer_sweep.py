@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Early-Exit Depth Sweep of the VCD/AGLA Branches
+
+Runs the POPE questions once per decoder depth K of the auxiliary branches
+(--vcd-exit-layer / --agla-exit-layer of the runners) plus once at full
+depth, with one model load, and scores every run with eval_pope. The
+cheapest K whose F1 stays within ``--tolerance`` of the full-depth F1 is
+reported, together with an exact McNemar test of its per-question
+correctness against the full-depth run.
+
+An auxiliary branch at depth K costs about K / L of a full forward (L decoder
+layers); the original branch always runs all layers.
+
+Usage:
+    python run_exit_layer_sweep.py --runner llava --question-file pope_coco_val.jsonl \\
+        --output-dir output/exit_layers --branches vcd --exit-layers 8 12 16 20 24 -- \\
+        --model-path /path/to/llava --image-folder /path/to/coco --use-vcd --use-agla
+"""
+
+import argparse
+import importlib
+import json
+import os
+import time
+
+from eval_pope import evaluate_pope, load_ground_truth
+from run_matrix import RUNNERS, release
+from run_sequential_sweep import compare, load_correct, mcnemar_pvalue
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="POPE F1 of the VCD/AGLA branches truncated to their first K decoder layers",
+        epilog="Arguments after '--' are passed to the runner for every depth.",
+    )
+    parser.add_argument("--runner", type=str, default="llava", choices=sorted(RUNNERS), help="Model runner")
+    parser.add_argument("--question-file", type=str, required=True, help="Validation questions (with labels)")
+    parser.add_argument("--output-dir", type=str, required=True, help="Answers per depth and sweep summary")
+    parser.add_argument("--branches", type=str, nargs="+", default=["vcd"], choices=["vcd", "agla"],
+                        help="Auxiliary branches truncated to depth K")
+    parser.add_argument("--exit-layers", type=int, nargs="+", required=True, help="Depths K to evaluate")
+    parser.add_argument("--tolerance", type=float, default=0.005,
+                        help="F1 drop versus full depth accepted for the recommended depth")
+    parser.add_argument("--resume", action='store_true', help="Keep the answers of an interrupted sweep")
+    parser.add_argument("--seed", type=int, default=55, help="Random seed (decoding)")
+    args, runner_args = parser.parse_known_args()
+    if runner_args and runner_args[0] == "--":
+        runner_args = runner_args[1:]
+    for option in ["--question-file", "--answers-file", "--seed", "--resume", "--vcd-exit-layer", "--agla-exit-layer"]:
+        if option in runner_args:
+            parser.error(f"{option} is set by the sweep")
+    if min(args.exit_layers) < 1:
+        parser.error("--exit-layers must be at least 1")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    ground_truth = load_ground_truth(args.question_file)
+
+    from transformers import set_seed
+
+    runner = importlib.import_module(RUNNERS[args.runner])
+    session = None
+    depths = [None] + sorted(set(args.exit_layers), reverse=True)
+    runs = {}
+    for depth in depths:
+        name = "full" if depth is None else f"k{depth}"
+        answers_file = os.path.join(args.output_dir, f"{name}.jsonl")
+        depth_args = []
+        if depth is not None:
+            for branch in args.branches:
+                depth_args.extend([f"--{branch}-exit-layer", str(depth)])
+        job_args = runner.parse_args(runner_args + depth_args + [
+            "--question-file", args.question_file, "--answers-file", answers_file, "--seed", str(args.seed),
+        ] + (["--resume"] if args.resume else []))
+        if session is None:
+            session = runner.load_model(job_args)
+            num_layers = session["model"].config.num_hidden_layers
+        if depth is not None and depth >= num_layers:
+            print(f"Skipping K={depth}: the model has {num_layers} decoder layers")
+            continue
+
+        print(f"\n{'=' * 60}\nDepth {'full' if depth is None else depth} of {num_layers} ({', '.join(args.branches)})")
+        set_seed(job_args.seed)
+        start = time.time()
+        runner.eval_model(job_args, session)
+        runs[name] = {
+            "exit_layer": depth,
+            "aux_cost": 1.0 if depth is None else depth / num_layers,
+            "seconds": time.time() - start,
+            "metrics": evaluate_pope(args.question_file, answers_file, verbose=False),
+            "correct": load_correct(answers_file, ground_truth),
+        }
+
+    if session is not None:
+        release(session)
+
+    full = runs["full"]
+    question_ids = list(full["correct"])
+    for name, run in runs.items():
+        if name == "full":
+            continue
+        b, c = compare(full["correct"], run["correct"], question_ids)
+        run["mcnemar"] = {"b": b, "c": c, "p": mcnemar_pvalue(b, c)}
+    # Cheapest depth within the tolerance (full depth when none is)
+    accepted = [name for name, run in runs.items() if run["metrics"]["f1"] >= full["metrics"]["f1"] - args.tolerance]
+    best = min(accepted, key=lambda name: runs[name]["aux_cost"])
+
+    summary = {
+        "branches": args.branches,
+        "num_layers": num_layers,
+        "tolerance": args.tolerance,
+        "recommended": best,
+        "runs": {name: {k: v for k, v in run.items() if k != "correct"} for name, run in runs.items()},
+    }
+    summary_path = os.path.join(args.output_dir, "exit_layer_sweep.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"\n{'=' * 60}")
+    print(f"{'depth':<8} {'aux cost':>9} {'Acc':>8} {'F1':>8} {'Yes':>8} {'McNemar p':>10} {'time (s)':>9}")
+    for name, run in runs.items():
+        m = run["metrics"]
+        p = f"{run['mcnemar']['p']:10.4f}" if "mcnemar" in run else f"{'-':>10}"
+        print(f"{name:<8} {run['aux_cost']:9.2f} {m['accuracy']:8.4f} {m['f1']:8.4f} {m['yes_proportion']:8.4f} "
+              f"{p} {run['seconds']:9.1f}")
+    print(f"Cheapest depth within {args.tolerance} F1 of full depth: {best}")
+    print(f"Summary saved to {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+In-Process Experiment Matrix Orchestrator
+
+Runs a models x datasets x methods matrix (configs/experiment_matrix.yaml)
+with each model loaded once. run_all_combined_experiments.sh starts one
+Python process per experiment, so every job reloads the 7B checkpoint,
+LAVIS / BLIP-ITM and the tokenizer; here the jobs of a model share one
+session (see run_pope_combined.load_model), and the AGLA providers (BLIP-ITM,
+its image encodings and the mask cache) are shared by the models that use the
+same BLIP variant: the LLaVA models share BLIP-ITM large, Qwen-VL uses base in
+fp16, and the variant is part of the mask cache key.
+
+Every job is run with --resume, so a finished job is skipped and an
+interrupted one is continued.
+
+Usage:
+    python run_matrix.py --config configs/experiment_matrix.yaml
+    python run_matrix.py --config configs/experiment_matrix.yaml --models qwenvl --datasets coco_pope
+"""
+
+import argparse
+import gc
+import importlib
+import itertools
+import json
+import os
+import time
+import traceback
+from datetime import datetime
+
+import yaml
+
+RUNNERS = {
+    "llava": "run_pope_combined",
+    "qwenvl": "run_qwenvl_combined",
+}
+
+
+def to_argv(options):
+    """Runner command line of an options dict (true = flag, false / None = omitted)."""
+    argv = []
+    for key, value in options.items():
+        flag = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(flag)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, (list, tuple)):
+            argv.extend([flag, *map(str, value)])
+        else:
+            argv.extend([flag, str(value)])
+    return argv
+
+
+def expand_methods(methods):
+    """
+    Expand list-valued method options into one method per combination.
+
+    ``{"vcd": {"noise_step": [300, 500]}}`` becomes
+    ``{"vcd_noise_step300": {"noise_step": 300}, "vcd_noise_step500": {"noise_step": 500}}``.
+    """
+    expanded = {}
+    for name, options in methods.items():
+        options = options or {}
+        swept = [key for key, value in options.items() if isinstance(value, list)]
+        for values in itertools.product(*(options[key] for key in swept)):
+            suffix = "".join(f"_{key}{value}" for key, value in zip(swept, values))
+            expanded[name + suffix] = {**options, **dict(zip(swept, values))}
+    return expanded
+
+
+def build_jobs(config, models=None, datasets=None, methods=None):
+    """
+    Jobs of the matrix grouped by model, in config order.
+
+    Returns:
+        list of (model_name, model_config, [job, ...]) where a job is a dict
+        with name, output file and runner options
+    """
+    excluded = {(e["model"], e["dataset"]) for e in config.get("exclude") or []}
+    all_methods = expand_methods(config["methods"])
+    seed = config.get("seed", 55)
+
+    groups = []
+    for model_name, model_config in config["models"].items():
+        if models and model_name not in models:
+            continue
+        jobs = []
+        for dataset_name, question_file in config["datasets"].items():
+            if datasets and dataset_name not in datasets or (model_name, dataset_name) in excluded:
+                continue
+            for method_name, method_options in all_methods.items():
+                if methods and method_name not in methods:
+                    continue
+                answers_file = os.path.join(
+                    config["output_dir"], f"{model_name}_{dataset_name}_{method_name}_seed{seed}.jsonl"
+                )
+                jobs.append({
+                    "name": f"{model_name} {dataset_name} {method_name}",
+                    "answers_file": answers_file,
+                    "options": {
+                        **(config.get("args") or {}),
+                        **(model_config.get("args") or {}),
+                        **method_options,
+                        "question_file": question_file,
+                        "answers_file": answers_file,
+                        "seed": seed,
+                        "resume": True,
+                    },
+                })
+        if jobs:
+            groups.append((model_name, model_config, jobs))
+    return groups
+
+
+def is_complete(job):
+    """Whether every question of a job already has an answer."""
+    from utils.resume import read_answered_ids
+
+    with open(job["options"]["question_file"], "r") as f:
+        question_ids = {json.loads(line)["question_id"] for line in f if line.strip()}
+    return question_ids <= read_answered_ids(job["answers_file"], repair=False)
+
+
+def release(session):
+    """Drop a model session and return its GPU memory."""
+    import torch
+
+    session.clear()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an experiment matrix with one model load per model")
+    parser.add_argument("--config", type=str, default="configs/experiment_matrix.yaml", help="Matrix config (YAML)")
+    parser.add_argument("--models", type=str, nargs="+", default=None, help="Only these models")
+    parser.add_argument("--datasets", type=str, nargs="+", default=None, help="Only these datasets")
+    parser.add_argument("--methods", type=str, nargs="+", default=None, help="Only these (expanded) methods")
+    parser.add_argument("--dry-run", action='store_true', help="Print the jobs without running them")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+    groups = build_jobs(config, args.models, args.datasets, args.methods)
+    total = sum(len(jobs) for _, _, jobs in groups)
+    print(f"Experiment matrix: {total} jobs over {len(groups)} models")
+
+    if args.dry_run:
+        for model_name, model_config, jobs in groups:
+            runner = RUNNERS[model_config["runner"]]
+            for job in jobs:
+                print(f"  python {runner}.py {' '.join(to_argv(job['options']))}")
+        return
+
+    os.makedirs(config["output_dir"], exist_ok=True)
+    log_path = os.path.join(config["output_dir"], "experiment_log.txt")
+    from transformers import set_seed
+
+    agla_providers = {}
+    failed = []
+    done = 0
+    for model_name, model_config, jobs in groups:
+        runner = importlib.import_module(RUNNERS[model_config["runner"]])
+        session = None
+        start = time.time()
+        for job in jobs:
+            done += 1
+            print(f"\n{'=' * 60}\nExperiment {done}/{total}: {job['name']}\n{'=' * 60}")
+            job_start = time.time()
+            try:
+                if is_complete(job):
+                    print(f"✓ Already complete (skipped): {job['answers_file']}")
+                    continue
+                job_args = runner.parse_args(to_argv(job["options"]))
+                if session is None:
+                    session = runner.load_model(job_args, agla_providers)
+                    print(f"✓ Loaded {model_name} in {time.time() - start:.0f}s")
+                set_seed(job_args.seed)
+                runner.eval_model(job_args, session)
+                status = "SUCCESS"
+            except (Exception, SystemExit) as e:
+                traceback.print_exc()
+                failed.append(job["name"])
+                status = f"FAILED ({type(e).__name__}: {e})"
+            with open(log_path, "a") as log:
+                log.write(f"{datetime.now()} - {status}: {job['name']} ({time.time() - job_start:.0f}s)\n")
+        if session is not None:
+            release(session)
+        print(f"\n✓ {model_name}: {len(jobs)} jobs in {time.time() - start:.0f}s")
+
+    print(f"\n{'=' * 60}\nFinished {total - len(failed)}/{total} jobs")
+    for name in failed:
+        print(f"✗ {name}")
+    summary_path = os.path.join(config["output_dir"], "matrix_summary.json")
+    with open(summary_path, "w") as f:
+        json.dump({"total": total, "failed": failed}, f, indent=2)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Hyperparameter Search for the Combined Method
+
+Replaces the fixed Cartesian grid of scripts/parameter_search.sh with
+successive halving over continuous ranges of cd_alpha, cd_beta, agla_alpha,
+agla_beta and noise_step. Each bracket starts eta^k configurations on a small
+question subset and promotes the best 1/eta of them to an eta times larger
+subset until the full validation set is reached. New configurations are
+proposed by a tree-structured Parzen estimator (TPE) fitted to the trials
+evaluated so far (``--proposer random`` samples uniformly).
+
+The compute budget is counted in question evaluations (one configuration
+answering one question). The model is loaded once; subsets are nested and
+every evaluation runs with --resume, so a promoted configuration only answers
+the questions its new subset adds.
+
+The trial history is saved to ``<output-dir>/search_history.json`` after
+every evaluation. The search is a deterministic function of that history and
+the seed, so ``--resume`` continues an interrupted search where it stopped
+(a larger ``--budget`` extends a finished one).
+
+Usage:
+    python run_param_search.py --runner llava --question-file pope_coco_val.jsonl \\
+        --output-dir output/search_llava15_coco --budget 20000 -- \\
+        --model-path /path/to/llava --image-folder /path/to/coco --use-vcd --use-agla
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+
+from eval_pope import compute_pope_metrics, confusion_counts, load_ground_truth, load_predictions
+from live_eval_pope import write_status
+from run_matrix import RUNNERS, release
+
+# name -> (low, high, scale); "int" values are rounded
+SEARCH_SPACE = {
+    "cd_alpha": (0.0, 3.0, "linear"),
+    "cd_beta": (0.01, 0.5, "log"),
+    "agla_alpha": (0.0, 3.0, "linear"),
+    "agla_beta": (0.1, 0.9, "linear"),
+    "noise_step": (100, 900, "int"),
+}
+
+# Points of the Cartesian grid in scripts/parameter_search.sh (3 x 3 x 3 x 3)
+GRID_POINTS = 81
+
+
+def to_unit(name, value):
+    """Map a parameter value into [0, 1]."""
+    low, high, scale = SEARCH_SPACE[name]
+    if scale == "log":
+        return (math.log(value) - math.log(low)) / (math.log(high) - math.log(low))
+    return (value - low) / (high - low)
+
+
+def from_unit(name, u):
+    """Parameter value of a point in [0, 1]."""
+    low, high, scale = SEARCH_SPACE[name]
+    u = min(1.0, max(0.0, u))
+    if scale == "log":
+        return round(math.exp(math.log(low) + u * (math.log(high) - math.log(low))), 4)
+    if scale == "int":
+        return int(round(low + u * (high - low)))
+    return round(low + u * (high - low), 4)
+
+
+def parzen_log_density(u, centers, bandwidth):
+    """Log density at ``u`` of Gaussian kernels on ``centers`` mixed with a uniform prior on [0, 1]."""
+    density = 1.0 + sum(
+        math.exp(-0.5 * ((u - c) / bandwidth) ** 2) / (bandwidth * math.sqrt(2 * math.pi)) for c in centers
+    )
+    return math.log(density / (len(centers) + 1))
+
+
+def propose_tpe(observations, names, rng, gamma=0.25, num_candidates=24):
+    """
+    Tree-structured Parzen estimator proposal.
+
+    The observations are split into the best ``gamma`` fraction and the rest;
+    candidates are drawn around the good points and the one maximizing
+    l(x) / g(x) (good over bad density, per parameter) is returned.
+
+    Args:
+        observations (list): (params dict, score) pairs, higher score is better
+        names (list): Parameters to propose
+        rng (random.Random): Random source
+
+    Returns:
+        dict: Proposed parameters
+    """
+    ranked = sorted(observations, key=lambda o: o[1], reverse=True)
+    num_good = max(1, int(math.ceil(gamma * len(ranked))))
+    good = {name: [to_unit(name, p[name]) for p, _ in ranked[:num_good]] for name in names}
+    bad = {name: [to_unit(name, p[name]) for p, _ in ranked[num_good:]] for name in names}
+    # Scott-style bandwidths that shrink as the estimators see more points
+    good_bw = max(0.05, len(ranked[:num_good]) ** (-1 / (len(names) + 4)) * 0.3)
+    bad_bw = max(0.05, max(1, len(ranked) - num_good) ** (-1 / (len(names) + 4)) * 0.3)
+
+    best, best_score = None, -math.inf
+    for _ in range(num_candidates):
+        anchor = rng.randrange(num_good)
+        point = {name: min(1.0, max(0.0, rng.gauss(good[name][anchor], good_bw))) for name in names}
+        score = sum(
+            parzen_log_density(point[name], good[name], good_bw) - parzen_log_density(point[name], bad[name], bad_bw)
+            for name in names
+        )
+        if score > best_score:
+            best, best_score = point, score
+    return {name: from_unit(name, u) for name, u in best.items()}
+
+
+def rung_sizes(num_questions, min_questions, eta):
+    """Subset sizes of the successive-halving rungs: min_questions * eta^i, the last one being all questions."""
+    sizes, size = [], min_questions
+    while size < num_questions:
+        sizes.append(size)
+        size *= eta
+    return sizes + [num_questions]
+
+
+def subset_metrics(answers_file, ground_truth, question_ids):
+    """
+    POPE metrics of an answers file restricted to ``question_ids`` (first answer per question).
+
+    ``ground_truth`` is the result of eval_pope.load_ground_truth.
+    """
+    _, index, labels = ground_truth
+    rows = sorted({index[idx] for idx in question_ids})
+    answered, has_yes, has_no = load_predictions(answers_file, index)
+    counts = confusion_counts(labels[rows], answered[rows], has_yes[rows], has_no[rows])
+    return compute_pope_metrics(
+        counts["true_pos"], counts["true_neg"], counts["false_pos"], counts["false_neg"],
+        counts["yes_answers"], counts["unknown"], len(rows),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Successive-halving / TPE search over the VCD and AGLA hyperparameters",
+        epilog="Arguments after '--' are passed to the runner for every trial.",
+    )
+    parser.add_argument("--runner", type=str, default="llava", choices=sorted(RUNNERS), help="Model runner")
+    parser.add_argument("--question-file", type=str, required=True, help="Validation questions (with labels)")
+    parser.add_argument("--output-dir", type=str, required=True, help="Trial answers, subsets and search history")
+    parser.add_argument("--budget", type=int, required=True, help="Budget in question evaluations")
+    parser.add_argument("--params", type=str, nargs="+", default=list(SEARCH_SPACE), choices=list(SEARCH_SPACE),
+                        help="Parameters to search (the others keep the runner defaults)")
+    parser.add_argument("--proposer", type=str, default="tpe", choices=["tpe", "random"],
+                        help="How new configurations are proposed")
+    parser.add_argument("--metric", type=str, default="f1", choices=["f1", "accuracy"], help="Metric to maximize")
+    parser.add_argument("--min-questions", type=int, default=100, help="Subset size of the first rung")
+    parser.add_argument("--eta", type=int, default=3, help="Halving rate (keep 1/eta, grow subsets by eta)")
+    parser.add_argument("--resume", action='store_true', help="Continue the search in --output-dir")
+    parser.add_argument("--seed", type=int, default=55, help="Random seed (question order, proposals and decoding)")
+    args, runner_args = parser.parse_known_args()
+    if runner_args and runner_args[0] == "--":
+        runner_args = runner_args[1:]
+    for option in ["--question-file", "--answers-file", "--seed", "--resume",
+                   *("--" + name.replace("_", "-") for name in args.params)]:
+        if option in runner_args:
+            parser.error(f"{option} is set by the search")
+    if args.eta < 2:
+        parser.error("--eta must be at least 2")
+
+    with open(os.path.expanduser(args.question_file), "r") as f:
+        lines = [line if line.endswith("\n") else line + "\n" for line in f if line.strip()]
+    if not lines:
+        parser.error("the question file is empty")
+    # Shuffle once so every subset is a random sample and each rung extends the previous one
+    random.Random(args.seed).shuffle(lines)
+    question_ids = [json.loads(line)["question_id"] for line in lines]
+    ground_truth = load_ground_truth(args.question_file)
+    sizes = rung_sizes(len(lines), args.min_questions, args.eta)
+    bracket_size = args.eta ** (len(sizes) - 1)
+
+    settings = {
+        "question_file": os.path.abspath(os.path.expanduser(args.question_file)),
+        "params": args.params, "proposer": args.proposer, "metric": args.metric,
+        "min_questions": args.min_questions, "eta": args.eta, "seed": args.seed, "runner_args": runner_args,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    history_path = os.path.join(args.output_dir, "search_history.json")
+    history = {"settings": settings, "trials": [], "spent": 0}
+    if os.path.exists(history_path):
+        if not args.resume:
+            parser.error(f"{history_path} exists; pass --resume or choose another --output-dir")
+        with open(history_path, "r") as f:
+            history = json.load(f)
+        if history["settings"] != settings:
+            parser.error("--resume needs the settings of the saved search (see search_history.json)")
+    trials = history["trials"]
+
+    print(f"Parameter search: {', '.join(args.params)} | rungs of {sizes} questions, "
+          f"{bracket_size} configurations per bracket | budget {args.budget} question evaluations")
+    if trials:
+        print(f"Resuming: {len(trials)} trials, {history['spent']} question evaluations spent")
+
+    from transformers import set_seed
+
+    runner = importlib.import_module(RUNNERS[args.runner])
+    state = {"session": None}
+    start = time.time()
+
+    def trial_argv(trial):
+        argv = []
+        for name, value in trial["params"].items():
+            argv.extend(["--" + name.replace("_", "-"), str(value)])
+        return argv
+
+    def score(trial, size):
+        return trial["evaluations"][str(size)][args.metric]
+
+    def propose(trial_id):
+        rng = random.Random(f"{args.seed}:{trial_id}")
+        if args.proposer == "tpe":
+            # Fit on the largest subset size with enough evaluations to separate good from bad
+            for size in reversed(sizes):
+                observations = [(t["params"], score(t, size)) for t in trials if str(size) in t["evaluations"]]
+                if len(observations) >= len(args.params) + 2:
+                    return propose_tpe(observations, args.params, rng)
+        return {name: from_unit(name, rng.random()) for name in args.params}
+
+    def evaluate(trial, rung):
+        """Evaluate a trial on rung ``rung``; False when the budget does not cover it."""
+        size = sizes[rung]
+        if str(size) in trial["evaluations"]:
+            return True
+        done = [int(s) for s in trial["evaluations"]]
+        cost = size - max(done, default=0)
+        if history["spent"] + cost > args.budget:
+            return False
+
+        subset_file = os.path.join(args.output_dir, f"questions_{size}.jsonl")
+        if not os.path.exists(subset_file):
+            with open(subset_file, "w") as f:
+                f.writelines(lines[:size])
+        answers_file = os.path.join(args.output_dir, f"trial{trial['id']:03d}.jsonl")
+        job_args = runner.parse_args(runner_args + trial_argv(trial) + [
+            "--question-file", subset_file, "--answers-file", answers_file,
+            "--seed", str(args.seed), "--resume",
+        ])
+        if state["session"] is None:
+            state["session"] = runner.load_model(job_args)
+        set_seed(job_args.seed)
+        runner.eval_model(job_args, state["session"])
+
+        metrics = subset_metrics(answers_file, ground_truth, question_ids[:size])
+        trial["evaluations"][str(size)] = metrics
+        history["spent"] += cost
+        write_status(history_path, history)
+        print(f"Trial {trial['id']} {' '.join(trial_argv(trial))} | {size} questions | "
+              f"{args.metric} {metrics[args.metric]:.4f} | spent {history['spent']}/{args.budget}")
+        return True
+
+    def run_bracket(bracket):
+        """Run (or continue) one bracket; False when the budget runs out."""
+        members = [t for t in trials if t["bracket"] == bracket]
+        while len(members) < bracket_size:
+            if history["spent"] + sizes[0] > args.budget:
+                return False
+            trial_id = len(trials)
+            trial = {"id": trial_id, "bracket": bracket, "params": propose(trial_id), "evaluations": {}}
+            trials.append(trial)
+            members.append(trial)
+            if not evaluate(trial, 0):
+                return False
+        for rung in range(len(sizes)):
+            if rung > 0:
+                previous = sizes[rung - 1]
+                members = sorted(members, key=lambda t: score(t, previous), reverse=True)
+                members = members[:max(1, len(members) // args.eta)]
+            for trial in members:
+                if not evaluate(trial, rung):
+                    return False
+        return True
+
+    for bracket in itertools.count():
+        if not run_bracket(bracket):
+            break
+
+    if state["session"] is not None:
+        release(state["session"])
+
+    evaluated = [t for t in trials if t["evaluations"]]
+    if not evaluated:
+        print("\n✗ The budget does not cover a single evaluation")
+        return
+    # Best trial on the largest subset it was evaluated on
+    top_size = max(max(int(s) for s in t["evaluations"]) for t in evaluated)
+    best = max((t for t in evaluated if str(top_size) in t["evaluations"]), key=lambda t: score(t, top_size))
+    history["best"] = {"trial": best["id"], "params": best["params"], "questions": top_size,
+                       "metrics": best["evaluations"][str(top_size)]}
+    write_status(history_path, history)
+
+    grid_cost = GRID_POINTS * len(lines)
+    print(f"\n{'=' * 60}")
+    print(f"Best trial {best['id']}: {' '.join(trial_argv(best))}")
+    print(f"{args.metric} on {top_size} questions: {score(best, top_size):.4f}")
+    print(f"Spent {history['spent']} question evaluations "
+          f"({history['spent'] / grid_cost:.1%} of the {GRID_POINTS}-point grid) in {time.time() - start:.0f}s")
+    print(f"History saved to {history_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Accuracy of the Cached Language Prior versus Per-Image VCD Noise
+
+Runs the POPE questions through a runner with one model load, once with the
+per-image noisy VCD branch and once per cached prior mode (--vcd-prior text /
+noise), and scores every run with eval_pope. Each prior run is compared to
+the per-image run by an exact McNemar test of per-question correctness, and
+its prior cache hit rate is reported next to the wall time.
+
+Usage:
+    python run_prior_comparison.py --runner llava --question-file pope_coco_val.jsonl \\
+        --output-dir output/prior -- \\
+        --model-path /path/to/llava --image-folder /path/to/coco --use-vcd --use-agla
+"""
+
+import argparse
+import importlib
+import json
+import os
+import time
+
+from eval_pope import evaluate_pope, load_ground_truth
+from run_matrix import RUNNERS, release
+from run_sequential_sweep import compare, load_correct, mcnemar_pvalue
+from utils.prior_cache import PRIOR_MODES
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="POPE accuracy of the cached language prior versus the per-image noisy VCD branch",
+        epilog="Arguments after '--' are passed to the runner for every run.",
+    )
+    parser.add_argument("--runner", type=str, default="llava", choices=sorted(RUNNERS), help="Model runner")
+    parser.add_argument("--question-file", type=str, required=True, help="Validation questions (with labels)")
+    parser.add_argument("--output-dir", type=str, required=True, help="Answers per run and comparison summary")
+    parser.add_argument("--modes", type=str, nargs="+", default=list(PRIOR_MODES), choices=PRIOR_MODES,
+                        help="Prior modes compared to per-image noise")
+    parser.add_argument("--resume", action='store_true', help="Keep the answers of an interrupted comparison")
+    parser.add_argument("--seed", type=int, default=55, help="Random seed (decoding, noise)")
+    args, runner_args = parser.parse_known_args()
+    if runner_args and runner_args[0] == "--":
+        runner_args = runner_args[1:]
+    for option in ["--question-file", "--answers-file", "--seed", "--resume", "--vcd-prior"]:
+        if option in runner_args:
+            parser.error(f"{option} is set by the comparison")
+    if "--use-vcd" not in runner_args:
+        parser.error("the runner arguments need --use-vcd")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    ground_truth = load_ground_truth(args.question_file)
+
+    from transformers import set_seed
+
+    runner = importlib.import_module(RUNNERS[args.runner])
+    session = None
+    runs = {}
+    for name in ["image"] + args.modes:
+        answers_file = os.path.join(args.output_dir, f"{name}.jsonl")
+        mode_args = [] if name == "image" else ["--vcd-prior", name]
+        job_args = runner.parse_args(runner_args + mode_args + [
+            "--question-file", args.question_file, "--answers-file", answers_file, "--seed", str(args.seed),
+        ] + (["--resume"] if args.resume else []))
+        if session is None:
+            session = runner.load_model(job_args)
+
+        print(f"\n{'=' * 60}\nVCD branch: {'per-image noise' if name == 'image' else f'cached {name} prior'}")
+        # Hit and miss counters of this run only (the cache is kept across the runs of the session)
+        before = session["prior_cache"].stats() if "prior_cache" in session else {"hits": 0, "misses": 0}
+        set_seed(job_args.seed)
+        start = time.time()
+        runner.eval_model(job_args, session)
+        run = {
+            "vcd_prior": None if name == "image" else name,
+            "seconds": time.time() - start,
+            "metrics": evaluate_pope(args.question_file, answers_file, verbose=False),
+            "correct": load_correct(answers_file, ground_truth),
+        }
+        if name != "image":
+            after = session["prior_cache"].stats()
+            hits, misses = after["hits"] - before["hits"], after["misses"] - before["misses"]
+            run["prior_cache"] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "entries": after["entries"],
+                "bytes": after["bytes"],
+            }
+        runs[name] = run
+
+    release(session)
+
+    baseline = runs["image"]
+    question_ids = list(baseline["correct"])
+    for name, run in runs.items():
+        if name == "image":
+            continue
+        b, c = compare(baseline["correct"], run["correct"], question_ids)
+        run["mcnemar"] = {"b": b, "c": c, "p": mcnemar_pvalue(b, c)}
+
+    summary = {
+        "runner": args.runner,
+        "runs": {name: {k: v for k, v in run.items() if k != "correct"} for name, run in runs.items()},
+    }
+    summary_path = os.path.join(args.output_dir, "prior_comparison.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"\n{'=' * 60}")
+    print(f"{'VCD':<8} {'Acc':>8} {'F1':>8} {'Yes':>8} {'McNemar p':>10} {'hit rate':>9} {'time (s)':>9}")
+    for name, run in runs.items():
+        m = run["metrics"]
+        p = f"{run['mcnemar']['p']:10.4f}" if "mcnemar" in run else f"{'-':>10}"
+        hit_rate = f"{run['prior_cache']['hit_rate']:9.1%}" if "prior_cache" in run else f"{'-':>9}"
+        print(f"{name:<8} {m['accuracy']:8.4f} {m['f1']:8.4f} {m['yes_proportion']:8.4f} "
+              f"{p} {hit_rate} {run['seconds']:9.1f}")
+    print(f"Summary saved to {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
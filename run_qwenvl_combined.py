@@ -29,24 +29,45 @@ sys.path.insert(0, '/root/autodl-tmp/COMBINED')
 from Qwen_VL.modeling_qwen import QWenLMHeadModel
 
 # Import VCD+AGLA sampling
-from sample_vcd_agla import evolve_vcd_agla_sampling_qwenvl
+from sample_vcd_agla import (
+    BranchSkipPolicy, evolve_vcd_agla_sampling_qwenvl,
+    first_token_branch_logits, get_yes_no_token_ids, language_prior_logits, score_branch_logits,
+)
 
 # Import utilities
 from utils.vcd_add_noise import add_diffusion_noise
+from utils.prefix_cache import PrefixKVCache, hash_image_file
+from utils.agla_cache import AGLAMaskCache, AGLAMaskProvider
+from utils.logit_store import LogitStoreWriter
+from utils.prefetch import AGLAMaskPrefetcher, ImagePrefetcher
+from utils.batching import bucket_by_length
+from utils.seeding import question_generator, sampling_generators
+from utils.resume import remaining_questions
+from utils.prior_cache import PRIOR_MODES, PriorLogitsCache, prior_noise_image
+from utils.static_kv_cache import AUX_BRANCHES, BRANCHES, QuantizedKVCache, make_static_kv_caches
 
 # Try to import AGLA components
 try:
-    from lavis.models import load_model_and_preprocess
-    from torchvision import transforms
     from utils.augmentation import augmentation
     AGLA_AVAILABLE = True
 except Exception as e:
     print(f"Warning: AGLA not available: {e}")
     AGLA_AVAILABLE = False
 
+# Decode budget per answer (also the reserve of the static KV caches)
+MAX_NEW_TOKENS = 20
+# Image path of the prior's stand-in image in the prompt (the tensor is passed, the path never read)
+PRIOR_IMAGE_NAME = "prior"
 
-def eval_model(args):
-    """Main evaluation function"""
+
+def load_model(args, agla_providers=None):
+    """
+    Load the Qwen-VL model of ``args`` into a session for eval_model.
+
+    A session can be passed to several eval_model calls (see run_matrix.py);
+    its AGLA providers and prefix / static KV caches are reused by all of them.
+    ``agla_providers`` lets sessions share the AGLA providers of the same BLIP variant.
+    """
     # Evolve sampling to VCD+AGLA for Qwen-VL
     evolve_vcd_agla_sampling_qwenvl()
     print("✓ Evolved Qwen-VL sampling function to VCD+AGLA three-way contrastive decoding")
@@ -65,108 +86,368 @@ def eval_model(args):
         device_map="cuda",
         trust_remote_code=True
     ).eval()
+    return {
+        "model_name": model_name,
+        "tokenizer": tokenizer,
+        "model": model,
+        "agla_providers": agla_providers if agla_providers is not None else {},
+    }
+
+
+def eval_model(args, session=None):
+    """Main evaluation function (``session`` from load_model reuses a loaded model)"""
+    if session is None:
+        session = load_model(args)
+    model_name, tokenizer, model = session["model_name"], session["tokenizer"], session["model"]
     
-    # Load BLIP-ITM if AGLA is enabled
-    model_itm = None
-    vis_processors = None
-    text_processors = None
-    loader = None
+    # AGLA masks: disk cache first, BLIP-ITM (base, fp16) is loaded on the first miss
+    agla_mask_cache = None
+    agla_provider = None
     
     if args.use_agla:
-        if not AGLA_AVAILABLE:
-            print("ERROR: AGLA requested but not available. Please install LAVIS:")
-            print("  pip install salesforce-lavis")
-            sys.exit(1)
-        
-        print("Loading BLIP-ITM model for AGLA...")
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        model_itm, vis_processors, text_processors = load_model_and_preprocess(
-            "blip_image_text_matching", "base", device=device, is_eval=True
+        provider_key = ("base-fp16", args.agla_mask_cache, args.agla_device_mask)
+        if provider_key not in session["agla_providers"]:
+            agla_mask_cache = AGLAMaskCache(args.agla_mask_cache) if args.agla_mask_cache else None
+            if not AGLA_AVAILABLE:
+                if agla_mask_cache is None:
+                    print("ERROR: AGLA requested but not available. Please install LAVIS:")
+                    print("  pip install salesforce-lavis")
+                    sys.exit(1)
+                print("Warning: LAVIS not available, only cached AGLA masks can be used")
+            session["agla_providers"][provider_key] = AGLAMaskProvider(
+                agla_mask_cache, blip_variant="base", half=True, device_masks=args.agla_device_mask
+            )
+        agla_provider = session["agla_providers"][provider_key]
+        agla_mask_cache = agla_provider.cache
+    
+    # Early exit of the VCD/AGLA branches after their first K decoder layers
+    branch_exit_layers = {
+        name: layer for name, layer in (("vcd", args.vcd_exit_layer), ("agla", args.agla_exit_layer))
+        if layer is not None
+    }
+    
+    # Entropy / margin gate for the VCD and AGLA branches
+    branch_skip_policy = None
+    if args.skip_entropy_threshold is not None or args.skip_margin_threshold is not None:
+        branch_skip_policy = BranchSkipPolicy(
+            entropy_threshold=args.skip_entropy_threshold,
+            margin_threshold=args.skip_margin_threshold,
+            mode=args.skip_mode,
+        )
+    
+    # Image-prefix KV cache shared across questions on the same image
+    prefix_cache = None
+    if args.prefix_cache:
+        if "prefix_cache" not in session:
+            session["prefix_cache"] = PrefixKVCache(max_bytes=int(args.prefix_cache_gb * 1024 ** 3))
+        prefix_cache = session["prefix_cache"]
+    
+    # Language prior in place of the noisy-image VCD branch, cached per prompt across questions
+    prior_cache = prior_cache_key = None
+    if args.vcd_prior is not None:
+        if "prior_cache" not in session:
+            session["prior_cache"] = PriorLogitsCache(max_bytes=int(args.prior_cache_gb * 1024 ** 3))
+        prior_cache = session["prior_cache"]
+        prior_cache_key = PriorLogitsCache.make_key(
+            model_name, args.vcd_prior, noise_seed=args.seed if args.vcd_prior == "noise" else None
         )
-        model_itm = model_itm.half()
-        model_itm.eval()
-        loader = transforms.Compose([transforms.ToTensor()])
-        print("✓ BLIP-ITM loaded in fp16 mode")
+    # Per-question noisy images only without the prior
+    noise_vcd = args.use_vcd and prior_cache is None
+    
+    # Preallocated per-branch KV caches shared across questions (and jobs of the session),
+    # int8 for the VCD/AGLA branches with --aux-kv-int8
+    static_kv_caches = None
+    if args.static_kv_cache or args.aux_kv_int8:
+        cache_key = (args.static_kv_cache, args.aux_kv_int8)
+        if session.get("static_kv_caches_key") != cache_key:
+            # A job with other cache flags replaces the session's caches (freeing their buffers)
+            session["static_kv_caches_key"] = cache_key
+            session["static_kv_caches"] = make_static_kv_caches(
+                model, MAX_NEW_TOKENS,
+                branches=BRANCHES if args.static_kv_cache else AUX_BRANCHES,
+                int8_branches=AUX_BRANCHES if args.aux_kv_int8 else (),
+            )
+        static_kv_caches = session["static_kv_caches"]
+    
+    # Yes/No answer tokens for single-forward scoring
+    score_mode = args.score_yes_no or args.record_logits is not None
+    yes_token_ids, no_token_ids = get_yes_no_token_ids(tokenizer) if score_mode else ([], [])
     
     # Load questions
     questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
+    if args.batch_size > 1:
+        # The prompt template is shared, so the question length orders the prompts
+        questions = bucket_by_length(
+            questions, [len(tokenizer(line["text"]).input_ids) for line in questions], args.batch_size
+        )
     
     # Prepare output file
     answers_file = os.path.expanduser(args.answers_file)
     os.makedirs(os.path.dirname(answers_file) if os.path.dirname(answers_file) else '.', exist_ok=True)
-    ans_file = open(answers_file, "w")
+    # --resume keeps the answers of an interrupted run and only runs the missing questions
+    num_questions = len(questions)
+    questions, answers_mode = remaining_questions(questions, answers_file, args.resume)
+    ans_file = open(answers_file, answers_mode)
+    
+    # Branch logit recording for offline parameter sweeps
+    logit_writer = None
+    if args.record_logits is not None:
+        logit_writer = LogitStoreWriter(
+            args.record_logits, len(questions), yes_token_ids, no_token_ids, topk=args.record_topk,
+            metadata={
+                "model_id": model_name,
+                "question_file": args.question_file,
+                "noise_step": args.noise_step if noise_vcd else None,
+                "vcd_prior": args.vcd_prior,
+                "seed": args.seed,
+            },
+        )
     
     print(f"\nStarting evaluation:")
     print(f"  Questions: {len(questions)}")
+    if args.resume:
+        print(f"  Resumed: {num_questions - len(questions)} questions already answered")
     print(f"  VCD: {args.use_vcd}")
     print(f"  AGLA: {args.use_agla}")
-    if args.use_vcd:
+    if noise_vcd:
         print(f"  VCD params: alpha={args.cd_alpha}, beta={args.cd_beta}, noise_step={args.noise_step}")
+    elif args.use_vcd:
+        print(f"  VCD params: alpha={args.cd_alpha}, beta={args.cd_beta}, cached {args.vcd_prior} prior")
     if args.use_agla:
         print(f"  AGLA params: alpha={args.agla_alpha}, beta={args.agla_beta}")
+    print(f"  Batch size: {args.batch_size}")
+    print(f"  Batched branches: {args.batch_branches}")
+    if args.sparse_candidates:
+        print(f"  Sparse candidates: {args.sparse_candidates}")
+    print(f"  Yes/No scoring: {score_mode}")
+    if logit_writer is not None:
+        print(f"  Recording branch logits to: {args.record_logits} (top-k={args.record_topk})")
+    if prefix_cache is not None:
+        print(f"  Prefix KV cache: {args.prefix_cache_gb} GB")
+    if branch_skip_policy is not None:
+        print(f"  Branch skipping: entropy<={args.skip_entropy_threshold}, "
+              f"margin>={args.skip_margin_threshold}, mode={args.skip_mode}")
     print()
     
-    # Process each question
-    for line in tqdm(questions, desc="Evaluating"):
+    # AGLA masks computed ahead of the LVLM in worker processes
+    agla_prefetcher = None
+    agla_masks = None
+    if agla_provider is not None and args.agla_workers > 0:
+        agla_prefetcher = AGLAMaskPrefetcher(agla_provider, num_workers=args.agla_workers, depth=args.agla_prefetch)
+        agla_masks = agla_prefetcher.iter_masks(
+            [(os.path.join(args.image_folder, line["image"]), line["text"]) for line in questions]
+        )
+    
+    # VCD noise per question, or per image when the prefix cache shares it across questions
+    def noise_key(line):
+        return line["image"] if prefix_cache is not None else line["question_id"]
+    
+    # Images decoded, preprocessed and noised ahead of the LVLM in loader threads
+    image_loader = None
+    loaded_images = None
+    if args.loader_workers > 0:
+        image_loader = ImagePrefetcher(
+            model.transformer.visual.image_transform,
+            num_workers=args.loader_workers, depth=args.loader_prefetch,
+            noise_step=args.noise_step if noise_vcd else None, seed=args.seed,
+            hash_images=prefix_cache is not None or agla_provider is not None,
+        )
+        loaded_images = image_loader.iter_images(
+            [os.path.join(args.image_folder, line["image"]) for line in questions],
+            noise_keys=[noise_key(line) for line in questions],
+        )
+    
+    def prepare_question(line):
+        """Prompt and branch images of one question (None when it is skipped)."""
         idx = line["question_id"]
         image_file = line["image"]
         question = line["text"]
         
-        image_path = os.path.join(args.image_folder, image_file)
-        
-        # Load image
-        try:
-            raw_image = Image.open(image_path).convert('RGB')
-        except Exception as e:
-            print(f"Error loading image {image_file}: {e}")
-            continue
+        # Consume the prefetched mask first so skipped questions stay aligned
+        agla_mask = agla_error = None
+        if agla_masks is not None:
+            agla_mask, _, agla_error = next(agla_masks)
         
-        # Prepare original image tensor for Qwen-VL
-        image_tensor = model.transformer.visual.image_transform(raw_image).unsqueeze(0).to(model.device)
+        image_path = os.path.join(args.image_folder, image_file)
         
-        # Prepare VCD noisy image
-        image_tensor_vcd = None
-        if args.use_vcd:
-            image_tensor_vcd = add_diffusion_noise(image_tensor, args.noise_step)
+        if loaded_images is not None:
+            # Prefetched image, original tensor and VCD noisy image (pinned, copied asynchronously)
+            loaded = next(loaded_images)
+            if loaded["error"] is not None:
+                print(loaded["error"])
+                return None
+            raw_image, image_hash = loaded["raw_image"], loaded["image_hash"]
+            image_tensor = loaded["pixel_values"].unsqueeze(0).to(model.device, non_blocking=True)
+            image_tensor_vcd = None
+            if loaded["pixel_values_cd"] is not None:
+                image_tensor_vcd = loaded["pixel_values_cd"].unsqueeze(0).to(model.device, non_blocking=True)
+        else:
+            # Load image
+            try:
+                raw_image = Image.open(image_path).convert('RGB')
+            except Exception as e:
+                print(f"Error loading image {image_file}: {e}")
+                return None
+            
+            image_hash = None
+            if prefix_cache is not None or agla_provider is not None:
+                image_hash = hash_image_file(image_path)
+            
+            # Prepare original image tensor for Qwen-VL
+            image_tensor = model.transformer.visual.image_transform(raw_image).unsqueeze(0)
+            
+            # Prepare VCD noisy image (drawn on the CPU, like the loader's)
+            image_tensor_vcd = None
+            if noise_vcd:
+                image_tensor_vcd = add_diffusion_noise(
+                    image_tensor, args.noise_step, generator=question_generator(args.seed, noise_key(line), "vcd")
+                ).to(model.device)
+            image_tensor = image_tensor.to(model.device)
         
         # Prepare AGLA augmented image
         image_tensor_agla = None
-        if args.use_agla and model_itm is not None:
+        if agla_provider is not None:
             try:
-                tensor_image = loader(raw_image.resize((384, 384)))
-                image_blip = vis_processors["eval"](raw_image).unsqueeze(0).to('cuda').half()
-                question_blip = text_processors["eval"](question)
-                tokenized_text = model_itm.tokenizer(
-                    question_blip, padding='longest', truncation=True, return_tensors="pt"
-                ).to('cuda')
-                
-                with torch.no_grad():
-                    augmented_image = augmentation(
-                        image_blip, question_blip, tensor_image,
-                        model_itm, tokenized_text, raw_image
-                    )
-                
-                # Clean up intermediate tensors
-                del image_blip, tensor_image, tokenized_text
-                torch.cuda.empty_cache()
-                
-                # Process augmented image for Qwen-VL
-                image_tensor_agla = model.transformer.visual.image_transform(augmented_image).unsqueeze(0).to(model.device)
+                if agla_error is not None:
+                    raise RuntimeError(agla_error)
+                visual = model.transformer.visual
+                if args.agla_device_mask:
+                    # Qwen-VL resizes the whole image, so the mask maps onto it without a crop
+                    with torch.no_grad():
+                        image_tensor_agla = agla_provider.augment_pixel_values(
+                            image_tensor, raw_image, question, visual.image_mean, visual.image_std, image_hash,
+                            mask=agla_mask,
+                        )
+                    torch.cuda.empty_cache()
+                else:
+                    with torch.no_grad():
+                        augmented_image = agla_provider.augment(raw_image, question, image_hash, mask=agla_mask)
+                    
+                    # Release BLIP intermediates
+                    torch.cuda.empty_cache()
+                    
+                    # Process augmented image for Qwen-VL
+                    image_tensor_agla = visual.image_transform(augmented_image).unsqueeze(0).to(model.device)
             except Exception as e:
                 print(f"Warning: Failed to generate AGLA image for question {idx}: {e}")
                 image_tensor_agla = None
         
-        # Prepare question for Qwen-VL
-        question_prompt = '<img>{}</img>{} Answer:'.format(image_path, question)
-        input_ids = tokenizer([question_prompt], return_tensors='pt', padding='longest')
+        return {
+            "idx": idx,
+            "image_file": image_file,
+            "image_hash": image_hash,
+            "question": question,
+            # Prepare question for Qwen-VL
+            "question_prompt": '<img>{}</img>{} Answer:'.format(image_path, question),
+            "image": image_tensor,
+            "image_cd": image_tensor_vcd,
+            "image_agla": image_tensor_agla,
+            # Prior prompt: no image ("text"), or a placeholder path for the stand-in image ("noise")
+            "prior_input_ids": None if args.vcd_prior is None else tokenizer(
+                '{} Answer:'.format(question) if args.vcd_prior == "text"
+                else '<img>{}</img>{} Answer:'.format(PRIOR_IMAGE_NAME, question),
+                return_tensors='pt',
+            ).input_ids[0],
+        }
+    
+    prior_image = None
+    
+    # Process the questions in batches of --batch-size
+    for start in tqdm(range(0, len(questions), args.batch_size), desc="Evaluating"):
+        batch = [prepared for prepared in map(prepare_question, questions[start:start + args.batch_size])
+                 if prepared is not None]
+        if not batch:
+            continue
+        
+        # The tokenizer pads on the left, so generated tokens stay aligned on the right
+        input_ids = tokenizer([p["question_prompt"] for p in batch], return_tensors='pt', padding='longest')
         
-        # Generate
+        image_tensor = torch.cat([p["image"] for p in batch])
+        image_tensor_vcd = torch.cat([p["image_cd"] for p in batch]) if noise_vcd else None
+        # Rows whose AGLA image failed use the original image in the AGLA branch
+        image_tensor_agla = None
+        if any(p["image_agla"] is not None for p in batch):
+            image_tensor_agla = torch.cat(
+                [p["image_agla"] if p["image_agla"] is not None else p["image"] for p in batch]
+            )
+        
+        # Cached language prior; its stand-in image ("noise" mode) is the same for every question
+        prior_kwargs = {}
+        if prior_cache is not None:
+            prior_kwargs = {
+                "prior_cache": prior_cache,
+                "prior_cache_key": prior_cache_key,
+                "prior_input_ids": [p["prior_input_ids"] for p in batch],
+                "prior_images": None,
+            }
+            if args.vcd_prior == "noise":
+                if prior_image is None:
+                    # Drawn on the CPU, like the per-question noise
+                    prior_image = prior_noise_image(batch[0]["image"].cpu(), args.seed).to(model.device)
+                prior_kwargs["prior_images"] = prior_image.expand(len(batch), *prior_image.shape[1:])
+        
+        # Prefix (<img>...</img>) cache keys; the question suffix is always prefilled
+        prefix_kwargs = {}
+        if prefix_cache is not None:
+            image_hash, question = batch[0]["image_hash"], batch[0]["question"]
+            prefix_kwargs = {
+                "prefix_cache": prefix_cache,
+                "prefix_cache_keys": {
+                    "original": PrefixKVCache.make_key(model_name, "original", image_hash),
+                    "vcd": PrefixKVCache.make_key(
+                        model_name, "vcd", image_hash, noise_seed=args.seed, noise_step=args.noise_step
+                    ),
+                    "agla": PrefixKVCache.make_key(
+                        model_name, "agla", image_hash,
+                        agla_mask_id=agla_provider.mask_id(image_hash, question) if agla_provider else None,
+                    ),
+                },
+                "prefix_length": (input_ids.input_ids[0] == model.config.visual['image_start_id'] + 1).nonzero()[0].item() + 1,
+            }
+        
+        # Score yes/no from the first-token distribution (no decoding loop)
+        if score_mode:
+            with torch.inference_mode():
+                branch_logits = first_token_branch_logits(
+                    model, input_ids.input_ids.cuda(),
+                    images=image_tensor, images_cd=image_tensor_vcd, images_agla=image_tensor_agla,
+                    attention_mask=input_ids.attention_mask.cuda(),
+                    batch_branches=args.batch_branches,
+                    branch_exit_layers=branch_exit_layers,
+                    **prefix_kwargs,
+                )
+                if prior_kwargs:
+                    logits_vcd = language_prior_logits(model, **prior_kwargs, pad_token_id=tokenizer.eod_id)
+                    branch_logits = (branch_logits[0], logits_vcd, branch_logits[2])
+                if logit_writer is not None:
+                    for i, p in enumerate(batch):
+                        logit_writer.add(p["idx"], *[l[i:i + 1] if l is not None else None for l in branch_logits])
+                scored = score_branch_logits(
+                    *branch_logits, yes_token_ids, no_token_ids,
+                    cd_alpha=args.cd_alpha, cd_beta=args.cd_beta,
+                    agla_alpha=args.agla_alpha, agla_beta=args.agla_beta,
+                )
+            for i, p in enumerate(batch):
+                ans_file.write(json.dumps({
+                    "question_id": p["idx"],
+                    "prompt": p["question_prompt"],
+                    "text": scored["labels"][i],
+                    "p_yes": scored["p_yes"][i].item(),
+                    "p_no": scored["p_no"][i].item(),
+                    "model_id": model_name,
+                    "image": p["image_file"],
+                    "metadata": {}
+                }) + "\n")
+            ans_file.flush()
+            continue
+        
+        # Generate; rows that emit <|endoftext|> are padded until the whole batch is done
         with torch.inference_mode():
             pred = model.generate(
                 input_ids=input_ids.input_ids.cuda(),
                 attention_mask=input_ids.attention_mask.cuda(),
                 do_sample=True,
-                max_new_tokens=20,
+                max_new_tokens=MAX_NEW_TOKENS,
                 min_new_tokens=1,
                 length_penalty=1,
                 num_return_sequences=1,
@@ -184,28 +465,38 @@ def eval_model(args):
                 cd_beta=args.cd_beta,
                 agla_alpha=args.agla_alpha,
                 agla_beta=args.agla_beta,
+                batch_branches=args.batch_branches,
+                branch_skip_policy=branch_skip_policy,
+                last_logits_only=True,
+                sparse_candidates=args.sparse_candidates,
+                static_kv_caches=static_kv_caches,
+                branch_exit_layers=branch_exit_layers,
+                sampling_generator=sampling_generators(args.seed, [p["idx"] for p in batch], model.device),
+                **prefix_kwargs,
+                **prior_kwargs,
             )
         
         # Decode output
-        outputs = [
+        batch_outputs = [
             tokenizer.decode(_[input_ids.input_ids.size(1):].cpu(),
                            skip_special_tokens=True).strip() for _ in pred
-        ][0]
-        outputs = outputs.strip()
-        
-        # Save answer
-        ans_file.write(json.dumps({
-            "question_id": idx,
-            "prompt": question_prompt,
-            "text": outputs,
-            "model_id": model_name,
-            "image": image_file,
-            "metadata": {}
-        }) + "\n")
+        ]
+        for p, outputs in zip(batch, batch_outputs):
+            outputs = outputs.strip()
+            
+            # Save answer
+            ans_file.write(json.dumps({
+                "question_id": p["idx"],
+                "prompt": p["question_prompt"],
+                "text": outputs,
+                "model_id": model_name,
+                "image": p["image_file"],
+                "metadata": {}
+            }) + "\n")
         ans_file.flush()
         
         # Clean up tensors to free memory
-        del image_tensor, pred
+        del image_tensor, pred, batch
         if image_tensor_vcd is not None:
             del image_tensor_vcd
         if image_tensor_agla is not None:
@@ -213,10 +504,48 @@ def eval_model(args):
         torch.cuda.empty_cache()
     
     ans_file.close()
+    if agla_prefetcher is not None:
+        agla_prefetcher.close()
+    if image_loader is not None:
+        image_loader.close()
+    if logit_writer is not None:
+        logit_writer.close()
+    if branch_skip_policy is not None and hasattr(model, "vcd_agla_stats"):
+        stats = model.vcd_agla_stats
+        total = stats["branch_forwards"] + stats["skipped_branch_forwards"]
+        print(f"\nBranch forwards: {stats['branch_forwards']} run, "
+              f"{stats['skipped_branch_forwards']} skipped ({stats['skipped_branch_forwards'] / max(total, 1):.1%}), "
+              f"{stats['catch_up_tokens']} catch-up tokens")
+    if args.sparse_candidates and hasattr(model, "vcd_agla_stats"):
+        print(f"Sparse candidate steps: {model.vcd_agla_stats['sparse_steps']}")
+    if static_kv_caches is not None:
+        cache_bytes = sum(cache.nbytes() for cache in static_kv_caches.values())
+        allocations = sum(cache.allocations for cache in static_kv_caches.values())
+        int8_bytes = sum(cache.nbytes() for cache in static_kv_caches.values() if isinstance(cache, QuantizedKVCache))
+        print(f"Static KV caches: {cache_bytes / 1024 ** 3:.2f} GB ({int8_bytes / 1024 ** 3:.2f} GB int8), "
+              f"{allocations} layer allocations")
+    if agla_mask_cache is not None:
+        mask_stats = agla_mask_cache.stats()
+        print(f"\nAGLA mask cache: {mask_stats['hits']} hits, {mask_stats['misses']} misses "
+              f"({mask_stats['hit_rate']:.1%})")
+    if agla_provider is not None and agla_provider.saliency is not None:
+        encode_stats = agla_provider.saliency.stats()
+        print(f"\nBLIP image encodings: {encode_stats['misses']} computed, {encode_stats['hits']} reused")
+    if prior_cache is not None:
+        prior_stats = prior_cache.stats()
+        print(f"\nLanguage prior cache: {prior_stats['hits']} hits, {prior_stats['misses']} misses "
+              f"({prior_stats['hit_rate']:.1%}), {prior_stats['bytes'] / 1024 ** 2:.1f} MB "
+              f"in {prior_stats['entries']} entries")
+    if prefix_cache is not None:
+        cache_stats = prefix_cache.stats()
+        print(f"\nPrefix KV cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+              f"({cache_stats['hit_rate']:.1%}), {cache_stats['evictions']} evictions, "
+              f"{cache_stats['bytes'] / 1024 ** 3:.2f} GB in {cache_stats['entries']} entries")
     print(f"\n✓ Evaluation complete. Results saved to {answers_file}")
 
 
-if __name__ == "__main__":
+def build_parser():
+    """Command-line arguments of the Qwen-VL runner."""
     parser = argparse.ArgumentParser(description="VCD+AGLA Combined Qwen-VL Evaluation")
     
     # Model arguments
@@ -225,6 +554,8 @@ if __name__ == "__main__":
     parser.add_argument("--image-folder", type=str, required=True, help="Path to image folder")
     parser.add_argument("--question-file", type=str, required=True, help="Path to question file")
     parser.add_argument("--answers-file", type=str, required=True, help="Path to save answers")
+    parser.add_argument("--resume", action='store_true',
+                        help="Keep the answers already in --answers-file and only run the missing questions")
     
     # Generation arguments
     parser.add_argument("--temperature", type=float, default=1.0, help="Temperature for sampling")
@@ -241,11 +572,91 @@ if __name__ == "__main__":
     parser.add_argument("--use-agla", action='store_true', help="Enable AGLA")
     parser.add_argument("--agla-alpha", type=float, default=1.0, help="AGLA enhancement strength")
     parser.add_argument("--agla-beta", type=float, default=0.5, help="AGLA plausibility threshold")
+    parser.add_argument("--agla-mask-cache", type=str, default=None,
+                        help="Directory of the AGLA mask cache shared across Qwen-VL runs "
+                             "(LLaVA masks use another BLIP variant and are kept apart)")
+    parser.add_argument("--agla-device-mask", action='store_true',
+                        help="Compute AGLA masks on the GPU and apply them to the preprocessed image tensor")
+    parser.add_argument("--agla-workers", type=int, default=0,
+                        help="Worker processes computing AGLA masks ahead of the LVLM (0 = inline)")
+    parser.add_argument("--agla-prefetch", type=int, default=None,
+                        help="Same-image question groups prefetched ahead (default: 2 x workers)")
+
+    # Input pipeline arguments
+    parser.add_argument("--loader-workers", type=int, default=0,
+                        help="Threads decoding and preprocessing images ahead of the LVLM (0 = inline)")
+    parser.add_argument("--loader-prefetch", type=int, default=None,
+                        help="Same-image question groups loaded ahead (default: 2 x loader workers)")
+
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Questions decoded together (left-padded, bucketed by prompt length)")
+
+    # Decoding arguments
+    parser.add_argument("--batch-branches", action='store_true',
+                        help="Run original/VCD/AGLA branches as one stacked batch per decode step")
+    parser.add_argument("--sparse-candidates", type=int, default=None,
+                        help="Combine and sample within the K tokens passing the plausibility cutoff "
+                             "(falls back to the full vocabulary when more survive)")
+    parser.add_argument("--static-kv-cache", action='store_true',
+                        help="Preallocate one KV cache per branch, written in place and reused across questions")
+    parser.add_argument("--aux-kv-int8", action='store_true',
+                        help="Keep the VCD/AGLA branch KV caches in int8 with a per-head, per-position scale "
+                             "(about half the memory)")
+    parser.add_argument("--vcd-exit-layer", type=int, default=None,
+                        help="Run the VCD branch through its first K decoder layers only (default: all layers)")
+    parser.add_argument("--agla-exit-layer", type=int, default=None,
+                        help="Run the AGLA branch through its first K decoder layers only (default: all layers)")
+    parser.add_argument("--score-yes-no", action='store_true',
+                        help="Score P(yes)/P(no) from the first-token logits instead of sampling")
+    parser.add_argument("--skip-entropy-threshold", type=float, default=None,
+                        help="Skip VCD/AGLA branches for a step when original-branch entropy is below this")
+    parser.add_argument("--skip-margin-threshold", type=float, default=None,
+                        help="Skip VCD/AGLA branches for a step when the top-1 probability margin is above this")
+    parser.add_argument("--skip-mode", type=str, default="lazy", choices=["lazy", "drop"],
+                        help="Catch skipped branches up lazily, or drop them for the rest of the sequence")
+    parser.add_argument("--record-logits", type=str, default=None,
+                        help="Record first-token branch logits to this directory (implies --score-yes-no)")
+    parser.add_argument("--record-topk", type=int, default=64,
+                        help="Original-branch top-k tokens to record (0 = full vocabulary)")
+    parser.add_argument("--vcd-prior", type=str, default=None, choices=PRIOR_MODES,
+                        help="Replace the noisy-image VCD branch by a language prior cached per prompt "
+                             "(text: no image, noise: a fully noised image shared by all questions)")
+    parser.add_argument("--prior-cache-gb", type=float, default=1.0,
+                        help="Memory budget of the language prior cache in GB (LRU eviction)")
+    parser.add_argument("--prefix-cache", action='store_true',
+                        help="Reuse the per-image prefix KV cache across questions (VCD noise is drawn once per image)")
+    parser.add_argument("--prefix-cache-gb", type=float, default=4.0,
+                        help="Memory budget of the prefix KV cache in GB (LRU eviction)")
     
     # Seed
     parser.add_argument("--seed", type=int, default=55, help="Random seed")
-    
-    args = parser.parse_args()
+    return parser
+
+
+def parse_args(argv=None):
+    """Parse and validate the command line (``argv`` defaults to sys.argv)."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.resume and args.record_logits is not None:
+        parser.error("--resume cannot be combined with --record-logits (the logit store is rewritten)")
+    if args.batch_size > 1 and args.prefix_cache:
+        parser.error("--prefix-cache requires --batch-size 1")
+    if args.static_kv_cache and args.prefix_cache:
+        parser.error("--static-kv-cache cannot be combined with --prefix-cache")
+    if args.aux_kv_int8 and (args.prefix_cache or args.batch_branches):
+        parser.error("--aux-kv-int8 cannot be combined with --prefix-cache or --batch-branches")
+    if args.vcd_prior is not None and not args.use_vcd:
+        parser.error("--vcd-prior requires --use-vcd")
+    for option in ("vcd_exit_layer", "agla_exit_layer"):
+        if getattr(args, option) is not None and getattr(args, option) < 1:
+            parser.error(f"--{option.replace('_', '-')} must be at least 1")
+    if (args.vcd_exit_layer is not None or args.agla_exit_layer is not None) and (args.prefix_cache or args.batch_branches):
+        parser.error("--vcd-exit-layer / --agla-exit-layer cannot be combined with --prefix-cache or --batch-branches")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
     set_seed(args.seed)
     
     eval_model(args)
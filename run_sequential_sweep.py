@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Sequential Parameter Sweep with Early Stopping
+
+scripts/parameter_search.sh runs every grid point over the whole validation
+set. Here the configurations are evaluated in rounds on growing, nested
+question subsets (e.g. 100, 200, 400, ... questions). After each round every
+configuration is compared with the incumbent (the most accurate one so far)
+by an exact McNemar test on the paired per-question correctness, and the
+configurations that are significantly worse are dropped. Only the survivors
+see the next, larger subset.
+
+The model is loaded once (see run_matrix.py) and each round runs with
+--resume, so a configuration only answers the questions added by the round;
+with per-question seeding (utils.seeding) the answers are the same as those
+of a full run. --alpha is split evenly over the rounds, so it bounds the
+chance that one given configuration, as good as the incumbent, is dropped in
+some round. It is not a family-wise level over the configurations: a round
+runs up to len(alive) - 1 tests against an incumbent picked on the same
+questions, so with many configurations some good ones can be dropped by
+chance.
+
+Usage:
+    python run_sequential_sweep.py --runner llava --question-file pope_coco_val.jsonl \\
+        --output-dir output/sequential_sweep \\
+        --cd-alphas 0.5 1.0 1.5 --cd-betas 0.05 0.1 0.2 --agla-alphas 0.5 1.0 1.5 --noise-steps 300 500 700 -- \\
+        --model-path /path/to/llava --image-folder /path/to/coco --use-vcd --use-agla
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+
+from eval_pope import correct_answers, load_ground_truth, load_predictions
+from run_matrix import RUNNERS, release
+
+# Grid options of the sweep and the runner option they set
+GRID_OPTIONS = {
+    "cd_alphas": "--cd-alpha",
+    "cd_betas": "--cd-beta",
+    "agla_alphas": "--agla-alpha",
+    "agla_betas": "--agla-beta",
+    "noise_steps": "--noise-step",
+}
+
+
+def mcnemar_pvalue(b, c):
+    """
+    Two-sided exact McNemar test.
+
+    Args:
+        b (int): Questions only the first configuration answers correctly
+        c (int): Questions only the second configuration answers correctly
+
+    Returns:
+        float: p-value of the hypothesis that both are equally accurate
+    """
+    n = b + c
+    if n == 0:
+        return 1.0
+    tail = sum(math.comb(n, k) for k in range(min(b, c) + 1)) / 2 ** n
+    return min(1.0, 2 * tail)
+
+
+def round_sizes(num_questions, first_round, growth):
+    """Nested subset sizes, growing geometrically up to all questions."""
+    sizes, size = [], first_round
+    while size < num_questions:
+        sizes.append(size)
+        size = int(math.ceil(size * growth))
+    return sizes + [num_questions]
+
+
+def load_correct(answers_file, ground_truth):
+    """
+    question_id -> whether the answer is correct (POPE rules of eval_pope).
+
+    ``ground_truth`` is the result of eval_pope.load_ground_truth. The first
+    answer of a question counts; questions without an answer or a yes/no
+    label are left out.
+    """
+    question_ids, index, labels = ground_truth
+    answered, has_yes, has_no = load_predictions(answers_file, index)
+    correct = correct_answers(labels, answered, has_yes, has_no)
+    return {question_ids[row]: bool(correct[row]) for row in (answered & (labels >= 0)).nonzero()[0]}
+
+
+def compare(incumbent, challenger, question_ids):
+    """Discordant counts (b, c) of two correctness dicts on ``question_ids``."""
+    b = sum(1 for q in question_ids if incumbent.get(q, False) and not challenger.get(q, False))
+    c = sum(1 for q in question_ids if challenger.get(q, False) and not incumbent.get(q, False))
+    return b, c
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Parameter sweep on growing question subsets, dropping configurations that are clearly worse",
+        epilog="Arguments after '--' are passed to the runner for every configuration.",
+    )
+    parser.add_argument("--runner", type=str, default="llava", choices=sorted(RUNNERS), help="Model runner")
+    parser.add_argument("--question-file", type=str, required=True, help="Validation questions (with labels)")
+    parser.add_argument("--output-dir", type=str, required=True, help="Answers, subsets and sweep summary")
+    for name, option in GRID_OPTIONS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=float, nargs="+", default=None,
+                            help=f"Values of {option} to sweep")
+    parser.add_argument("--first-round", type=int, default=100, help="Questions in the first round")
+    parser.add_argument("--growth", type=float, default=2.0, help="Subset growth factor per round")
+    parser.add_argument("--alpha", type=float, default=0.05,
+                        help="Per-configuration significance level over all rounds "
+                             "(split over the rounds; not corrected for the number of configurations)")
+    parser.add_argument("--seed", type=int, default=55, help="Random seed (question order and decoding)")
+    args, runner_args = parser.parse_known_args()
+    if runner_args and runner_args[0] == "--":
+        runner_args = runner_args[1:]
+    for option in ["--question-file", "--answers-file", "--seed", "--resume", *GRID_OPTIONS.values()]:
+        if option in runner_args:
+            parser.error(f"{option} is set by the sweep")
+
+    swept = {option: values for name, option in GRID_OPTIONS.items() if (values := getattr(args, name))}
+    configs = {}
+    for values in itertools.product(*swept.values()):
+        argv = []
+        for option, value in zip(swept, values):
+            argv.extend([option, str(int(value)) if option == "--noise-step" else str(value)])
+        name = "_".join(f"{option.lstrip('-').replace('-', '_')}{v}" for option, v in zip(swept, argv[1::2]))
+        configs[name or "default"] = argv
+
+    with open(os.path.expanduser(args.question_file), "r") as f:
+        lines = [line if line.endswith("\n") else line + "\n" for line in f if line.strip()]
+    if not lines:
+        parser.error("the question file is empty")
+    # Shuffle once so every subset is a random sample and each round extends the previous one
+    random.Random(args.seed).shuffle(lines)
+    ground_truth = load_ground_truth(args.question_file)
+    sizes = round_sizes(len(lines), args.first_round, args.growth)
+    # Bonferroni over the rounds of one configuration (not over the configurations of a round)
+    round_alpha = args.alpha / len(sizes)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    print(f"Sequential sweep: {len(configs)} configurations, rounds of {sizes} questions")
+
+    from transformers import set_seed
+
+    runner = importlib.import_module(RUNNERS[args.runner])
+    session = None
+    alive = list(configs)
+    history = []
+    questions_run = 0
+    start = time.time()
+    for k, size in enumerate(sizes):
+        subset_file = os.path.join(args.output_dir, f"questions_round{k}.jsonl")
+        with open(subset_file, "w") as f:
+            f.writelines(lines[:size])
+        subset_ids = [json.loads(line)["question_id"] for line in lines[:size]]
+
+        correct = {}
+        for name in alive:
+            answers_file = os.path.join(args.output_dir, f"{name}.jsonl")
+            job_args = runner.parse_args(runner_args + configs[name] + [
+                "--question-file", subset_file, "--answers-file", answers_file,
+                "--seed", str(args.seed), "--resume",
+            ])
+            if session is None:
+                session = runner.load_model(job_args)
+            set_seed(job_args.seed)
+            runner.eval_model(job_args, session)
+            correct[name] = load_correct(answers_file, ground_truth)
+        questions_run += len(alive) * (size - (sizes[k - 1] if k else 0))
+
+        accuracy = {name: sum(correct[name].get(q, False) for q in subset_ids) / size for name in alive}
+        incumbent = max(alive, key=lambda name: accuracy[name])
+        tests = {}
+        for name in alive:
+            if name == incumbent:
+                continue
+            b, c = compare(correct[incumbent], correct[name], subset_ids)
+            tests[name] = {"b": b, "c": c, "p": mcnemar_pvalue(b, c)}
+        dropped = [name for name, t in tests.items() if t["b"] > t["c"] and t["p"] < round_alpha]
+        alive = [name for name in alive if name not in dropped]
+
+        history.append({
+            "round": k, "questions": size, "incumbent": incumbent,
+            "accuracy": accuracy, "tests": tests, "dropped": dropped,
+        })
+        print(f"\nRound {k}: {size} questions, incumbent {incumbent} (acc {accuracy[incumbent]:.4f}), "
+              f"dropped {len(dropped)}, {len(alive)} left")
+        if len(alive) == 1:
+            break
+
+    if session is not None:
+        release(session)
+
+    final = history[-1]
+    best = max(alive, key=lambda name: final["accuracy"][name])
+    full_cost = len(configs) * len(lines)
+    summary = {
+        "configs": {name: " ".join(argv) for name, argv in configs.items()},
+        "rounds": history,
+        "survivors": alive,
+        "best": best,
+        "questions_run": questions_run,
+        "full_grid_questions": full_cost,
+        "elapsed_seconds": time.time() - start,
+    }
+    summary_path = os.path.join(args.output_dir, "sequential_sweep.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"\n{'=' * 60}")
+    print(f"Best configuration: {best} ({' '.join(configs[best])})")
+    print(f"Accuracy on {final['questions']} questions: {final['accuracy'][best]:.4f}")
+    print(f"Questions run: {questions_run} of {full_cost} for the full grid ({questions_run / full_cost:.1%})")
+    print(f"Summary saved to {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Sharded Multi-Process Evaluation Driver
+
+Splits a question file into N contiguous shards, runs one POPE runner
+process per shard and merges the partial answer files back into the
+answers file in the original question order.
+
+A single runner process keeps only a few CPU cores busy (the image loading,
+the AGLA mask pipeline and the Python decode loop are largely serial), so
+each worker gets its own set of cores with a matching intra-op thread count.
+Per-question seeding (utils.seeding) makes the merged answers identical to a
+single-process run with the same seed.
+
+Shards are contiguous slices, so questions about the same image stay in the
+same worker (AGLA / BLIP / prefix caches keep working per shard).
+
+Usage:
+    python run_sharded.py --runner run_pope_combined.py --num-shards 8 \\
+        --question-file pope_coco_random.jsonl --answers-file answers.jsonl -- \\
+        --model-path /path/to/llava --image-folder /path/to/coco \\
+        --use-vcd --use-agla --seed 55
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+
+def split_questions(lines, num_shards):
+    """
+    Contiguous, balanced split of a list (question lines or cores).
+
+    Returns:
+        list of lists; shard sizes differ by at most one
+    """
+    num_shards = max(1, min(num_shards, len(lines)))
+    base, extra = divmod(len(lines), num_shards)
+    shards, start = [], 0
+    for k in range(num_shards):
+        end = start + base + (1 if k < extra else 0)
+        shards.append(lines[start:end])
+        start = end
+    return shards
+
+
+def split_cores(cores, num_shards):
+    """Disjoint core sets, one per shard (shards share cores when there are fewer cores than shards)."""
+    cores = sorted(cores)
+    if len(cores) < num_shards:
+        return [[cores[k % len(cores)]] for k in range(num_shards)]
+    # Contiguous blocks keep a worker's threads on neighbouring cores
+    return split_questions(cores, num_shards)
+
+
+def merge_shards(question_ids, partial_files, answers_file):
+    """
+    Write the answers of all shards to ``answers_file`` in question order.
+
+    Lines that do not parse (the cut-off last line of a crashed shard) are skipped.
+
+    Args:
+        question_ids (list): Question ids of the original question file, in order
+        partial_files (list): Per-shard answers files (missing files are skipped)
+        answers_file (str): Merged answers file (may also be one of ``partial_files``)
+
+    Returns:
+        int: Number of questions without an answer
+    """
+    answers = {}
+    for path in partial_files:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    if line.strip():
+                        answers[json.loads(line)["question_id"]] = line if line.endswith("\n") else line + "\n"
+                except (ValueError, KeyError):
+                    continue
+
+    missing = 0
+    with open(answers_file, "w") as f:
+        for question_id in question_ids:
+            if question_id in answers:
+                f.write(answers[question_id])
+            else:
+                missing += 1
+    return missing
+
+
+def launch_shard(runner, runner_args, question_file, answers_file, log_file, cores, num_threads, gpu=None):
+    """Start one runner process pinned to ``cores`` with ``num_threads`` intra-op threads."""
+    env = os.environ.copy()
+    # torch, OpenMP and MKL read these when the worker starts
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        env[name] = str(num_threads)
+    if gpu is not None:
+        env["CUDA_VISIBLE_DEVICES"] = str(gpu)
+
+    def pin():
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+
+    cmd = [sys.executable, runner, *runner_args, "--question-file", question_file, "--answers-file", answers_file]
+    return subprocess.Popen(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=pin)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a POPE runner over N question shards in parallel and merge the answers",
+        epilog="Arguments after '--' are passed to every runner process.",
+    )
+    parser.add_argument("--runner", type=str, default="run_pope_combined.py",
+                        help="Runner script (run_pope_combined.py or run_qwenvl_combined.py)")
+    parser.add_argument("--num-shards", type=int, required=True, help="Number of worker processes")
+    parser.add_argument("--question-file", type=str, required=True, help="Path to question file")
+    parser.add_argument("--answers-file", type=str, required=True, help="Path to the merged answers")
+    parser.add_argument("--threads-per-shard", type=int, default=None,
+                        help="Intra-op threads per worker (default: size of its core set)")
+    parser.add_argument("--gpus", type=str, nargs="+", default=None,
+                        help="GPU ids assigned to the shards round-robin (default: inherit CUDA_VISIBLE_DEVICES)")
+    parser.add_argument("--shard-dir", type=str, default=None,
+                        help="Directory of the shard question / answer / log files (default: <answers-file>.shards)")
+    parser.add_argument("--keep-shards", action='store_true', help="Keep the shard directory after merging")
+    parser.add_argument("--resume", action='store_true',
+                        help="Keep the answers of an interrupted sharded run and only run the missing questions")
+    args, runner_args = parser.parse_known_args()
+    if runner_args and runner_args[0] == "--":
+        runner_args = runner_args[1:]
+    for option in ("--question-file", "--answers-file", "--record-logits"):
+        if option in runner_args:
+            parser.error(f"{option} cannot be passed to the sharded runners")
+
+    with open(os.path.expanduser(args.question_file), "r") as f:
+        lines = [line if line.endswith("\n") else line + "\n" for line in f if line.strip()]
+    question_ids = [json.loads(line)["question_id"] for line in lines]
+    if len(set(question_ids)) != len(question_ids):
+        parser.error("question ids must be unique to merge the shards")
+
+    answers_file = os.path.expanduser(args.answers_file)
+    os.makedirs(os.path.dirname(answers_file) if os.path.dirname(answers_file) else '.', exist_ok=True)
+    shard_dir = args.shard_dir or answers_file + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # Fold the shards of an interrupted run into the answers file, then shard what is left
+    previous_files = []
+    if args.resume:
+        old_partials = sorted(glob.glob(os.path.join(shard_dir, "answers_*.jsonl")))
+        missing = merge_shards(question_ids, [answers_file] + old_partials, answers_file)
+        previous_files = [answers_file]
+        for path in old_partials:
+            os.remove(path)
+        with open(answers_file, "r") as f:
+            answered = {json.loads(line)["question_id"] for line in f}
+        lines = [line for line, question_id in zip(lines, question_ids) if question_id not in answered]
+        print(f"Resuming: {len(question_ids) - missing} questions already answered")
+        if not lines:
+            print(f"\n✓ Nothing to run, all answers are in {answers_file}")
+            return
+
+    shards = split_questions(lines, args.num_shards)
+    available = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+    core_sets = split_cores(available, len(shards))
+
+    print(f"Sharded evaluation: {len(lines)} questions in {len(shards)} shards ({args.runner})")
+    processes, partial_files, log_files = [], [], []
+    for k, (shard, cores) in enumerate(zip(shards, core_sets)):
+        shard_questions = os.path.join(shard_dir, f"questions_{k}.jsonl")
+        shard_answers = os.path.join(shard_dir, f"answers_{k}.jsonl")
+        with open(shard_questions, "w") as f:
+            f.writelines(shard)
+        num_threads = args.threads_per_shard or len(cores)
+        gpu = args.gpus[k % len(args.gpus)] if args.gpus else None
+        log_file = open(os.path.join(shard_dir, f"log_{k}.txt"), "w")
+        processes.append(launch_shard(
+            args.runner, runner_args, shard_questions, shard_answers, log_file, cores, num_threads, gpu
+        ))
+        partial_files.append(shard_answers)
+        log_files.append(log_file)
+        print(f"  Shard {k}: {len(shard)} questions, cores {cores[0]}..{cores[-1]} "
+              f"({num_threads} threads){f', GPU {gpu}' if gpu is not None else ''}")
+
+    start = time.time()
+    failed = []
+    for k, process in enumerate(processes):
+        if process.wait() != 0:
+            failed.append(k)
+        log_files[k].close()
+    print(f"\nAll shards finished in {time.time() - start:.1f}s")
+
+    missing = merge_shards(question_ids, previous_files + partial_files, answers_file)
+    for k in failed:
+        print(f"✗ Shard {k} failed (exit code {processes[k].returncode}), see {os.path.join(shard_dir, f'log_{k}.txt')}")
+    if missing:
+        print(f"✗ {missing} questions have no answer")
+    if not failed and not args.keep_shards:
+        shutil.rmtree(shard_dir)
+    print(f"\n✓ Merged {len(question_ids) - missing} answers into {answers_file}")
+    if failed or missing:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,14 @@ Combined formula:
     final_logits = (1 + cd_alpha + agla_alpha) * logits_original
                    - cd_alpha * logits_noisy
                    + agla_alpha * logits_augmented
+
+With ``batch_branches=True`` the three branches are stacked into a single
+batch of size 3×B, so the vision encoder and every decoder step run once
+per token instead of three times (one read of the weights per step).
 """
 
 import copy
+import math
 import warnings
 from typing import Optional, List, Union
 
@@ -21,7 +26,15 @@ import torch
 import torch.distributed as dist
 from torch import nn
 
-from transformers.generation.logits_process import LogitsProcessorList
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    MinLengthLogitsProcessor,
+    MinNewTokensLengthLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
 from transformers.generation.stopping_criteria import (
     StoppingCriteriaList,
     validate_stopping_criteria,
@@ -30,9 +43,480 @@ import transformers
 from transformers.generation.utils import SampleOutput
 import logging
 
+from utils.batching import left_pad
+from utils.static_kv_cache import HF_CACHE_PROTOCOL
+
 logger = logging.getLogger(__name__)
 
 
+def _stack_branch_inputs(input_ids, model_kwargs, branch_images):
+    """
+    Stack the original / VCD / AGLA branches into one batch of size n_branches×B.
+
+    Rows are laid out branch-major: rows [k*B:(k+1)*B] belong to branch k, in
+    the order given by ``branch_images``. The returned model_kwargs carry the
+    stacked images under ``images`` so the ordinary
+    ``prepare_inputs_for_generation`` path (and a single ``encode_images`` /
+    visual call) serves all branches, with one batched KV cache.
+
+    Args:
+        input_ids: Prompt token IDs [B, L]
+        model_kwargs: Generation kwargs of the original branch
+        branch_images: List of image tensors, one per branch, each [B, ...]
+
+    Returns:
+        (batched_input_ids, batched_model_kwargs)
+    """
+    n_branches = len(branch_images)
+    batched_kwargs = model_kwargs.copy()
+    batched_kwargs["images"] = torch.cat(branch_images, dim=0)
+    batched_kwargs["images_cd"] = None
+    batched_kwargs["images_agla"] = None
+
+    attention_mask = model_kwargs.get("attention_mask")
+    if attention_mask is not None:
+        batched_kwargs["attention_mask"] = attention_mask.repeat(n_branches, 1)
+
+    return input_ids.repeat(n_branches, 1), batched_kwargs
+
+
+def combine_branch_logits(
+    logits_original,
+    logits_vcd=None,
+    logits_agla=None,
+    cd_alpha=1.0,
+    cd_beta=0.1,
+    agla_alpha=1.0,
+    agla_beta=0.5,
+):
+    """
+    Combine per-branch next-token logits and apply the plausibility cutoff.
+
+    The cutoff is always taken relative to the original branch
+    (VCD's beta when VCD is active, AGLA's beta for AGLA only).
+
+    Args:
+        logits_original: Original image logits [B, V]
+        logits_vcd: VCD noisy image logits [B, V] (optional)
+        logits_agla: AGLA augmented image logits [B, V] (optional)
+
+    Returns:
+        torch.Tensor: Final logits [B, V], implausible tokens set to -inf
+    """
+    if logits_vcd is not None and logits_agla is not None:
+        # Three-way contrastive decoding (plausibility uses VCD's beta)
+        combined_logits = (
+            (1 + cd_alpha + agla_alpha) * logits_original
+            - cd_alpha * logits_vcd
+            + agla_alpha * logits_agla
+        )
+        beta = cd_beta
+    elif logits_vcd is not None:
+        # VCD only
+        combined_logits = (1 + cd_alpha) * logits_original - cd_alpha * logits_vcd
+        beta = cd_beta
+    elif logits_agla is not None:
+        # AGLA only
+        combined_logits = logits_original + agla_alpha * logits_agla
+        beta = agla_beta
+    else:
+        # Standard decoding
+        return logits_original
+
+    cutoff = logits_original.max(dim=-1, keepdim=True).values + math.log(beta)
+    return combined_logits.masked_fill(logits_original < cutoff, -float("inf"))
+
+
+def sparse_candidate_logits(
+    logits_original,
+    logits_vcd=None,
+    logits_agla=None,
+    cd_alpha=1.0,
+    cd_beta=0.1,
+    agla_alpha=1.0,
+    agla_beta=0.5,
+    max_candidates=64,
+):
+    """
+    combine_branch_logits restricted to the tokens that pass the plausibility cutoff.
+
+    The cutoff depends on the original branch only, so the surviving tokens
+    are found first (top-k of the original logits) and only their columns of
+    the VCD / AGLA logits are gathered and combined. The cost of the
+    combination no longer depends on the vocabulary size.
+
+    Args:
+        logits_original, logits_vcd, logits_agla: Branch logits [B, V]
+        max_candidates: Candidate set size K
+
+    Returns:
+        (candidate_ids [B, K], candidate_logits [B, K]) with the candidates
+        below the cutoff at -inf, or None when a row has more than K plausible
+        tokens or no contrast branch is active (use combine_branch_logits)
+    """
+    if logits_vcd is None and logits_agla is None:
+        return None
+    beta = cd_beta if logits_vcd is not None else agla_beta
+    k = min(max_candidates, logits_original.shape[-1])
+    top_values, candidate_ids = logits_original.topk(k, dim=-1)
+    cutoff = top_values[:, :1] + math.log(beta)
+    if k < logits_original.shape[-1] and bool((top_values[:, -1:] >= cutoff).any()):
+        return None
+
+    if logits_vcd is not None and logits_agla is not None:
+        candidate_logits = (
+            (1 + cd_alpha + agla_alpha) * top_values
+            - cd_alpha * logits_vcd.gather(-1, candidate_ids)
+            + agla_alpha * logits_agla.gather(-1, candidate_ids)
+        )
+    elif logits_vcd is not None:
+        candidate_logits = (1 + cd_alpha) * top_values - cd_alpha * logits_vcd.gather(-1, candidate_ids)
+    else:
+        candidate_logits = top_values + agla_alpha * logits_agla.gather(-1, candidate_ids)
+    return candidate_ids, candidate_logits.masked_fill(top_values < cutoff, -float("inf"))
+
+
+# Warpers that only look at the logit values, so they act the same on a candidate set
+_SPARSE_WARPERS = (TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper)
+
+
+def _sparse_processing(logits_processor, logits_warper):
+    """
+    Processing of candidate logits equivalent to ``logits_processor`` and
+    ``logits_warper`` on the full vocabulary.
+
+    Temperature / top-k / top-p warpers are applied as they are; a repetition
+    penalty is applied to the candidates that occur in ``input_ids``, and a
+    minimum length masks the EOS candidates. Returns None when another
+    processor needs the full vocabulary.
+    """
+    penalties = []
+    min_lengths = []
+    for processor in logits_processor:
+        if isinstance(processor, RepetitionPenaltyLogitsProcessor):
+            penalties.append(processor.penalty)
+        elif isinstance(processor, MinNewTokensLengthLogitsProcessor):
+            min_lengths.append(
+                (processor.prompt_length_to_skip + processor.min_new_tokens, processor.eos_token_id)
+            )
+        elif isinstance(processor, MinLengthLogitsProcessor):
+            min_lengths.append((processor.min_length, processor.eos_token_id))
+        else:
+            return None
+    if not all(isinstance(warper, _SPARSE_WARPERS) for warper in logits_warper):
+        return None
+
+    def process(input_ids, candidate_ids, candidate_logits):
+        for penalty in penalties:
+            seen = (candidate_ids.unsqueeze(-1) == input_ids.unsqueeze(1)).any(dim=-1)
+            penalized = torch.where(candidate_logits < 0, candidate_logits * penalty, candidate_logits / penalty)
+            candidate_logits = torch.where(seen, penalized, candidate_logits)
+        for min_length, eos_token_id in min_lengths:
+            if input_ids.shape[-1] < min_length:
+                eos = torch.as_tensor(eos_token_id, device=candidate_ids.device).view(-1)
+                candidate_logits = candidate_logits.masked_fill(torch.isin(candidate_ids, eos), -float("inf"))
+        return logits_warper(input_ids, candidate_logits)
+
+    return process
+
+
+class BranchSkipPolicy:
+    """
+    Entropy / top-1 margin gate for skipping the auxiliary (VCD/AGLA) branches.
+
+    A decode step skips the gated branches when the original branch is already
+    confident for every sequence in the batch: entropy at or below
+    ``entropy_threshold`` (nats), or top-1 minus top-2 probability at or above
+    ``margin_threshold``. A skipped branch is left out of that step's
+    combination (its term and coefficient), so skipping every gated branch
+    samples from the original logits alone, and skipping VCD only uses the
+    AGLA-only combination with AGLA's beta.
+
+    Args:
+        entropy_threshold: Skip when entropy <= threshold (None disables)
+        margin_threshold: Skip when p_top1 - p_top2 >= threshold (None disables)
+        branches: Branch names the gate applies to ("vcd", "agla")
+        mode: "lazy" catches the skipped branch's KV cache up on its next
+              forward; "drop" stops running the branch for the rest of the
+              sequence
+    """
+
+    def __init__(self, entropy_threshold=None, margin_threshold=None, branches=("vcd", "agla"), mode="lazy"):
+        if mode not in ("lazy", "drop"):
+            raise ValueError(f"Unknown branch skip mode: {mode}")
+        self.entropy_threshold = entropy_threshold
+        self.margin_threshold = margin_threshold
+        self.branches = tuple(branches)
+        self.mode = mode
+
+    def is_confident(self, logits):
+        """True when every row of ``logits`` [B, V] clears one of the thresholds."""
+        probs = nn.functional.softmax(logits.float(), dim=-1)
+        checks = []
+        if self.entropy_threshold is not None:
+            entropy = -(probs * torch.log(probs.clamp_min(1e-12))).sum(dim=-1)
+            checks.append(entropy <= self.entropy_threshold)
+        if self.margin_threshold is not None:
+            top2 = probs.topk(2, dim=-1).values
+            checks.append(top2[:, 0] - top2[:, 1] >= self.margin_threshold)
+        if not checks:
+            return False
+        return bool(torch.stack(checks).any(dim=0).all())
+
+    def __call__(self, logits_original):
+        """Return the set of branch names to skip for this step."""
+        return set(self.branches) if self.is_confident(logits_original) else set()
+
+
+def _past_length(model, past_key_values):
+    """Number of cached positions in a branch's past_key_values."""
+    if hasattr(past_key_values, "get_seq_length"):
+        return past_key_values.get_seq_length()
+    # LLaMA caches are [B, H, S, D]; Qwen-VL's are [B, S, H, D]
+    return past_key_values[0][0].shape[getattr(model, "kv_cache_seq_dim", -2)]
+
+
+def _prefix_spec(model_kwargs, input_ids, branches):
+    """
+    Prefix-cache lookup spec ``(cache, keys, prefix_length)`` for ``branches``.
+
+    Returns None when no prefix cache was passed to generate, or when the
+    prompt has no suffix beyond the prefix.
+    """
+    prefix_cache = model_kwargs.get("prefix_cache")
+    prefix_length = model_kwargs.get("prefix_length")
+    if prefix_cache is None or not prefix_length or prefix_length >= input_ids.shape[1]:
+        return None
+    prefix_keys = model_kwargs.get("prefix_cache_keys") or {}
+    return prefix_cache, [prefix_keys[branch] for branch in branches], prefix_length
+
+
+def _prefix_prefill(model, prepare_fn, input_ids, branch_kwargs, prefix, **forward_kwargs):
+    """
+    Prefill a branch from the prefix KV cache, running only the question suffix.
+
+    ``prefix`` is a spec from _prefix_spec with one key per block of rows
+    (a single block, or one per branch when the branches are stacked).
+    On a miss the prefix is run once for all blocks and stored; the suffix
+    then runs on top of the prefix cache like a lagging branch catching up.
+    """
+    prefix_cache, keys, prefix_length = prefix
+    prefix_ids = input_ids[:, :prefix_length]
+    block = input_ids.shape[0] // len(keys)
+    blocks = [slice(i * block, (i + 1) * block) for i in range(len(keys))]
+
+    pasts = [prefix_cache.get(key, prefix_ids[rows]) for key, rows in zip(keys, blocks)]
+    if any(past is None for past in pasts):
+        prefix_kwargs = branch_kwargs.copy()
+        prefix_kwargs["use_cache"] = True
+        if prefix_kwargs.get("attention_mask") is not None:
+            prefix_kwargs["attention_mask"] = prefix_kwargs["attention_mask"][:, :prefix_length]
+        # Only the cache is kept, so project a single position
+        prefix_outputs = model(**prepare_fn(prefix_ids, **prefix_kwargs), return_dict=True, last_logits_only=True)
+        past_key_values = prefix_outputs.past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        for key, rows in zip(keys, blocks):
+            block_past = past_key_values
+            if len(keys) > 1:
+                block_past = tuple(tuple(t[rows].clone() for t in layer) for layer in past_key_values)
+            prefix_cache.put(key, prefix_ids[rows], block_past)
+    elif len(pasts) == 1:
+        past_key_values = pasts[0]
+    else:
+        past_key_values = tuple(
+            tuple(torch.cat(tensors, dim=0) for tensors in zip(*layers)) for layers in zip(*pasts)
+        )
+
+    suffix_kwargs = branch_kwargs.copy()
+    suffix_kwargs["past_key_values"] = past_key_values
+    lag = input_ids.shape[1] - prefix_length - 1
+    return _branch_forward(model, prepare_fn, input_ids, suffix_kwargs, lag, **forward_kwargs)
+
+
+def _branch_forward(model, prepare_fn, input_ids, branch_kwargs, lag=0, prefix=None, **forward_kwargs):
+    """
+    Run one branch forward, catching up a lagging KV cache.
+
+    ``lag`` is the number of decode steps the branch skipped since its last
+    forward. Those tokens are fed together with the current one on top of the
+    existing cache (images are already in the cache, so none are passed).
+    A branch that never ran (no cache yet) takes the normal prefill path over
+    the full ``input_ids``, or the prefix-cache path when ``prefix`` is given.
+    """
+    if prefix is not None and not branch_kwargs.get("past_key_values"):
+        return _prefix_prefill(model, prepare_fn, input_ids, branch_kwargs, prefix, **forward_kwargs)
+
+    model_inputs = prepare_fn(input_ids, **branch_kwargs)
+
+    past_key_values = branch_kwargs.get("past_key_values")
+    # An empty (static) cache means the branch has not run yet: plain prefill
+    if lag > 0 and past_key_values:
+        n_new = lag + 1
+        past_length = _past_length(model, past_key_values)
+        attention_mask = branch_kwargs.get("attention_mask")
+        if attention_mask is None or attention_mask.shape[1] > past_length + n_new:
+            attention_mask = torch.ones(
+                (input_ids.shape[0], past_length + n_new), dtype=torch.long, device=input_ids.device
+            )
+        elif attention_mask.shape[1] < past_length + n_new:
+            # LLaVA's text-level mask does not count the expanded image tokens; its only
+            # zeros are left padding, so extending it on the right keeps them in place
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones((attention_mask.shape[0], past_length + n_new - attention_mask.shape[1]))],
+                dim=-1,
+            )
+        model_inputs.update(
+            {
+                "input_ids": input_ids[:, -n_new:],
+                "attention_mask": attention_mask,
+                "images": None,
+            }
+        )
+        if model_inputs.get("position_ids") is not None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            model_inputs["position_ids"] = position_ids[:, -n_new:]
+
+    return model(**model_inputs, return_dict=True, **forward_kwargs)
+
+
+def _exit_kwargs(branch_exit_layers, branch):
+    """Forward kwargs of a branch's early exit (none when it runs every decoder layer)."""
+    exit_layer = branch_exit_layers.get(branch)
+    return {"exit_layer": exit_layer} if exit_layer is not None else {}
+
+
+def _sample_tokens(probs, generators=None):
+    """
+    Draw one token per row of ``probs``.
+
+    ``generators`` is a torch.Generator or a list with one per row (see
+    utils.seeding), so a row's draws do not depend on the other rows or on
+    earlier questions; None samples from the global RNG.
+    """
+    if generators is None:
+        return torch.multinomial(probs, num_samples=1).squeeze(1)
+    if isinstance(generators, torch.Generator):
+        generators = [generators] * probs.shape[0]
+    return torch.cat(
+        [torch.multinomial(probs[i:i + 1], num_samples=1, generator=g) for i, g in enumerate(generators)]
+    ).squeeze(1)
+
+
+def _extend_attention_mask(model_kwargs):
+    """Append one position to the attention mask of a branch that skipped a step."""
+    attention_mask = model_kwargs.get("attention_mask")
+    if attention_mask is not None:
+        model_kwargs = model_kwargs.copy()
+        model_kwargs["attention_mask"] = torch.cat(
+            [attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1
+        )
+    return model_kwargs
+
+
+def language_prior_logits(
+    model, prior_cache, prior_cache_key, prior_input_ids, prior_images=None, pad_token_id=0,
+):
+    """
+    First-token logits of the language-prior branch, from the cache where possible.
+
+    The prior sequence of a row is its prior prompt (image-free, or with the
+    stand-in image of utils.prior_cache). Rows missing from ``prior_cache``
+    run one left-padded forward without a KV cache, since only the next
+    token is scored; their logits are then stored. A miss costs a prefill of
+    the prior prompt (including the stand-in image's tokens in "noise" mode),
+    paid once per distinct prompt. Decoding keeps a KV cache for the prior
+    instead (see _language_prior_step).
+
+    Args:
+        prior_cache: utils.prior_cache.PriorLogitsCache
+        prior_cache_key: Namespace from PriorLogitsCache.make_key
+        prior_input_ids: Prior prompt token ids per row (list of 1-D tensors)
+        prior_images: Stand-in images [B, ...] ("noise" mode; None for "text")
+
+    Returns:
+        torch.Tensor: Prior logits [B, V]
+    """
+    logits = [prior_cache.get(prior_cache_key, prompt) for prompt in prior_input_ids]
+    missing = [i for i, row_logits in enumerate(logits) if row_logits is None]
+    if missing:
+        input_ids, attention_mask = left_pad([prior_input_ids[i] for i in missing], pad_token_id)
+        device = model.device
+        prior_kwargs = {"attention_mask": attention_mask.to(device), "use_cache": False}
+        if prior_images is not None:
+            prior_kwargs["images"] = prior_images[missing]
+        outputs = model(
+            **model.prepare_inputs_for_generation(input_ids.to(device), **prior_kwargs),
+            return_dict=True, last_logits_only=True,
+        )
+        for row, i in enumerate(missing):
+            logits[i] = outputs.logits[row, -1, :].clone()
+            prior_cache.put(prior_cache_key, prior_input_ids[i], logits[i])
+    return torch.stack(logits)
+
+
+def _language_prior_branch(prior_input_ids, prior_images, pad_token_id, device):
+    """
+    Decode state of the language-prior branch: left-padded prior prompts, the
+    branch kwargs (KV cache, attention mask, stand-in images) and its lag.
+    """
+    input_ids, attention_mask = left_pad(list(prior_input_ids), pad_token_id)
+    branch_kwargs = {"attention_mask": attention_mask.to(device), "use_cache": True}
+    if prior_images is not None:
+        branch_kwargs["images"] = prior_images
+    return {
+        "prompts": [prompt.to(device) for prompt in prior_input_ids],
+        "input_ids": input_ids.to(device),
+        "kwargs": branch_kwargs,
+        "lag": 0,
+    }
+
+
+def _language_prior_step(model, prior_cache, prior_cache_key, prior_branch, generated_ids=None):
+    """
+    Language-prior logits of one decode step.
+
+    Every row (prior prompt + tokens generated so far) is looked up in
+    ``prior_cache`` first. When a row misses, the prior's own KV cache is
+    advanced over the tokens since its last forward, like a lagging branch
+    catching up, so each prior position is computed once per sequence. When
+    every row hits, the forward is skipped and the cache lags one more token.
+
+    Args:
+        prior_branch: State from _language_prior_branch (updated in place)
+        generated_ids: Tokens generated so far [B, T] (None before the first)
+
+    Returns:
+        torch.Tensor: Prior logits [B, V]
+    """
+    input_ids = prior_branch["input_ids"]
+    sequences = prior_branch["prompts"]
+    if generated_ids is not None:
+        input_ids = torch.cat([input_ids, generated_ids], dim=-1)
+        sequences = [torch.cat([prompt, generated_ids[i]]) for i, prompt in enumerate(sequences)]
+
+    logits = [prior_cache.get(prior_cache_key, sequence) for sequence in sequences]
+    missing = [i for i, row_logits in enumerate(logits) if row_logits is None]
+    if not missing:
+        prior_branch["lag"] += 1
+        prior_branch["kwargs"] = _extend_attention_mask(prior_branch["kwargs"])
+        return torch.stack(logits)
+
+    outputs = _branch_forward(
+        model, model.prepare_inputs_for_generation, input_ids, prior_branch["kwargs"], prior_branch["lag"],
+        last_logits_only=True,
+    )
+    for i in missing:
+        logits[i] = outputs.logits[i, -1, :].clone()
+        prior_cache.put(prior_cache_key, sequences[i], logits[i])
+    prior_branch["kwargs"] = model._update_model_kwargs_for_generation(
+        outputs, prior_branch["kwargs"], is_encoder_decoder=model.config.is_encoder_decoder
+    )
+    prior_branch["lag"] = 0
+    return torch.stack(logits)
+
+
 def sample_vcd_agla(
     self,
     input_ids: torch.LongTensor,
@@ -63,6 +547,34 @@ def sample_vcd_agla(
             - cd_beta: VCD plausibility threshold (default: 0.1)
             - agla_alpha: AGLA enhancement strength (default: 1.0)
             - agla_beta: AGLA plausibility threshold (default: 0.5)
+            - batch_branches: Run all branches as one 3×B batch (default: False)
+            - branch_skip_policy: BranchSkipPolicy gating the VCD/AGLA branches
+              per step (default: None, always run both)
+            - prefix_cache: utils.prefix_cache.PrefixKVCache to reuse the
+              image-prefix KV cache across questions (default: None)
+            - prefix_cache_keys: Cache key per branch ("original", "vcd", "agla")
+            - prefix_length: Number of prompt tokens in the shared prefix
+            - last_logits_only: Apply the LM head to the last position only
+              (only the next-token logits are read; default: False)
+            - sampling_generator: torch.Generator, or one per batch row, for the
+              token sampling (default: None, global RNG; see utils.seeding)
+            - sparse_candidates: Combine, warp and sample within the K tokens
+              that pass the plausibility cutoff (default: None, full vocabulary;
+              same distribution, but different draws for a given seed)
+            - static_kv_caches: Preallocated KV cache per branch, reset and
+              reused on every call (utils.static_kv_cache.make_static_kv_caches;
+              int8 for the VCD/AGLA branches with QuantizedKVCache; default:
+              None, caches grow by concatenation)
+            - branch_exit_layers: {"vcd": K, "agla": K}, run that branch through
+              its first K decoder layers only, then the final norm and LM head
+              (default: None, all layers; ignored with batch_branches / prefix_cache)
+            - prior_cache, prior_cache_key, prior_input_ids, prior_images: Use the
+              cached language prior (utils.prior_cache) as the VCD branch instead
+              of a noisy-image forward; the prior keeps its own KV cache for the
+              cache misses (images_cd is then ignored)
+    
+    Branch statistics (forwards run / skipped, catch-up tokens) are
+    accumulated in ``self.vcd_agla_stats``.
     
     Returns:
         Generated token IDs
@@ -104,11 +616,92 @@ def sample_vcd_agla(
     use_vcd = model_kwargs.get("images_cd") is not None
     use_agla = model_kwargs.get("images_agla") is not None
     
-    logger.info(f"Three-way decoding: VCD={use_vcd}, AGLA={use_agla}")
+    # Language-prior mode: the VCD logits come from utils.prior_cache, not from a noisy-image branch
+    prior_kwargs = None
+    if model_kwargs.get("prior_cache") is not None:
+        if use_vcd:
+            logger.warning("images_cd is ignored with prior_cache")
+            use_vcd = False
+        prior_kwargs = {name: model_kwargs.get(name) for name in ("prior_cache", "prior_cache_key")}
+        prior_branch = _language_prior_branch(
+            model_kwargs["prior_input_ids"], model_kwargs.get("prior_images"),
+            pad_token_id if pad_token_id is not None else 0, input_ids.device,
+        )
+    prompt_length = input_ids.shape[1]
+    
+    batch_branches = bool(model_kwargs.get("batch_branches", False)) and (use_vcd or use_agla)
+    
+    logger.info(f"Three-way decoding: VCD={use_vcd}, AGLA={use_agla}, batched={batch_branches}")
+    
+    branch_skip_policy = model_kwargs.get("branch_skip_policy")
+    if branch_skip_policy is not None and batch_branches:
+        logger.warning("branch_skip_policy is ignored with batch_branches=True")
+        branch_skip_policy = None
+    branch_lag = {"vcd": 0, "agla": 0}
+    if not hasattr(self, "vcd_agla_stats"):
+        self.vcd_agla_stats = {
+            "branch_forwards": 0, "skipped_branch_forwards": 0, "catch_up_tokens": 0, "sparse_steps": 0,
+        }
+    stats = self.vcd_agla_stats
     
     # Create separate model_kwargs for VCD and AGLA
-    model_kwargs_vcd = model_kwargs.copy() if use_vcd else None
-    model_kwargs_agla = model_kwargs.copy() if use_agla else None
+    model_kwargs_vcd = model_kwargs.copy() if use_vcd and not batch_branches else None
+    model_kwargs_agla = model_kwargs.copy() if use_agla and not batch_branches else None
+
+    # Batched mode: one model_kwargs / KV cache for all branches stacked as n_branches×B
+    batch_size = input_ids.shape[0]
+    if batch_branches:
+        branch_images = [model_kwargs["images"]]
+        if use_vcd:
+            branch_images.append(model_kwargs["images_cd"])
+        if use_agla:
+            branch_images.append(model_kwargs["images_agla"])
+        n_branches = len(branch_images)
+        batched_input_ids, batched_kwargs = _stack_branch_inputs(input_ids, model_kwargs, branch_images)
+    
+    # Prefix-cache specs for the first forward of each branch
+    if batch_branches:
+        prefix_batched = _prefix_spec(
+            model_kwargs, input_ids,
+            ["original"] + (["vcd"] if use_vcd else []) + (["agla"] if use_agla else []),
+        )
+    else:
+        prefix_original = _prefix_spec(model_kwargs, input_ids, ["original"])
+        prefix_vcd = _prefix_spec(model_kwargs, input_ids, ["vcd"]) if use_vcd else None
+        prefix_agla = _prefix_spec(model_kwargs, input_ids, ["agla"]) if use_agla else None
+    
+    # Preallocated per-branch KV caches, written in place and reused across calls
+    static_kv_caches = model_kwargs.get("static_kv_caches")
+    if static_kv_caches is not None and not getattr(self, "supports_static_kv_cache", HF_CACHE_PROTOCOL):
+        logger.warning("static_kv_caches needs transformers >= 4.36 for this model; using growing caches")
+        static_kv_caches = None
+    if static_kv_caches is not None and model_kwargs.get("prefix_cache") is not None:
+        logger.warning("static_kv_caches is ignored with prefix_cache")
+        static_kv_caches = None
+    if static_kv_caches is not None:
+        if batch_branches:
+            branch_caches = [(batched_kwargs, "batched")]
+        else:
+            branch_caches = [(model_kwargs, "original"), (model_kwargs_vcd, "vcd"), (model_kwargs_agla, "agla")]
+        for branch_kwargs, name in branch_caches:
+            # Branches without a cache (e.g. only int8 VCD/AGLA caches) keep the default one
+            if branch_kwargs is not None and name in static_kv_caches:
+                static_kv_caches[name].reset()
+                branch_kwargs["past_key_values"] = static_kv_caches[name]
+    
+    # Early exit of the VCD/AGLA branches: only their first K decoder layers run
+    branch_exit_layers = model_kwargs.get("branch_exit_layers") or {}
+    if branch_exit_layers and (batch_branches or model_kwargs.get("prefix_cache") is not None):
+        logger.warning("branch_exit_layers is ignored with batch_branches / prefix_cache")
+        branch_exit_layers = {}
+    
+    # Forward options shared by every branch
+    forward_kwargs = {
+        "output_attentions": output_attentions,
+        "output_hidden_states": output_hidden_states,
+    }
+    if model_kwargs.get("last_logits_only"):
+        forward_kwargs["last_logits_only"] = True
     
     # Get parameters
     cd_alpha = model_kwargs.get("cd_alpha", 1.0)
@@ -118,6 +711,16 @@ def sample_vcd_agla(
     
     logger.info(f"Parameters: cd_alpha={cd_alpha}, cd_beta={cd_beta}, "
                 f"agla_alpha={agla_alpha}, agla_beta={agla_beta}")
+
+    # Candidate-set combination (full-vocabulary scores are needed for output_scores)
+    sparse_candidates = model_kwargs.get("sparse_candidates")
+    sparse_processing = None
+    if (sparse_candidates and (use_vcd or use_agla or prior_kwargs is not None)
+            and not (return_dict_in_generate and output_scores)):
+        sparse_processing = _sparse_processing(logits_processor, logits_warper)
+        if sparse_processing is None:
+            logger.warning("sparse_candidates supports temperature / top-k / top-p / repetition penalty / "
+                           "minimum length only; combining over the full vocabulary")
     
     # Initialize attention / hidden states / scores tuples
     scores = () if (return_dict_in_generate and output_scores) else None
@@ -138,80 +741,116 @@ def sample_vcd_agla(
             if this_peer_finished_flag.item() == 0.0:
                 break
 
-        # ========== 1. Original image forward pass ==========
-        model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
-        outputs = self(
-            **model_inputs,
-            return_dict=True,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-        )
-
-        if synced_gpus and this_peer_finished:
-            continue
+        if batch_branches:
+            # ========== 1-3. All branches in one stacked forward pass ==========
+            outputs = _branch_forward(
+                self, self.prepare_inputs_for_generation, batched_input_ids, batched_kwargs,
+                prefix=prefix_batched,
+                **forward_kwargs,
+            )
 
-        next_token_logits_original = outputs.logits[:, -1, :]
+            if synced_gpus and this_peer_finished:
+                continue
 
-        # ========== 2. VCD: Noisy image forward pass ==========
-        next_token_logits_vcd = None
-        if use_vcd:
-            model_inputs_vcd = self.prepare_inputs_for_generation_cd(input_ids, **model_kwargs_vcd)
-            outputs_vcd = self(
-                **model_inputs_vcd,
-                return_dict=True,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
+            branch_logits = list(outputs.logits[:, -1, :].split(batch_size, dim=0))
+            next_token_logits_original = branch_logits.pop(0)
+            next_token_logits_vcd = branch_logits.pop(0) if use_vcd else None
+            next_token_logits_agla = branch_logits.pop(0) if use_agla else None
+            outputs_vcd = outputs_agla = None
+            skipped = set()
+        else:
+            # ========== 1. Original image forward pass ==========
+            outputs = _branch_forward(
+                self, self.prepare_inputs_for_generation, input_ids, model_kwargs,
+                prefix=prefix_original,
+                **forward_kwargs,
             )
-            next_token_logits_vcd = outputs_vcd.logits[:, -1, :]
 
-        # ========== 3. AGLA: Augmented image forward pass ==========
-        next_token_logits_agla = None
-        if use_agla:
-            model_inputs_agla = self.prepare_inputs_for_generation_agla(input_ids, **model_kwargs_agla)
-            outputs_agla = self(
-                **model_inputs_agla,
-                return_dict=True,
-                output_attentions=output_attentions,
-                output_hidden_states=output_hidden_states,
-            )
-            next_token_logits_agla = outputs_agla.logits[:, -1, :]
+            if synced_gpus and this_peer_finished:
+                continue
+
+            next_token_logits_original = outputs.logits[:, -1, :]
+
+            # Branches the policy gates off for this step (dropped branches stay off)
+            skipped = branch_skip_policy(next_token_logits_original) if branch_skip_policy is not None else set()
+            if branch_skip_policy is not None and branch_skip_policy.mode == "drop":
+                if "vcd" in skipped:
+                    model_kwargs_vcd = None
+                    prior_kwargs = None
+                if "agla" in skipped:
+                    model_kwargs_agla = None
 
+            # ========== 2. VCD: Noisy image forward pass ==========
+            next_token_logits_vcd = None
+            outputs_vcd = None
+            if use_vcd:
+                if model_kwargs_vcd is None or "vcd" in skipped:
+                    stats["skipped_branch_forwards"] += 1
+                else:
+                    outputs_vcd = _branch_forward(
+                        self, self.prepare_inputs_for_generation_cd, input_ids, model_kwargs_vcd, branch_lag["vcd"],
+                        prefix=prefix_vcd,
+                        **forward_kwargs, **_exit_kwargs(branch_exit_layers, "vcd"),
+                    )
+                    next_token_logits_vcd = outputs_vcd.logits[:, -1, :]
+
+            # ========== 3. AGLA: Augmented image forward pass ==========
+            next_token_logits_agla = None
+            outputs_agla = None
+            if use_agla:
+                if model_kwargs_agla is None or "agla" in skipped:
+                    stats["skipped_branch_forwards"] += 1
+                else:
+                    outputs_agla = _branch_forward(
+                        self, self.prepare_inputs_for_generation_agla, input_ids, model_kwargs_agla, branch_lag["agla"],
+                        prefix=prefix_agla,
+                        **forward_kwargs, **_exit_kwargs(branch_exit_layers, "agla"),
+                    )
+                    next_token_logits_agla = outputs_agla.logits[:, -1, :]
+
+        # ========== 2b. Cached language prior in place of the VCD branch ==========
+        if prior_kwargs is not None:
+            if "vcd" in skipped:
+                # Like a skipped branch: left out of this step, its KV cache lags one more token
+                prior_branch["lag"] += 1
+                prior_branch["kwargs"] = _extend_attention_mask(prior_branch["kwargs"])
+                stats["skipped_branch_forwards"] += 1
+            else:
+                next_token_logits_vcd = _language_prior_step(
+                    self, **prior_kwargs, prior_branch=prior_branch,
+                    generated_ids=input_ids[:, prompt_length:] if input_ids.shape[1] > prompt_length else None,
+                )
+        
         # ========== 4. Combine logits ==========
-        if use_vcd and use_agla:
-            # Three-way contrastive decoding
-            combined_logits = (
-                (1 + cd_alpha + agla_alpha) * next_token_logits_original
-                - cd_alpha * next_token_logits_vcd
-                + agla_alpha * next_token_logits_agla
+        sparse = None
+        if sparse_processing is not None:
+            sparse = sparse_candidate_logits(
+                next_token_logits_original, next_token_logits_vcd, next_token_logits_agla,
+                cd_alpha=cd_alpha, cd_beta=cd_beta, agla_alpha=agla_alpha, agla_beta=agla_beta,
+                max_candidates=sparse_candidates,
             )
-            
-            # Apply plausibility constraint (using VCD's beta)
-            cutoff = torch.log(torch.tensor(cd_beta)) + next_token_logits_original.max(dim=-1, keepdim=True).values
-            final_logits = combined_logits.masked_fill(next_token_logits_original < cutoff, -float("inf"))
-            
-        elif use_vcd:
-            # VCD only
-            combined_logits = (1 + cd_alpha) * next_token_logits_original - cd_alpha * next_token_logits_vcd
-            cutoff = torch.log(torch.tensor(cd_beta)) + next_token_logits_original.max(dim=-1, keepdim=True).values
-            final_logits = combined_logits.masked_fill(next_token_logits_original < cutoff, -float("inf"))
-            
-        elif use_agla:
-            # AGLA only
-            combined_logits = next_token_logits_original + agla_alpha * next_token_logits_agla
-            cutoff = torch.log(torch.tensor(agla_beta)) + next_token_logits_original.max(dim=-1, keepdim=True).values
-            final_logits = combined_logits.masked_fill(next_token_logits_original < cutoff, -float("inf"))
-            
+
+        if sparse is not None:
+            # ========== 5. Process and sample within the candidate set ==========
+            candidate_ids, candidate_logits = sparse
+            candidate_logits = sparse_processing(input_ids, candidate_ids, candidate_logits)
+            probs = nn.functional.softmax(candidate_logits, dim=-1)
+            choices = _sample_tokens(probs, model_kwargs.get("sampling_generator"))
+            next_tokens = candidate_ids.gather(-1, choices[:, None]).squeeze(1)
+            stats["sparse_steps"] += 1
         else:
-            # Standard decoding
-            final_logits = next_token_logits_original
+            final_logits = combine_branch_logits(
+                next_token_logits_original, next_token_logits_vcd, next_token_logits_agla,
+                cd_alpha=cd_alpha, cd_beta=cd_beta, agla_alpha=agla_alpha, agla_beta=agla_beta,
+            )
 
-        # ========== 5. Apply logits processing and sampling ==========
-        final_logits = logits_processor(input_ids, final_logits)
-        final_logits = logits_warper(input_ids, final_logits)
+            # ========== 5. Apply logits processing and sampling ==========
+            final_logits = logits_processor(input_ids, final_logits)
+            final_logits = logits_warper(input_ids, final_logits)
 
-        # Sample next token
-        probs = nn.functional.softmax(final_logits, dim=-1)
-        next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            # Sample next token
+            probs = nn.functional.softmax(final_logits, dim=-1)
+            next_tokens = _sample_tokens(probs, model_kwargs.get("sampling_generator"))
 
         # ========== 6. Update sequences ==========
         if eos_token_id is not None:
@@ -221,6 +860,10 @@ def sample_vcd_agla(
 
         # Update input_ids
         input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+        if batch_branches:
+            batched_input_ids = torch.cat(
+                [batched_input_ids, next_tokens.repeat(n_branches)[:, None]], dim=-1
+            )
 
         if streamer is not None:
             streamer.put(next_tokens.cpu())
@@ -243,20 +886,35 @@ def sample_vcd_agla(
                 )
 
         # Update model_kwargs
-        model_kwargs = self._update_model_kwargs_for_generation(
-            outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
-        )
-
-        if use_vcd:
-            model_kwargs_vcd = self._update_model_kwargs_for_generation(
-                outputs_vcd, model_kwargs_vcd, is_encoder_decoder=self.config.is_encoder_decoder
+        if batch_branches:
+            batched_kwargs = self._update_model_kwargs_for_generation(
+                outputs, batched_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
-
-        if use_agla:
-            model_kwargs_agla = self._update_model_kwargs_for_generation(
-                outputs_agla, model_kwargs_agla, is_encoder_decoder=self.config.is_encoder_decoder
+        else:
+            model_kwargs = self._update_model_kwargs_for_generation(
+                outputs, model_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
             )
 
+        for name, branch_outputs in (("vcd", outputs_vcd), ("agla", outputs_agla)):
+            branch_kwargs = model_kwargs_vcd if name == "vcd" else model_kwargs_agla
+            if branch_kwargs is None:
+                continue
+            if branch_outputs is not None:
+                stats["branch_forwards"] += 1
+                stats["catch_up_tokens"] += branch_lag[name]
+                branch_lag[name] = 0
+                branch_kwargs = self._update_model_kwargs_for_generation(
+                    branch_outputs, branch_kwargs, is_encoder_decoder=self.config.is_encoder_decoder
+                )
+            else:
+                # Skipped this step: the cache lags one more token behind
+                branch_lag[name] += 1
+                branch_kwargs = _extend_attention_mask(branch_kwargs)
+            if name == "vcd":
+                model_kwargs_vcd = branch_kwargs
+            else:
+                model_kwargs_agla = branch_kwargs
+
         # Check if finished
         if eos_token_id_tensor is not None:
             unfinished_sequences = unfinished_sequences.mul(
@@ -265,6 +923,14 @@ def sample_vcd_agla(
             if unfinished_sequences.max() == 0:
                 this_peer_finished = True
 
+        # Per-sequence stopping criteria (e.g. KeywordsStoppingCriteria): finished rows are padded from now on
+        for criteria in stopping_criteria:
+            if hasattr(criteria, "sequences_finished"):
+                finished = criteria.sequences_finished(input_ids, scores)
+                unfinished_sequences = unfinished_sequences.mul((~finished).long())
+                if unfinished_sequences.max() == 0:
+                    this_peer_finished = True
+
         if stopping_criteria(input_ids, scores):
             this_peer_finished = True
 
@@ -287,6 +953,194 @@ def sample_vcd_agla(
         return input_ids
 
 
+def get_yes_no_token_ids(tokenizer):
+    """
+    Collect the vocabulary ids that start a "yes" / "no" answer.
+
+    Both the bare and the space-prefixed spellings are included, since
+    LLaMA (sentencepiece) and Qwen (tiktoken) tokenize the first answer
+    word differently.
+
+    Returns:
+        (yes_token_ids, no_token_ids): Lists of token ids
+    """
+    def first_word_ids(words):
+        ids = []
+        for word in words:
+            for token_id in tokenizer.encode(word, add_special_tokens=False):
+                # Skip a bare SentencePiece "▁" piece in front of the word
+                if tokenizer.decode([token_id]).strip():
+                    if token_id not in ids:
+                        ids.append(token_id)
+                    break
+        return ids
+
+    yes_token_ids = first_word_ids(["Yes", "yes", "YES", " Yes", " yes"])
+    no_token_ids = first_word_ids(["No", "no", "NO", " No", " no"])
+    return yes_token_ids, no_token_ids
+
+
+def first_token_branch_logits(
+    model,
+    input_ids,
+    images=None,
+    images_cd=None,
+    images_agla=None,
+    attention_mask=None,
+    batch_branches=False,
+    prefix_cache=None,
+    prefix_cache_keys=None,
+    prefix_length=None,
+    branch_exit_layers=None,
+):
+    """
+    Next-token logits of each branch after a single prefill (no decoding loop).
+
+    Args:
+        model: LLaVA or Qwen-VL model with prepare_inputs_for_generation{,_cd,_agla}
+        input_ids: Prompt token IDs [B, L]
+        images / images_cd / images_agla: Branch images (VCD/AGLA optional)
+        batch_branches: Stack the branches into one n_branches×B prefill
+        prefix_cache / prefix_cache_keys / prefix_length: Reuse cached image
+            prefixes and prefill only the question suffix (see sample_vcd_agla)
+        branch_exit_layers: Decoder depth per auxiliary branch (see sample_vcd_agla)
+
+    Returns:
+        (logits_original, logits_vcd, logits_agla): [B, V] each, None for
+        branches without images
+    """
+    model_kwargs = {
+        "images": images,
+        "images_cd": images_cd,
+        "images_agla": images_agla,
+        "attention_mask": attention_mask,
+        "use_cache": False,
+        "prefix_cache": prefix_cache,
+        "prefix_cache_keys": prefix_cache_keys,
+        "prefix_length": prefix_length,
+    }
+    use_vcd = images_cd is not None
+    use_agla = images_agla is not None
+    branch_exit_layers = branch_exit_layers or {}
+    if branch_exit_layers and ((batch_branches and (use_vcd or use_agla)) or prefix_cache is not None):
+        logger.warning("branch_exit_layers is ignored with batch_branches / prefix_cache")
+        branch_exit_layers = {}
+
+    if batch_branches and (use_vcd or use_agla):
+        branch_images = [images] + ([images_cd] if use_vcd else []) + ([images_agla] if use_agla else [])
+        batched_input_ids, batched_kwargs = _stack_branch_inputs(input_ids, model_kwargs, branch_images)
+        branches = ["original"] + (["vcd"] if use_vcd else []) + (["agla"] if use_agla else [])
+        outputs = _branch_forward(
+            model, model.prepare_inputs_for_generation, batched_input_ids, batched_kwargs,
+            prefix=_prefix_spec(model_kwargs, input_ids, branches), last_logits_only=True,
+        )
+        branch_logits = list(outputs.logits[:, -1, :].split(input_ids.shape[0], dim=0))
+        logits_original = branch_logits.pop(0)
+        logits_vcd = branch_logits.pop(0) if use_vcd else None
+        logits_agla = branch_logits.pop(0) if use_agla else None
+    else:
+        def branch_forward(prepare_fn, branch):
+            prefix = _prefix_spec(model_kwargs, input_ids, [branch])
+            outputs = _branch_forward(
+                model, prepare_fn, input_ids, model_kwargs, prefix=prefix, last_logits_only=True,
+                **_exit_kwargs(branch_exit_layers, branch),
+            )
+            return outputs.logits[:, -1, :]
+
+        logits_original = branch_forward(model.prepare_inputs_for_generation, "original")
+        logits_vcd = branch_forward(model.prepare_inputs_for_generation_cd, "vcd") if use_vcd else None
+        logits_agla = branch_forward(model.prepare_inputs_for_generation_agla, "agla") if use_agla else None
+
+    return logits_original, logits_vcd, logits_agla
+
+
+def score_branch_logits(
+    logits_original,
+    logits_vcd,
+    logits_agla,
+    yes_token_ids,
+    no_token_ids,
+    cd_alpha=1.0,
+    cd_beta=0.1,
+    agla_alpha=1.0,
+    agla_beta=0.5,
+):
+    """
+    Yes/no decision from first-token branch logits.
+
+    Applies the three-way combination and plausibility cutoff of
+    sample_vcd_agla, then compares the combined probability mass of the
+    yes and no answer tokens.
+
+    Returns:
+        dict with
+            - p_yes: P(yes) under the combined distribution [B]
+            - p_no: P(no) under the combined distribution [B]
+            - labels: "yes" / "no" per row
+    """
+    final_logits = combine_branch_logits(
+        logits_original.float(),
+        logits_vcd.float() if logits_vcd is not None else None,
+        logits_agla.float() if logits_agla is not None else None,
+        cd_alpha=cd_alpha, cd_beta=cd_beta, agla_alpha=agla_alpha, agla_beta=agla_beta,
+    )
+    probs = nn.functional.softmax(final_logits, dim=-1)
+    p_yes = probs[:, yes_token_ids].sum(dim=-1)
+    p_no = probs[:, no_token_ids].sum(dim=-1)
+
+    # If the cutoff removed both answers, fall back to the original branch
+    fallback = logits_original[:, yes_token_ids].max(dim=-1).values >= logits_original[:, no_token_ids].max(dim=-1).values
+    is_yes = torch.where(p_yes == p_no, fallback, p_yes > p_no)
+    labels = ["yes" if y else "no" for y in is_yes.tolist()]
+
+    return {"p_yes": p_yes, "p_no": p_no, "labels": labels}
+
+
+def score_yes_no(
+    model,
+    input_ids,
+    yes_token_ids,
+    no_token_ids,
+    images=None,
+    images_cd=None,
+    images_agla=None,
+    attention_mask=None,
+    cd_alpha=1.0,
+    cd_beta=0.1,
+    agla_alpha=1.0,
+    agla_beta=0.5,
+    batch_branches=False,
+    prefix_cache=None,
+    prefix_cache_keys=None,
+    prefix_length=None,
+    branch_exit_layers=None,
+):
+    """
+    Score a binary (POPE-style) question with one prefill per branch.
+
+    The three-way combination and plausibility cutoff of sample_vcd_agla are
+    applied to the first-token logits only, so no autoregressive loop runs.
+    See first_token_branch_logits() and score_branch_logits() for the arguments.
+
+    Returns:
+        dict with
+            - p_yes: P(yes) under the combined distribution [B]
+            - p_no: P(no) under the combined distribution [B]
+            - labels: "yes" / "no" per row
+    """
+    branch_logits = first_token_branch_logits(
+        model, input_ids,
+        images=images, images_cd=images_cd, images_agla=images_agla,
+        attention_mask=attention_mask, batch_branches=batch_branches,
+        prefix_cache=prefix_cache, prefix_cache_keys=prefix_cache_keys, prefix_length=prefix_length,
+        branch_exit_layers=branch_exit_layers,
+    )
+    return score_branch_logits(
+        *branch_logits, yes_token_ids, no_token_ids,
+        cd_alpha=cd_alpha, cd_beta=cd_beta, agla_alpha=agla_alpha, agla_beta=agla_beta,
+    )
+
+
 def evolve_vcd_agla_sampling():
     """
     Replace transformers' default sampling function with VCD+AGLA combined version.
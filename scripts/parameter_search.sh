@@ -2,6 +2,13 @@
 # VCD + AGLA Combined Method - Parameter Grid Search
 #
 # This script performs grid search over key parameters to find optimal settings
+#
+# OFFLINE_SWEEP=1 records branch logits once per noise step and evaluates the
+# alpha/beta grid offline (sweep_recorded_logits.py) instead of re-running the
+# model for every combination. SEQUENTIAL_SWEEP=1 runs the grid on growing
+# question subsets (run_sequential_sweep.py) and drops clearly worse settings early.
+# SEARCH=1 replaces the grid by a successive-halving / TPE search with a
+# question-evaluation budget (run_param_search.py).
 
 set -e
 
@@ -27,6 +34,76 @@ NOISE_STEPS=(300 500 700)
 # Fixed AGLA beta for simplicity
 AGLA_BETA=0.5
 
+# Offline mode: record first-token branch logits once per noise step, then
+# sweep the alpha/beta grid over the recordings (yes/no scoring decision)
+if [ "${OFFLINE_SWEEP:-0}" = "1" ]; then
+    GT_FILE="${GT_FILE:-$QUESTION_FILE}"  # POPE question files carry the labels
+    stores=()
+    for noise_step in "${NOISE_STEPS[@]}"; do
+        store_dir="$OUTPUT_DIR/logits_noise${noise_step}"
+        echo "Recording branch logits: noise_step=$noise_step -> $store_dir"
+        python run_pope_combined.py \
+            --model-path $MODEL_PATH \
+            --image-folder $IMAGE_FOLDER \
+            --question-file $QUESTION_FILE \
+            --answers-file "$OUTPUT_DIR/scored_noise${noise_step}.jsonl" \
+            --use-vcd --use-agla \
+            --noise-step $noise_step \
+            --record-logits "$store_dir" \
+            2>&1 | tee "$OUTPUT_DIR/log_record_noise${noise_step}.txt"
+        stores+=("$store_dir")
+    done
+
+    python sweep_recorded_logits.py \
+        --gt-file $GT_FILE \
+        --store "${stores[@]}" \
+        --cd-alphas "${CD_ALPHAS[@]}" \
+        --cd-betas "${CD_BETAS[@]}" \
+        --agla-alphas "${AGLA_ALPHAS[@]}" \
+        --agla-betas $AGLA_BETA \
+        --output "$OUTPUT_DIR/offline_sweep.json"
+    exit 0
+fi
+
+# Search mode: successive halving with TPE proposals over continuous ranges of
+# all five parameters, limited to SEARCH_BUDGET question evaluations
+if [ "${SEARCH:-0}" = "1" ]; then
+    python run_param_search.py \
+        --runner llava \
+        --question-file $QUESTION_FILE \
+        --output-dir "$OUTPUT_DIR/search" \
+        --budget ${SEARCH_BUDGET:-20000} \
+        --resume \
+        -- \
+        --model-path $MODEL_PATH \
+        --image-folder $IMAGE_FOLDER \
+        --use-vcd --use-agla \
+        --temperature 1.0 \
+        2>&1 | tee -a "$OUTPUT_DIR/log_search.txt"
+    exit 0
+fi
+
+# Sequential mode: evaluate the grid in rounds on growing question subsets and
+# drop configurations that are significantly worse than the incumbent
+if [ "${SEQUENTIAL_SWEEP:-0}" = "1" ]; then
+    python run_sequential_sweep.py \
+        --runner llava \
+        --question-file $QUESTION_FILE \
+        --output-dir "$OUTPUT_DIR/sequential" \
+        --cd-alphas "${CD_ALPHAS[@]}" \
+        --cd-betas "${CD_BETAS[@]}" \
+        --agla-alphas "${AGLA_ALPHAS[@]}" \
+        --noise-steps "${NOISE_STEPS[@]}" \
+        -- \
+        --model-path $MODEL_PATH \
+        --image-folder $IMAGE_FOLDER \
+        --use-vcd --use-agla \
+        --agla-beta $AGLA_BETA \
+        --temperature 1.0 \
+        2>&1 | tee "$OUTPUT_DIR/log_sequential.txt"
+    exit 0
+fi
+
 total_runs=$((${#CD_ALPHAS[@]} * ${#CD_BETAS[@]} * ${#AGLA_ALPHAS[@]} * ${#NOISE_STEPS[@]}))
 current_run=0
 
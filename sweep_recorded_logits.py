@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Offline VCD + AGLA Parameter Sweep over Recorded Branch Logits
+
+Re-combines first-token branch logits recorded with
+``run_pope_combined.py --record-logits DIR`` for a whole
+cd_alpha / cd_beta / agla_alpha / agla_beta grid in one vectorized NumPy
+pass, and scores every grid point with the eval_pope metrics. The noise step
+is fixed per recording, so sweeping it takes one recording per step.
+
+Each grid point uses the yes/no decision of ``--score-yes-no``: the combined
+probability mass of the yes tokens against the no tokens after the
+plausibility cutoff.
+
+Usage:
+    python sweep_recorded_logits.py --gt-file pope_coco_random.jsonl \\
+        --store logits/noise300 logits/noise500 logits/noise700 \\
+        --cd-alphas 0.5 1.0 1.5 --cd-betas 0.05 0.1 0.2 --agla-alphas 0.5 1.0 1.5 \\
+        --output sweep_results.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+
+import numpy as np
+
+from eval_pope import compute_pope_metrics
+from utils.logit_store import load_logit_store
+
+
+def branch_coefficients(branches, cd_alpha, agla_alpha):
+    """
+    Coefficients of each stored branch in the combined logits.
+
+    Mirrors sample_vcd_agla.combine_branch_logits.
+    """
+    use_vcd = "vcd" in branches
+    use_agla = "agla" in branches
+    if use_vcd and use_agla:
+        weights = {"original": 1 + cd_alpha + agla_alpha, "vcd": -cd_alpha, "agla": agla_alpha}
+    elif use_vcd:
+        weights = {"original": 1 + cd_alpha, "vcd": -cd_alpha}
+    elif use_agla:
+        weights = {"original": 1.0, "agla": agla_alpha}
+    else:
+        weights = {"original": 1.0}
+    return [weights[name] for name in branches]
+
+
+def _logsumexp(x, axis):
+    """logsumexp that returns -inf (without warnings) for all -inf slices."""
+    x_max = x.max(axis=axis, keepdims=True)
+    safe_max = np.where(np.isfinite(x_max), x_max, 0.0)
+    with np.errstate(divide="ignore"):
+        out = np.log(np.exp(x - safe_max).sum(axis=axis, keepdims=True)) + safe_max
+    return out.squeeze(axis)
+
+
+def predict_yes(logits, num_main, num_yes, coefficients, betas):
+    """
+    Yes/no predictions for a chunk of grid points.
+
+    Args:
+        logits: float32 [N, n_branches, K] stored branch logits
+        num_main: Number of top-k / full-vocabulary columns before the answer tokens
+        num_yes: Number of yes-token columns (the no tokens follow them)
+        coefficients: [G, n_branches] combination weights
+        betas: [G] plausibility thresholds (unused for original-only stores)
+
+    Returns:
+        np.ndarray: bool [G, N], True where the combined answer is "yes"
+    """
+    answers = logits[:, :, num_main:]
+    original = answers[:, 0]
+
+    combined = np.einsum("gb,nbj->gnj", np.asarray(coefficients, dtype=np.float32), answers)
+    if logits.shape[1] > 1:
+        original_max = logits[:, 0, :num_main].max(axis=-1)
+        cutoff = np.log(np.asarray(betas, dtype=np.float32))[:, None] + original_max[None, :]
+        combined = np.where(original[None] < cutoff[:, :, None], -np.inf, combined)
+
+    lse_yes = _logsumexp(combined[:, :, :num_yes], axis=-1)
+    lse_no = _logsumexp(combined[:, :, num_yes:], axis=-1)
+
+    # Ties (including both answers cut off) fall back to the original branch
+    fallback = original[:, :num_yes].max(axis=-1) >= original[:, num_yes:].max(axis=-1)
+    return np.where(lse_yes == lse_no, fallback[None, :], lse_yes > lse_no)
+
+
+def sweep_store(store, gt_labels, total_questions, cd_alphas, cd_betas, agla_alphas, agla_betas, chunk_size=256):
+    """
+    Evaluate every grid point on one recorded store.
+
+    Axes that the store's branches do not use are collapsed to None
+    (e.g. agla_beta when VCD is on, since the cutoff then uses cd_beta).
+
+    Returns:
+        list of dicts: grid parameters plus eval_pope metrics
+    """
+    branches = store["branches"]
+    use_vcd = "vcd" in branches
+    use_agla = "agla" in branches
+    grid = list(itertools.product(
+        cd_alphas if use_vcd else [None],
+        cd_betas if use_vcd else [None],
+        agla_alphas if use_agla else [None],
+        agla_betas if use_agla and not use_vcd else [None],
+    ))
+
+    # Ground truth aligned with the stored rows
+    labels = [gt_labels.get(qid) for qid in store["question_ids"]]
+    is_yes = np.array([label == "yes" for label in labels])
+    is_no = np.array([label == "no" for label in labels])
+    unknown = total_questions - int(is_yes.sum() + is_no.sum())
+
+    logits = np.asarray(store["logits"], dtype=np.float32)
+    num_yes = len(store["yes_token_ids"])
+
+    results = []
+    for start in range(0, len(grid), chunk_size):
+        chunk = grid[start:start + chunk_size]
+        coefficients = [branch_coefficients(branches, cd_alpha or 0.0, agla_alpha or 0.0)
+                        for cd_alpha, _, agla_alpha, _ in chunk]
+        betas = [cd_beta if use_vcd else (agla_beta if use_agla else 1.0)
+                 for _, cd_beta, _, agla_beta in chunk]
+        pred_yes = predict_yes(logits, store["num_main_columns"], num_yes, coefficients, betas)
+
+        true_pos = (pred_yes & is_yes).sum(axis=1)
+        false_neg = (~pred_yes & is_yes).sum(axis=1)
+        true_neg = (~pred_yes & is_no).sum(axis=1)
+        false_pos = (pred_yes & is_no).sum(axis=1)
+
+        for i, (cd_alpha, cd_beta, agla_alpha, agla_beta) in enumerate(chunk):
+            metrics = compute_pope_metrics(
+                int(true_pos[i]), int(true_neg[i]), int(false_pos[i]), int(false_neg[i]),
+                int(true_pos[i] + false_pos[i]), unknown, total_questions,
+            )
+            results.append({
+                "noise_step": store["metadata"].get("noise_step"),
+                "cd_alpha": cd_alpha,
+                "cd_beta": cd_beta,
+                "agla_alpha": agla_alpha,
+                "agla_beta": agla_beta,
+                **metrics,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline VCD+AGLA parameter sweep over recorded branch logits")
+    parser.add_argument("--gt-file", type=str, required=True, help="POPE ground truth file (JSONL)")
+    parser.add_argument("--store", type=str, nargs="+", required=True,
+                        help="Logit store directories (one per noise step)")
+    parser.add_argument("--cd-alphas", type=float, nargs="+", default=[0.5, 1.0, 1.5])
+    parser.add_argument("--cd-betas", type=float, nargs="+", default=[0.05, 0.1, 0.2])
+    parser.add_argument("--agla-alphas", type=float, nargs="+", default=[0.5, 1.0, 1.5])
+    parser.add_argument("--agla-betas", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--sort-by", type=str, default="f1", choices=["f1", "accuracy", "precision", "recall"])
+    parser.add_argument("--top", type=int, default=10, help="Number of best settings to print")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Grid points per vectorized pass")
+    parser.add_argument("--output", type=str, default=None, help="Path to save all results (JSON)")
+    args = parser.parse_args()
+
+    gt_data = [json.loads(q) for q in open(os.path.expanduser(args.gt_file), "r")]
+    gt_labels = {q["question_id"]: q["label"].lower().strip() for q in gt_data}
+
+    results = []
+    for store_path in args.store:
+        store = load_logit_store(store_path)
+        store_results = sweep_store(
+            store, gt_labels, len(gt_data),
+            args.cd_alphas, args.cd_betas, args.agla_alphas, args.agla_betas,
+            chunk_size=args.chunk_size,
+        )
+        print(f"{store_path}: {len(store_results)} settings over {len(store['question_ids'])} questions "
+              f"(branches: {', '.join(store['branches'])})")
+        results.extend(store_results)
+
+    results.sort(key=lambda r: r[args.sort_by], reverse=True)
+
+    print("=" * 90)
+    print(f"{'noise':>6} {'cd_a':>6} {'cd_b':>6} {'agla_a':>7} {'agla_b':>7} "
+          f"{'Acc':>8} {'Prec':>8} {'Rec':>8} {'F1':>8} {'Yes':>8}")
+    print("-" * 90)
+    fmt = lambda v: "-" if v is None else f"{v:g}"
+    for r in results[:args.top]:
+        print(f"{fmt(r['noise_step']):>6} {fmt(r['cd_alpha']):>6} {fmt(r['cd_beta']):>6} "
+              f"{fmt(r['agla_alpha']):>7} {fmt(r['agla_beta']):>7} "
+              f"{r['accuracy']:8.4f} {r['precision']:8.4f} {r['recall']:8.4f} {r['f1']:8.4f} "
+              f"{r['yes_proportion']:8.4f}")
+    print("=" * 90)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n✓ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -99,6 +99,38 @@ def test_logits_combination():
         final_combined = combined.masked_fill(logits_original < cutoff, -float("inf"))
         
         assert final_combined.shape == logits_original.shape, "Combined shape mismatch!"
+        
+        # The shared helper used by sample_vcd_agla / score_yes_no must agree
+        from sample_vcd_agla import combine_branch_logits
+        helper_combined = combine_branch_logits(
+            logits_original, logits_vcd, logits_agla,
+            cd_alpha=cd_alpha, cd_beta=cd_beta, agla_alpha=agla_alpha, agla_beta=agla_beta
+        )
+        assert torch.equal(helper_combined, final_combined), "combine_branch_logits mismatch!"
+        
+        # The candidate-set kernel keeps exactly the plausible tokens, with the same logits
+        from sample_vcd_agla import sparse_candidate_logits
+        candidate_ids, candidate_logits = sparse_candidate_logits(
+            logits_original, logits_vcd, logits_agla,
+            cd_alpha=cd_alpha, cd_beta=cd_beta, agla_alpha=agla_alpha, agla_beta=agla_beta, max_candidates=4096
+        )
+        kept = candidate_logits != -float('inf')
+        assert kept.sum() == (final_combined != -float('inf')).sum(), "Sparse candidate set mismatch!"
+        assert torch.equal(candidate_logits[kept], final_combined.gather(-1, candidate_ids)[kept]), \
+            "Sparse logits mismatch!"
+        assert sparse_candidate_logits(logits_original, logits_vcd, max_candidates=8) is None, \
+            "Too small a candidate set must fall back to the full vocabulary!"
+        
+        # A step that skips both branches passes None for them and samples from the original logits
+        assert torch.equal(combine_branch_logits(logits_original, None, None), logits_original), \
+            "Fully skipped step must equal the original logits!"
+        assert sparse_candidate_logits(logits_original, None, None) is None, \
+            "Fully skipped step must take the full-vocabulary path!"
+        # Skipping VCD only leaves the AGLA-only combination
+        assert torch.equal(
+            combine_branch_logits(logits_original, None, logits_agla, agla_alpha=agla_alpha, agla_beta=agla_beta),
+            final_agla,
+        ), "VCD-skipped step must equal the AGLA-only combination!"
         valid_combined = final_combined[final_combined != -float('inf')]
         logger.info(f"Combined: range [{valid_combined.min():.3f}, {valid_combined.max():.3f}]")
         
@@ -193,6 +225,213 @@ def test_file_structure():
         return False
 
 
+def test_prefix_cache():
+    """Test prefix KV cache lookup and LRU eviction"""
+    logger.info("=" * 60)
+    logger.info("Test 5: Prefix KV Cache")
+    logger.info("=" * 60)
+    
+    try:
+        from utils.prefix_cache import PrefixKVCache
+        
+        # Two layers of (key, value) [B, H, S, D] in fp16: 2 * 2 * 1*2*4*8 * 2 bytes = 512 bytes
+        def make_past():
+            return tuple((torch.randn(1, 2, 4, 8).half(), torch.randn(1, 2, 4, 8).half()) for _ in range(2))
+        
+        prefix_ids = torch.arange(4).unsqueeze(0)
+        cache = PrefixKVCache(max_bytes=1024)
+        key_a = PrefixKVCache.make_key("llava", "original", "img_a")
+        key_b = PrefixKVCache.make_key("llava", "original", "img_b")
+        key_c = PrefixKVCache.make_key("llava", "vcd", "img_a", noise_seed=55, noise_step=500)
+        
+        past_a = make_past()
+        cache.put(key_a, prefix_ids, past_a)
+        cache.put(key_b, prefix_ids, make_past())
+        assert cache.nbytes == 1024, f"Unexpected cache size {cache.nbytes}"
+        
+        # Hit returns the stored tensors; a different prefix is a miss
+        assert cache.get(key_a, prefix_ids) is past_a, "Expected a cache hit"
+        assert cache.get(key_a, prefix_ids + 1) is None, "Prefix mismatch should miss"
+        
+        # key_a was used most recently, so key_b is evicted
+        cache.put(key_c, prefix_ids, make_past())
+        assert key_b not in cache and key_a in cache and key_c in cache, "LRU eviction failed"
+        assert cache.stats()["evictions"] == 1
+        logger.info(f"Cache stats: {cache.stats()}")
+        
+        logger.info("✓ Prefix KV cache test PASSED")
+        return True
+        
+    except Exception as e:
+        logger.error(f"✗ Prefix KV cache test FAILED: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_agla_mask_cache():
+    """Test AGLA mask cache round trip and question normalization"""
+    logger.info("=" * 60)
+    logger.info("Test 6: AGLA Mask Cache")
+    logger.info("=" * 60)
+    
+    try:
+        import tempfile
+        import numpy as np
+        from utils.agla_cache import AGLAMaskCache
+        
+        mask = np.random.rand(384, 384) > 0.3
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = AGLAMaskCache(cache_dir)
+            key = AGLAMaskCache.make_key("img_hash", "Is there a dog in the image?", "large", 6)
+            
+            # Questions that reach BLIP as the same text share a key
+            assert key == AGLAMaskCache.make_key("img_hash", "is there a  dog in the image", "large", 6)
+            assert key != AGLAMaskCache.make_key("img_hash", "Is there a dog in the image?", "base", 6)
+            
+            assert cache.get(key) is None, "Empty cache should miss"
+            cache.put(key, mask, 0.42)
+            cached_mask, ratio = cache.get(key)
+            assert np.array_equal(cached_mask, mask), "Mask changed in the round trip"
+            assert abs(ratio - 0.42) < 1e-12
+        
+        logger.info("✓ AGLA mask cache test PASSED")
+        return True
+        
+    except Exception as e:
+        logger.error(f"✗ AGLA mask cache test FAILED: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_question_seeding():
+    """Test that per-question generators do not depend on the question order"""
+    logger.info("=" * 60)
+    logger.info("Test 7: Per-question Seeding")
+    logger.info("=" * 60)
+    
+    try:
+        from utils.seeding import question_seed, question_generator, sampling_generators
+        from utils.vcd_add_noise import add_diffusion_noise
+        from sample_vcd_agla import _sample_tokens
+        
+        assert question_seed(55, 3, "vcd") == question_seed(55, 3, "vcd"), "Seed is not deterministic"
+        assert question_seed(55, 3, "vcd") != question_seed(55, 3, "sample"), "Branches share a seed"
+        
+        # The noise of a question does not depend on what was drawn before it
+        image = torch.zeros(3, 8, 8)
+        noise_a = add_diffusion_noise(image, 500, generator=question_generator(55, 3, "vcd"))
+        torch.randn(100)
+        noise_b = add_diffusion_noise(image, 500, generator=question_generator(55, 3, "vcd"))
+        assert torch.equal(noise_a, noise_b), "VCD noise depends on the global RNG"
+        
+        # A row samples the same tokens alone and inside a batch
+        probs = torch.softmax(torch.randn(3, 50), dim=-1)
+        batched = _sample_tokens(probs, sampling_generators(55, [7, 8, 9]))
+        alone = _sample_tokens(probs[1:2], sampling_generators(55, [8]))
+        assert batched[1] == alone[0], "Sampling depends on the batch composition"
+        
+        logger.info("✓ Per-question seeding test PASSED")
+        return True
+        
+    except Exception as e:
+        logger.error(f"✗ Per-question seeding test FAILED: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_static_kv_cache():
+    """Test that the static KV cache matches concatenation and reuses its buffers"""
+    logger.info("=" * 60)
+    logger.info("Test 8: Static KV Cache")
+    logger.info("=" * 60)
+    
+    try:
+        from utils.static_kv_cache import QuantizedKVCache, StaticKVCache
+        
+        cache = StaticKVCache(max_new_tokens=4, seq_dim=2)
+        for question in range(2):
+            cache.reset()
+            keys = torch.randn(1, 2, 5, 8)
+            k, v = cache.update(keys, keys + 1, 0)
+            assert torch.equal(k, keys) and cache, "Prefill not cached"
+            # Decode steps append in place, past the reserve the buffer grows
+            for step in range(6):
+                new = torch.randn(1, 2, 1, 8)
+                keys = torch.cat([keys, new], dim=2)
+                k, v = cache.update(new, new + 1, 0)
+                assert torch.equal(k, keys) and torch.equal(v, keys + 1), "Static cache differs from torch.cat"
+            assert cache.get_seq_length() == 11
+        assert cache.allocations == 2, f"Expected 2 allocations (first use + one growth), got {cache.allocations}"
+        
+        cache.reset()
+        assert not cache, "A reset cache must read as empty"
+        
+        # int8 cache: reads are within half a quantization step of each head's values
+        int8_cache = QuantizedKVCache(max_new_tokens=4, seq_dim=2)
+        keys = torch.randn(1, 2, 5, 8)
+        int8_cache.update(keys, keys, 0)
+        new = torch.randn(1, 2, 1, 8)
+        keys = torch.cat([keys, new], dim=2)
+        k, v = int8_cache.update(new, new, 0)
+        half_step = keys.abs().amax(dim=-1, keepdim=True) / 254
+        assert k.shape == keys.shape and ((k - keys).abs() <= half_step * 1.001).all(), "int8 error above half a step"
+        full_cache = StaticKVCache(max_new_tokens=4, seq_dim=2)
+        full_cache.update(keys, keys, 0)
+        assert int8_cache.nbytes() < full_cache.nbytes(), "int8 cache is not smaller"
+        
+        logger.info("✓ Static KV cache test PASSED")
+        return True
+        
+    except Exception as e:
+        logger.error(f"✗ Static KV cache test FAILED: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_prior_cache():
+    """Test language-prior logits cache namespaces and LRU eviction"""
+    logger.info("=" * 60)
+    logger.info("Test 9: Language Prior Cache")
+    logger.info("=" * 60)
+    
+    try:
+        from utils.prior_cache import PriorLogitsCache
+        
+        # fp32 logits over a vocabulary of 64: 256 bytes per entry
+        cache = PriorLogitsCache(max_bytes=512)
+        text = PriorLogitsCache.make_key("llava", "text")
+        noise = PriorLogitsCache.make_key("llava", "noise", noise_seed=55)
+        prompt = torch.tensor([1, 5, 7])
+        
+        logits = torch.randn(64)
+        cache.put(text, prompt, logits)
+        assert cache.get(text, prompt.clone()) is logits, "Expected a cache hit"
+        assert cache.get(noise, prompt) is None, "Prior modes must not share entries"
+        assert cache.get(text, torch.tensor([1, 5, 7, 9])) is None, "Generated tokens are part of the key"
+        
+        # text/prompt was used most recently, so the second entry is evicted
+        cache.put(text, torch.tensor([1, 5]), torch.randn(64))
+        cache.get(text, prompt)
+        cache.put(noise, prompt, torch.randn(64))
+        assert len(cache) == 2 and cache.nbytes == 512, f"Unexpected cache size {cache.nbytes}"
+        assert cache.get(text, torch.tensor([1, 5])) is None, "LRU eviction failed"
+        assert cache.stats()["evictions"] == 1
+        logger.info(f"Cache stats: {cache.stats()}")
+        
+        logger.info("✓ Language prior cache test PASSED")
+        return True
+        
+    except Exception as e:
+        logger.error(f"✗ Language prior cache test FAILED: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
 def run_basic_tests():
     """Run basic tests"""
     logger.info("\n" + "=" * 60)
@@ -214,6 +453,21 @@ def run_basic_tests():
     results['sampling_function'] = test_sampling_function()
     print()
     
+    results['prefix_cache'] = test_prefix_cache()
+    print()
+    
+    results['agla_mask_cache'] = test_agla_mask_cache()
+    print()
+    
+    results['question_seeding'] = test_question_seeding()
+    print()
+    
+    results['static_kv_cache'] = test_static_kv_cache()
+    print()
+    
+    results['prior_cache'] = test_prior_cache()
+    print()
+    
     # Summary
     logger.info("=" * 60)
     logger.info("Test Summary")
@@ -0,0 +1,333 @@
+"""
+AGLA Mask Cache Module
+Content-addressed disk cache of AGLA keep-masks
+
+The AGLA mask depends only on the image, the question and the BLIP-ITM model
+(variant, precision, GradCAM block), not on the LVLM being evaluated, so one
+GradCAM + ITC pass per (image, question) can serve LLaVA-1.5, LLaVA-1.6 and
+Qwen-VL runs alike. Masks are stored bit-packed (384×384 → 18 KB) together
+with the masking ratio.
+
+AGLAMaskProvider consults the cache first and only loads BLIP-ITM on the
+first miss, so a fully cached run never imports LAVIS. Misses go through
+BLIPSaliency, which encodes each image once for all its questions. Its
+augment_pixel_values() applies the mask straight to the LVLM's preprocessed
+pixel tensor instead of going through PIL and a second preprocessing.
+"""
+
+import hashlib
+import json
+import os
+import re
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+from .blip_saliency import BLIPSaliency
+
+logger = logging.getLogger(__name__)
+
+MASK_SIZE = 384
+
+
+def normalize_question(question):
+    """
+    Normalize a question the way BLIP's caption processor does.
+
+    Lowercases, replaces the punctuation BLIP strips with spaces and collapses
+    whitespace, so questions that reach BLIP-ITM as the same text share a key.
+    """
+    question = re.sub(r"([.!\"()*#:;~])", " ", question.lower())
+    return " ".join(question.split())
+
+
+def apply_agla_mask(tensor_image, mask):
+    """
+    Apply an AGLA keep-mask to an image.
+
+    Args:
+        tensor_image (torch.Tensor): Image tensor [3, 384, 384] in [0, 1]
+        mask (np.ndarray): Bool keep-mask [384, 384] (True = keep)
+
+    Returns:
+        PIL.Image: Augmented image with the masked-out pixels set to black
+    """
+    new_image = tensor_image * torch.from_numpy(np.asarray(mask)).to(tensor_image.dtype)
+    unloader = transforms.ToPILImage()
+    return unloader(new_image)
+
+
+def center_crop_box(width, height):
+    """
+    Region of a centered square crop in normalized full-image coordinates.
+
+    This is the view of CLIP's preprocessing (shortest-edge resize followed by
+    a center crop of the same size).
+
+    Returns:
+        tuple: (x0, y0, x1, y1) in [0, 1]
+    """
+    if width >= height:
+        half = height / (2 * width)
+        return (0.5 - half, 0.0, 0.5 + half, 1.0)
+    half = width / (2 * height)
+    return (0.0, 0.5 - half, 1.0, 0.5 + half)
+
+
+def mask_pixel_values(pixel_values, masks, image_mean, image_std, boxes=None):
+    """
+    Apply AGLA keep-masks directly to preprocessed (normalized) pixel values.
+
+    Masks are in full-image coordinates (the 384×384 squashed view BLIP sees);
+    they are cropped to each sample's view and resized (nearest) to the pixel
+    grid. Masked pixels get the normalized value of black, i.e. what the
+    processor produces for a zeroed pixel.
+
+    Args:
+        pixel_values (torch.Tensor): Normalized images [B, 3, H, W]
+        masks: Bool keep-masks [B, h, w] or [h, w] (tensor or np.ndarray)
+        image_mean / image_std: Per-channel normalization of the processor
+        boxes (list): Per-sample (x0, y0, x1, y1) view of the pixel tensor in
+            normalized full-image coordinates (None = whole image, as for a
+            squash resize)
+
+    Returns:
+        torch.Tensor: Masked pixel values, same shape / dtype / device
+    """
+    batch_size, _, height, width = pixel_values.shape
+    masks = torch.as_tensor(masks, device=pixel_values.device)
+    if masks.dim() == 2:
+        masks = masks.unsqueeze(0).expand(batch_size, -1, -1)
+
+    keep = []
+    for i in range(batch_size):
+        mask = masks[i]
+        if boxes is not None and boxes[i] is not None:
+            x0, y0, x1, y1 = boxes[i]
+            mask_h, mask_w = mask.shape
+            mask = mask[round(y0 * mask_h):round(y1 * mask_h), round(x0 * mask_w):round(x1 * mask_w)]
+        mask = F.interpolate(mask[None, None].float(), size=(height, width), mode="nearest")[0, 0]
+        keep.append(mask > 0.5)
+    keep = torch.stack(keep).unsqueeze(1)
+
+    fill = -torch.tensor(image_mean) / torch.tensor(image_std)
+    fill = fill.to(device=pixel_values.device, dtype=pixel_values.dtype).view(1, -1, 1, 1)
+    return torch.where(keep, pixel_values, fill)
+
+
+class AGLAMaskCache:
+    """
+    Content-addressed store of AGLA masks under ``cache_dir``.
+
+    Each entry is ``<cache_dir>/<key[:2]>/<key>.npz`` holding the packed mask
+    and the ratio. Writes go through a temporary file and an atomic rename,
+    so concurrent runs can share one directory.
+
+    Args:
+        cache_dir (str): Cache directory (created if missing)
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(image_hash, question, blip_variant, block_num):
+        """
+        Cache key of a mask: SHA-1 over image hash, normalized question,
+        BLIP-ITM variant and GradCAM block.
+        """
+        payload = json.dumps([image_hash, normalize_question(question), blip_variant, int(block_num)])
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        """
+        Load a cached mask.
+
+        Returns:
+            (mask, ratio) with mask a bool np.ndarray [384, 384], or None on a miss
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with np.load(path) as entry:
+                shape = tuple(entry["shape"])
+                mask = np.unpackbits(entry["mask"], count=int(np.prod(shape))).reshape(shape).astype(bool)
+                ratio = float(entry["ratio"])
+        except Exception as e:
+            logger.warning(f"Unreadable AGLA mask cache entry {path}: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return mask, ratio
+
+    def put(self, key, mask, ratio):
+        """Store a mask (bool [H, W]) and its ratio."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mask = np.asarray(mask, dtype=bool)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, mask=np.packbits(mask.reshape(-1)), shape=np.array(mask.shape), ratio=np.float64(ratio))
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        """Hit / miss counters."""
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class AGLAMaskProvider:
+    """
+    AGLA masks from the disk cache, computing misses with BLIP-ITM.
+
+    BLIP-ITM is loaded on the first cache miss (or the first call when no
+    cache is configured).
+
+    Args:
+        cache (AGLAMaskCache): Mask cache, or None to always compute
+        blip_variant (str): BLIP-ITM model type ("large" or "base")
+        device (str): Device for BLIP-ITM (default: cuda if available)
+        half (bool): Run BLIP-ITM in fp16
+        block_num (int): BLIP text-encoder layer used for GradCAM
+        device_masks (bool): Compute masks with the device-resident pipeline
+            (compute_agla_mask_tensor); its masks are cached separately
+    """
+
+    def __init__(self, cache=None, blip_variant="large", device=None, half=False, block_num=6, device_masks=False):
+        self.cache = cache
+        self.blip_variant = blip_variant
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.half = half
+        self.block_num = block_num
+        self.device_masks = device_masks
+        self.model_itm = None
+        self.vis_processors = None
+        self.text_processors = None
+        self.saliency = None
+
+    @property
+    def variant_id(self):
+        """BLIP-ITM variant including precision and mask pipeline (part of the cache key)."""
+        variant = f"{self.blip_variant}-fp16" if self.half else self.blip_variant
+        return f"{variant}-device" if self.device_masks else variant
+
+    def mask_id(self, image_hash, question):
+        """Identifier of the mask for (image, question), usable in other cache keys."""
+        return AGLAMaskCache.make_key(image_hash, question, self.variant_id, self.block_num)
+
+    def _load_blip(self):
+        from lavis.models import load_model_and_preprocess
+
+        logger.info(f"Loading BLIP-ITM ({self.variant_id}) for AGLA")
+        self.model_itm, self.vis_processors, self.text_processors = load_model_and_preprocess(
+            "blip_image_text_matching", self.blip_variant, device=self.device, is_eval=True
+        )
+        if self.half:
+            self.model_itm = self.model_itm.half()
+        self.model_itm.eval()
+        self.saliency = BLIPSaliency(self.model_itm, block_num=self.block_num)
+
+    def _compute(self, raw_image, question, image_hash=None):
+        """
+        Run BLIP-ITM GradCAM + ITC; returns (mask, ratio) in the pipeline's native type.
+
+        The ViT encoding of the image is reused across questions with the same
+        ``image_hash`` (see utils.blip_saliency).
+        """
+        if self.model_itm is None:
+            self._load_blip()
+        from .augmentation import attention_maps, keep_masks, mask_from_gradcam
+
+        image_blip = None
+        if image_hash is None or not self.saliency.has_image(image_hash):
+            image_blip = self.vis_processors["eval"](raw_image).unsqueeze(0).to(self.device)
+            if self.half:
+                image_blip = image_blip.half()
+        question_blip = self.text_processors["eval"](question)
+        gradcams, ratios = self.saliency.saliency(image_blip, question_blip, image_hash)
+
+        if self.device_masks:
+            return keep_masks(attention_maps(gradcams), ratios)[0], ratios[0]
+        return mask_from_gradcam(gradcams[0], ratios[0], raw_image), ratios[0]
+
+    def get_mask(self, raw_image, question, image_hash=None):
+        """
+        Keep-mask and ratio for (image, question).
+
+        Args:
+            raw_image (PIL.Image): Original image
+            question (str): Question text
+            image_hash (str): Content hash of the image; required for caching
+
+        Returns:
+            (mask, ratio): bool mask [384, 384] and the masking ratio. The mask
+            is an np.ndarray, or a tensor on the BLIP device when
+            ``device_masks`` is set.
+        """
+        key = None
+        if self.cache is not None and image_hash is not None:
+            key = self.mask_id(image_hash, question)
+            cached = self.cache.get(key)
+            if cached is not None:
+                mask, ratio = cached
+                return (torch.from_numpy(mask).to(self.device) if self.device_masks else mask), ratio
+
+        mask, ratio = self._compute(raw_image, question, image_hash)
+        if key is not None:
+            self.cache.put(key, mask.cpu().numpy() if torch.is_tensor(mask) else mask, ratio)
+        return mask, ratio
+
+    def augment(self, raw_image, question, image_hash=None, mask=None):
+        """
+        AGLA augmented image for (image, question).
+
+        A precomputed ``mask`` (e.g. from utils.prefetch) skips the lookup.
+
+        Returns:
+            PIL.Image: The 384×384 image with low-attention pixels masked out
+        """
+        if mask is None:
+            mask, _ = self.get_mask(raw_image, question, image_hash)
+        if torch.is_tensor(mask):
+            mask = mask.cpu().numpy()
+        tensor_image = transforms.ToTensor()(raw_image.resize((MASK_SIZE, MASK_SIZE)))
+        return apply_agla_mask(tensor_image, mask)
+
+    def augment_pixel_values(self, pixel_values, raw_image, question, image_mean, image_std,
+                             image_hash=None, center_crop=False, mask=None):
+        """
+        AGLA branch input built from the already-preprocessed original image.
+
+        Skips the PIL round trip and second preprocessing of augment(): the
+        mask is applied to ``pixel_values`` on their device.
+
+        Args:
+            pixel_values (torch.Tensor): Preprocessed original image [B, 3, H, W]
+            raw_image (PIL.Image): Original image (for BLIP-ITM and the crop geometry)
+            question (str): Question text
+            image_mean / image_std: Normalization of the LVLM's image processor
+            image_hash (str): Content hash of the image; required for caching
+            center_crop (bool): The processor center-crops (CLIP); otherwise
+                it resizes the whole image (Qwen-VL)
+            mask: Precomputed keep-mask (skips the lookup)
+
+        Returns:
+            torch.Tensor: Masked pixel values [B, 3, H, W]
+        """
+        if mask is None:
+            mask, _ = self.get_mask(raw_image, question, image_hash)
+        box = center_crop_box(*raw_image.size) if center_crop else None
+        return mask_pixel_values(
+            pixel_values, mask, image_mean, image_std, boxes=[box] * pixel_values.shape[0]
+        )
@@ -14,9 +14,9 @@ if _vcd_exp_path in sys.path:
     sys.path.remove(_vcd_exp_path)
 
 import torch
+import torch.nn.functional as F
 import numpy as np
 from lavis.common.gradcam import getAttMap
-from torchvision import transforms
 from lavis.models.blip_models.blip_image_text_matching import compute_gradcam
 import logging
 
@@ -24,37 +24,34 @@ import logging
 if _vcd_exp_path not in sys.path:
     sys.path.insert(0, _vcd_exp_path)
 
+from .agla_cache import apply_agla_mask
+
 logger = logging.getLogger(__name__)
 
 
-def augmentation(image, question, tensor_image, model, tokenized_text, raw_image):
+def compute_agla_mask(image, question, model, tokenized_text, raw_image, block_num=6):
     """
-    Generate augmented image based on GradCAM attention from BLIP-ITM model.
+    Compute the AGLA keep-mask from BLIP-ITM GradCAM attention.
     
     This function:
     1. Computes GradCAM attention map using BLIP-ITM
     2. Calculates ITC score to determine masking ratio
-    3. Masks out low-attention regions
-    4. Returns augmented PIL image
+    3. Keeps the highest-attention pixels, masking the ``ratio`` fraction below them
+    
+    The mask depends only on the image, the question and the BLIP-ITM model,
+    so it can be cached and applied for any LVLM (see utils.agla_cache).
     
     Args:
         image (torch.Tensor): Preprocessed image for BLIP-ITM [1, 3, H, W]
         question (str): Text question/prompt
-        tensor_image (torch.Tensor): Image tensor [3, 384, 384] for masking
         model: BLIP-ITM model
         tokenized_text: Tokenized text from BLIP tokenizer
         raw_image (PIL.Image): Original PIL image
+        block_num (int): BLIP text-encoder layer used for GradCAM
         
     Returns:
-        PIL.Image: Augmented image with attention-based masking
-        
-    Example:
-        >>> from lavis.models import load_model_and_preprocess
-        >>> model_itm, vis_processors, text_processors = load_model_and_preprocess(
-        ...     "blip_image_text_matching", "large", device="cuda", is_eval=True
-        ... )
-        >>> augmented = augmentation(image_blip, question, tensor_img, 
-        ...                          model_itm, tokenized_text, raw_img)
+        tuple: (mask, ratio) with mask a bool np.ndarray [384, 384]
+               (True = keep) and ratio the ITC-derived masking ratio
     """
     try:
         # Compute GradCAM
@@ -64,7 +61,7 @@ def augmentation(image, question, tensor_image, model, tokenized_text, raw_image
                 visual_input=image,
                 text_input=question,
                 tokenized_text=tokenized_text,
-                block_num=6
+                block_num=block_num
             )
         
         # Extract gradcam values
@@ -76,47 +73,193 @@ def augmentation(image, question, tensor_image, model, tokenized_text, raw_image
         ratio = 1 - itc_score / 2
         ratio = min(ratio, 1 - 10**(-5))
         
-        # Resize and normalize image
-        resized_img = raw_image.resize((384, 384))
-        norm_img = np.float32(resized_img) / 255
-        gradcam = gradcams1.reshape(24, 24)
-
-        # Get attention map
-        avg_gradcam = getAttMap(norm_img, gradcam.cpu().numpy(), blur=True, overlap=False)
-        temp, _ = torch.sort(torch.tensor(avg_gradcam).reshape(-1), descending=True)
-        cam1 = torch.tensor(avg_gradcam).unsqueeze(2)
-        cam = torch.cat([cam1, cam1, cam1], dim=2)
-
-        # Handle numerical stability: check for inf/nan and clamp ratio
+        # Handle numerical stability: clamp ratio to a valid range
         ratio = float(ratio.item() if torch.is_tensor(ratio) else ratio)
-        ratio = max(0.0, min(ratio, 0.99999))  # Clamp to valid range
+        ratio = max(0.0, min(ratio, 0.99999))
+        
+        mask = mask_from_gradcam(gradcams1.reshape(24, 24), ratio, raw_image)
+        logger.debug(f"Computed AGLA mask with masking ratio {ratio:.3f}")
+        return mask, ratio
+        
+    except Exception as e:
+        logger.error(f"Error in augmentation: {e}")
+        raise
+
+
+def mask_from_gradcam(gradcam, ratio, raw_image):
+    """
+    CPU keep-mask from a GradCAM map (the original AGLA thresholding).
+    
+    Args:
+        gradcam (torch.Tensor): GradCAM map [24, 24]
+        ratio (float): Masking ratio
+        raw_image (PIL.Image): Original PIL image
+        
+    Returns:
+        np.ndarray: Bool keep-mask [384, 384] (True = keep)
+    """
+    # Resize and normalize image
+    resized_img = raw_image.resize((384, 384))
+    norm_img = np.float32(resized_img) / 255
+
+    # Get attention map
+    avg_gradcam = getAttMap(norm_img, gradcam.cpu().numpy(), blur=True, overlap=False)
+    temp, _ = torch.sort(torch.tensor(avg_gradcam).reshape(-1), descending=True)
+    cam = torch.tensor(avg_gradcam)
+
+    # Calculate index safely
+    total_pixels = 384 * 384
+    mask_index = int(total_pixels * ratio)
+    mask_index = min(mask_index, total_pixels - 1)  # Ensure within bounds
+
+    # Check if temp has valid values
+    if torch.isinf(temp).any() or torch.isnan(temp).any():
+        # Fallback: use median threshold
+        logger.warning("Invalid values in gradcam, using median threshold")
+        threshold = torch.median(temp)
+    else:
+        threshold = temp[mask_index]
+
+    return (cam >= threshold).numpy()
+
+
+def _gaussian_kernel1d(sigma, device, dtype, truncate=4.0):
+    """1-D Gaussian kernel with scipy.ndimage's default truncation."""
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, device=device, dtype=dtype)
+    kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def gaussian_blur(maps, sigma):
+    """
+    Separable Gaussian blur of attention maps on their device.
+    
+    Args:
+        maps (torch.Tensor): Maps [B, H, W]
+        sigma (float): Standard deviation in pixels
+        
+    Returns:
+        torch.Tensor: Blurred maps [B, H, W] (reflect padding)
+    """
+    kernel = _gaussian_kernel1d(sigma, maps.device, maps.dtype)
+    radius = kernel.numel() // 2
+    x = maps.unsqueeze(1)
+    x = F.conv2d(F.pad(x, (radius, radius, 0, 0), mode="reflect"), kernel.view(1, 1, 1, -1))
+    x = F.conv2d(F.pad(x, (0, 0, radius, radius), mode="reflect"), kernel.view(1, 1, -1, 1))
+    return x.squeeze(1)
+
+
+def attention_maps(gradcams, size=384, blur=True):
+    """
+    Device-resident counterpart of lavis' getAttMap(blur=True, overlap=False).
+    
+    Upsamples [B, 24, 24] GradCAM maps bicubically to size×size and blurs them
+    with sigma = 0.02 * size. getAttMap's min-max normalizations are affine
+    and monotonic, so they do not change which pixels pass a quantile
+    threshold and are skipped.
+    """
+    maps = F.interpolate(
+        gradcams.unsqueeze(1).float(), size=(size, size), mode="bicubic", align_corners=False
+    ).squeeze(1)
+    if blur:
+        maps = gaussian_blur(maps, 0.02 * size)
+    return maps
 
-        # Calculate index safely
-        total_pixels = 384 * 384
-        mask_index = int(total_pixels * ratio)
-        mask_index = min(mask_index, total_pixels - 1)  # Ensure within bounds
 
-        # Check if temp has valid values
-        if torch.isinf(temp).any() or torch.isnan(temp).any():
-            # Fallback: use median threshold
+def keep_masks(cams, ratios):
+    """
+    Keep-masks from attention maps without a full sort.
+    
+    For each map the threshold is the value at index int(N * ratio) of the
+    descending order, i.e. the (N - index)-th smallest value, found with
+    kthvalue.
+    
+    Args:
+        cams (torch.Tensor): Attention maps [B, H, W]
+        ratios (list): Masking ratio per map
+        
+    Returns:
+        torch.Tensor: Bool keep-masks [B, H, W]
+    """
+    flat = cams.reshape(cams.shape[0], -1)
+    total_pixels = flat.shape[1]
+    masks = []
+    for cam, ratio in zip(flat, ratios):
+        mask_index = min(int(total_pixels * ratio), total_pixels - 1)
+        if not torch.isfinite(cam).all():
             logger.warning("Invalid values in gradcam, using median threshold")
-            threshold = torch.median(temp)
+            threshold = torch.median(cam)
         else:
-            threshold = temp[mask_index]
+            threshold = cam.kthvalue(total_pixels - mask_index).values
+        masks.append(cam >= threshold)
+    return torch.stack(masks).reshape(cams.shape)
+
 
-        # Apply mask
-        mask = torch.where(cam < threshold, 0, 1)
-        new_image = tensor_image.permute(1, 2, 0) * mask
+def compute_agla_mask_tensor(image, question, model, tokenized_text, block_num=6, size=384):
+    """
+    Device-resident, batched version of compute_agla_mask.
+    
+    GradCAM upsampling, blur and thresholding stay on the BLIP device; no
+    NumPy / PIL conversion happens.
+    
+    Args:
+        image (torch.Tensor): Preprocessed images for BLIP-ITM [B, 3, H, W]
+        question (str or list): Question(s), one per image
+        model: BLIP-ITM model
+        tokenized_text: Tokenized question(s) from the BLIP tokenizer
+        block_num (int): BLIP text-encoder layer used for GradCAM
+        size (int): Mask resolution
         
-        # Convert back to PIL image
-        unloader = transforms.ToPILImage()
-        imag = new_image.clone().permute(2, 0, 1)
-        imag = unloader(imag)
+    Returns:
+        tuple: (masks, ratios) with masks a bool tensor [B, size, size]
+               (True = keep) and ratios a list of floats
+    """
+    batch_size = image.size(0)
+    with torch.set_grad_enabled(True):
+        gradcams, _ = compute_gradcam(
+            model=model,
+            visual_input=image,
+            text_input=question,
+            tokenized_text=tokenized_text,
+            block_num=block_num
+        )
+    gradcams = torch.stack([gradcam_[1] for gradcam_ in gradcams]).reshape(batch_size, 24, 24)
+
+    # ITC similarity of each image with its own question
+    itc_score = model({"image": image, "text_input": question}, match_head='itc').reshape(batch_size, -1)
+    itc_score = itc_score.diagonal() if itc_score.shape[1] == batch_size else itc_score[:, 0]
+    ratios = (1 - itc_score.float() / 2).clamp(0.0, 0.99999).tolist()
+
+    cams = attention_maps(gradcams.detach(), size=size)
+    return keep_masks(cams, ratios), ratios
+
+
+def augmentation(image, question, tensor_image, model, tokenized_text, raw_image):
+    """
+    Generate augmented image based on GradCAM attention from BLIP-ITM model.
+    
+    Computes the keep-mask with compute_agla_mask and applies it with
+    apply_agla_mask.
+    
+    Args:
+        image (torch.Tensor): Preprocessed image for BLIP-ITM [1, 3, H, W]
+        question (str): Text question/prompt
+        tensor_image (torch.Tensor): Image tensor [3, 384, 384] for masking
+        model: BLIP-ITM model
+        tokenized_text: Tokenized text from BLIP tokenizer
+        raw_image (PIL.Image): Original PIL image
         
-        logger.debug(f"Generated augmented image with masking ratio {ratio:.3f}")
-        return imag
+    Returns:
+        PIL.Image: Augmented image with attention-based masking
         
-    except Exception as e:
-        logger.error(f"Error in augmentation: {e}")
-        raise
-
+    Example:
+        >>> from lavis.models import load_model_and_preprocess
+        >>> model_itm, vis_processors, text_processors = load_model_and_preprocess(
+        ...     "blip_image_text_matching", "large", device="cuda", is_eval=True
+        ... )
+        >>> augmented = augmentation(image_blip, question, tensor_img, 
+        ...                          model_itm, tokenized_text, raw_img)
+    """
+    mask, _ = compute_agla_mask(image, question, model, tokenized_text, raw_image)
+    return apply_agla_mask(tensor_image, mask)
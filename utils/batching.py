@@ -0,0 +1,58 @@
+"""
+Batching Module
+Groups POPE questions into length-bucketed, left-padded batches
+
+Decoder-only generation appends new tokens on the right, so prompts of a
+batch are padded on the left and the attention mask marks the padding.
+Sorting questions by prompt length inside bounded windows keeps the padding
+small while leaving questions about the same image close together, which the
+AGLA mask and image prefetchers rely on.
+"""
+
+import torch
+
+
+def bucket_by_length(items, lengths, batch_size, window=None):
+    """
+    Reorder items so that batches hold prompts of similar length.
+
+    Items are stably sorted by length inside consecutive windows of
+    ``window`` items (default: 8 batches), so the order only changes locally.
+
+    Args:
+        items (list): Items to batch (e.g. POPE question dicts)
+        lengths (list): Prompt length of each item
+        batch_size (int): Batch size; 1 keeps the original order
+        window (int): Number of items sorted together
+
+    Returns:
+        list: The reordered items
+    """
+    if batch_size <= 1:
+        return list(items)
+    window = window or batch_size * 8
+    order = []
+    for start in range(0, len(items), window):
+        indices = range(start, min(start + window, len(items)))
+        order.extend(sorted(indices, key=lambda i: lengths[i]))
+    return [items[i] for i in order]
+
+
+def left_pad(sequences, pad_value):
+    """
+    Left-pad 1-D token id tensors into a batch.
+
+    Args:
+        sequences (list): Token id tensors [L_i]
+        pad_value (int): Padding token id
+
+    Returns:
+        tuple: (input_ids [B, L], attention_mask [B, L]) with zeros on the padding
+    """
+    max_len = max(seq.shape[0] for seq in sequences)
+    input_ids = sequences[0].new_full((len(sequences), max_len), pad_value)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        input_ids[i, max_len - seq.shape[0]:] = seq
+        attention_mask[i, max_len - seq.shape[0]:] = 1
+    return input_ids, attention_mask
@@ -0,0 +1,179 @@
+"""
+BLIP Saliency Module
+GradCAM and ITC scores for AGLA with the BLIP image encoding reused per image
+
+LAVIS' compute_gradcam and the ITC call each run BLIP's ViT over the image,
+and the GradCAM backward goes all the way down into the ViT. The AGLA mask
+only needs the ITM cross-attention at ``block_num`` and its gradient, plus the
+ITC image/text similarity, so BLIPSaliency encodes an image once, keeps the
+ViT output per image hash and runs only the text side per question:
+
+    ViT (no grad, once per image)
+      -> ITM text encoder with cross-attention -> ITM head,
+         backward to the cross-attention probabilities of ``block_num``
+      -> ITC text encoder + projections (no grad)
+
+The GradCAM maps match lavis' compute_gradcam (head-averaged gradient-weighted
+cross-attention, averaged over the question tokens).
+"""
+
+import math
+import logging
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+class BLIPSaliency:
+    """
+    AGLA saliency engine around a LAVIS BLIP-ITM model.
+
+    Args:
+        model: BLIP-ITM model (``blip_image_text_matching``)
+        block_num (int): Text-encoder layer whose cross-attention is used for GradCAM
+        max_images (int): Number of image encodings kept (LRU)
+    """
+
+    def __init__(self, model, block_num=6, max_images=16):
+        self.model = model
+        self.block_num = block_num
+        self.max_images = max_images
+        self.hits = 0
+        self.misses = 0
+        self._image_embeds = OrderedDict()
+
+    @property
+    def _cross_attention(self):
+        return self.model.text_encoder.base_model.base_model.encoder.layer[self.block_num].crossattention.self
+
+    @torch.no_grad()
+    def encode_image(self, image, image_hash=None):
+        """
+        ViT output of a preprocessed image, cached by ``image_hash``.
+
+        Args:
+            image (torch.Tensor): Preprocessed image for BLIP [1, 3, H, W]; may be
+                None when the encoding of ``image_hash`` is cached
+            image_hash (str): Content hash of the image (None = not cached)
+
+        Returns:
+            torch.Tensor: Image embeddings [1, 1 + num_patches, D]
+        """
+        if image_hash is not None and image_hash in self._image_embeds:
+            self._image_embeds.move_to_end(image_hash)
+            self.hits += 1
+            return self._image_embeds[image_hash]
+
+        self.misses += 1
+        image_embeds = self.model.visual_encoder.forward_features(image)
+        if image_hash is not None:
+            self._image_embeds[image_hash] = image_embeds
+            while len(self._image_embeds) > self.max_images:
+                self._image_embeds.popitem(last=False)
+        return image_embeds
+
+    def has_image(self, image_hash):
+        """Whether the encoding of ``image_hash`` is cached."""
+        return image_hash in self._image_embeds
+
+    def tokenize(self, questions):
+        """Tokenize question(s) the way BlipITM.forward does."""
+        return self.model.tokenizer(
+            questions, padding="longest", truncation=True,
+            max_length=self.model.max_txt_len, return_tensors="pt",
+        )
+
+    def gradcam(self, image_embeds, text):
+        """
+        Token-averaged GradCAM of the ITM score on the image patches.
+
+        Args:
+            image_embeds (torch.Tensor): Image embeddings [B, 1 + num_patches, D]
+            text: Tokenized questions [B, T] from :meth:`tokenize`
+
+        Returns:
+            torch.Tensor: GradCAM maps [B, grid, grid] (grid = sqrt(num_patches))
+        """
+        attention = self._cross_attention
+        attention.save_attention = True
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device)
+
+        encoder_input_ids = text.input_ids.clone()
+        encoder_input_ids[:, 0] = self.model.tokenizer.enc_token_id
+        with torch.enable_grad():
+            output = self.model.text_encoder(
+                encoder_input_ids,
+                attention_mask=text.attention_mask,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+            itm_output = self.model.itm_head(output.last_hidden_state[:, 0, :])
+            cams = attention.get_attention_map()
+            # Gradient w.r.t. the attention probabilities only; no parameter grads
+            grads = torch.autograd.grad(itm_output[:, 1].sum(), cams)[0]
+        attention.save_attention = False
+
+        with torch.no_grad():
+            batch_size, num_heads, seq_len, num_keys = cams.shape
+            grid = int(math.isqrt(num_keys - 1))
+            mask = text.attention_mask.view(batch_size, 1, -1, 1, 1).to(cams.dtype)
+            cams = cams[:, :, :, 1:].reshape(batch_size, num_heads, seq_len, grid, grid) * mask
+            grads = grads[:, :, :, 1:].clamp(0).reshape(batch_size, num_heads, seq_len, grid, grid) * mask
+            gradcams = (cams * grads).mean(1)
+
+            # Average over the question tokens (positions 1..len-2, i.e. without [ENC] and [SEP])
+            token_length = text.attention_mask.sum(dim=-1) - 2
+            positions = torch.arange(seq_len, device=gradcams.device)
+            in_question = (positions[None, :] >= 1) & (positions[None, :] <= token_length[:, None])
+            gradcams = (gradcams * in_question[:, :, None, None]).sum(1)
+            return gradcams / token_length.clamp(min=1)[:, None, None].to(gradcams.dtype)
+
+    @torch.no_grad()
+    def itc(self, image_embeds, text):
+        """
+        ITC cosine similarity of each image with its own question.
+
+        Returns:
+            torch.Tensor: Similarities [B]
+        """
+        text_output = self.model.text_encoder(
+            text.input_ids, attention_mask=text.attention_mask, return_dict=True, mode="text"
+        )
+        image_feat = F.normalize(self.model.vision_proj(image_embeds[:, 0, :]), dim=-1)
+        text_feat = F.normalize(self.model.text_proj(text_output.last_hidden_state[:, 0, :]), dim=-1)
+        return (image_feat * text_feat).sum(dim=-1)
+
+    def saliency(self, image, questions, image_hash=None):
+        """
+        GradCAM maps and AGLA masking ratios for questions about one image.
+
+        Args:
+            image (torch.Tensor): Preprocessed image for BLIP [1, 3, H, W]
+            questions (str or list): Processed question(s) about the image
+            image_hash (str): Content hash of the image; enables embedding reuse
+
+        Returns:
+            tuple: (gradcams [B, grid, grid], ratios list of floats)
+        """
+        if isinstance(questions, str):
+            questions = [questions]
+        image_embeds = self.encode_image(image, image_hash)
+        image_embeds = image_embeds.expand(len(questions), -1, -1)
+        text = self.tokenize(questions).to(image_embeds.device)
+
+        gradcams = self.gradcam(image_embeds, text)
+        ratios = (1 - self.itc(image_embeds, text).float() / 2).clamp(0.0, 0.99999).tolist()
+        return gradcams, ratios
+
+    def clear(self):
+        """Drop the cached image encodings."""
+        self._image_embeds.clear()
+
+    def stats(self):
+        """Image-encoding hit / miss counters."""
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
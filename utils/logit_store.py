@@ -0,0 +1,136 @@
+"""
+Branch Logit Store Module
+Records first-token branch logits for offline re-combination
+
+For a fixed noise step the final logits are a linear combination of the
+original / VCD / AGLA branch logits, so a parameter sweep over
+cd_alpha / cd_beta / agla_alpha / agla_beta does not need the model once the
+branch logits are on disk. A store is a directory with
+
+    meta.json       question ids, branch names, yes/no token ids, run settings
+    token_ids.npy   int32 [N, K]          vocabulary id of every stored column
+    logits.npy      float16 [N, n_branches, K]
+
+The first ``num_main_columns`` columns are the top-k tokens of the original
+branch in descending order (or the whole vocabulary with topk=0), followed by
+the yes and the no answer tokens. Both arrays are memory-mapped.
+"""
+
+import json
+import os
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+BRANCHES = ("original", "vcd", "agla")
+
+
+class LogitStoreWriter:
+    """
+    Append per-question branch logits to an on-disk store.
+
+    Args:
+        path (str): Store directory (created if missing)
+        num_questions (int): Capacity, i.e. number of questions in the run
+        yes_token_ids / no_token_ids (list): Answer token ids, always stored
+        topk (int): Number of original-branch top tokens to keep; 0 stores the
+            full first-token distribution
+        metadata (dict): Run settings saved with the store (noise_step, seed, ...)
+    """
+
+    def __init__(self, path, num_questions, yes_token_ids, no_token_ids, topk=64, metadata=None):
+        self.path = path
+        self.num_questions = int(num_questions)
+        self.yes_token_ids = [int(t) for t in yes_token_ids]
+        self.no_token_ids = [int(t) for t in no_token_ids]
+        self.topk = int(topk)
+        self.metadata = dict(metadata or {})
+        self.question_ids = []
+        self.branches = None
+        self._token_ids = None
+        self._logits = None
+        os.makedirs(path, exist_ok=True)
+
+    def _open(self, num_main_columns, branches):
+        num_columns = num_main_columns + len(self.yes_token_ids) + len(self.no_token_ids)
+        self.num_main_columns = num_main_columns
+        self.branches = branches
+        self._token_ids = np.lib.format.open_memmap(
+            os.path.join(self.path, "token_ids.npy"), mode="w+", dtype=np.int32,
+            shape=(self.num_questions, num_columns),
+        )
+        self._logits = np.lib.format.open_memmap(
+            os.path.join(self.path, "logits.npy"), mode="w+", dtype=np.float16,
+            shape=(self.num_questions, len(branches), num_columns),
+        )
+
+    def add(self, question_id, logits_original, logits_vcd=None, logits_agla=None):
+        """
+        Record one question from first_token_branch_logits() output.
+
+        Only the first row of a batch is stored; absent branches are skipped
+        (the set of branches must be the same for every question).
+        """
+        branch_logits = [
+            (name, logits[0]) for name, logits in zip(BRANCHES, (logits_original, logits_vcd, logits_agla))
+            if logits is not None
+        ]
+        branches = [name for name, _ in branch_logits]
+        if self._logits is None:
+            vocab_size = logits_original.shape[-1]
+            self._open(min(self.topk, vocab_size) if self.topk > 0 else vocab_size, branches)
+        elif branches != self.branches:
+            raise ValueError(f"Branches {branches} do not match the store's {self.branches}")
+        row = len(self.question_ids)
+        if row >= self.num_questions:
+            raise IndexError(f"Logit store is full ({self.num_questions} questions)")
+
+        if self.topk > 0:
+            main_ids = logits_original[0].float().topk(self.num_main_columns).indices
+        else:
+            main_ids = torch.arange(self.num_main_columns, device=logits_original.device)
+        answer_ids = torch.tensor(self.yes_token_ids + self.no_token_ids, device=main_ids.device, dtype=main_ids.dtype)
+        column_ids = torch.cat([main_ids, answer_ids])
+
+        self._token_ids[row] = column_ids.cpu().numpy()
+        self._logits[row] = torch.stack([logits[column_ids] for _, logits in branch_logits]).half().cpu().numpy()
+        self.question_ids.append(question_id)
+
+    def close(self):
+        """Flush the arrays and write meta.json."""
+        if self._logits is not None:
+            self._token_ids.flush()
+            self._logits.flush()
+        meta = {
+            "question_ids": self.question_ids,
+            "num_rows": len(self.question_ids),
+            "branches": self.branches or [],
+            "num_main_columns": getattr(self, "num_main_columns", 0),
+            "yes_token_ids": self.yes_token_ids,
+            "no_token_ids": self.no_token_ids,
+            "topk": self.topk,
+            "metadata": self.metadata,
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        logger.info(f"Recorded branch logits for {len(self.question_ids)} questions to {self.path}")
+
+
+def load_logit_store(path):
+    """
+    Open a store written by LogitStoreWriter.
+
+    Returns:
+        dict with the meta.json fields plus
+            - token_ids: int32 memmap [N, K]
+            - logits: float16 memmap [N, n_branches, K]
+    """
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        store = json.load(f)
+    num_rows = store["num_rows"]
+    store["token_ids"] = np.load(os.path.join(path, "token_ids.npy"), mmap_mode="r")[:num_rows]
+    store["logits"] = np.load(os.path.join(path, "logits.npy"), mmap_mode="r")[:num_rows]
+    return store
@@ -0,0 +1,245 @@
+"""
+Prefetch Module
+Prepares images and AGLA masks ahead of the LVLM
+
+ImagePrefetcher decodes images, runs the LVLM preprocessing and draws the VCD
+noise in a thread pool, handing pinned tensors to the evaluation loop.
+
+In the evaluation loops the BLIP-ITM GradCAM + ITC pass of a question and the
+LVLM forward of the same question run one after the other. AGLAMaskPrefetcher
+moves the mask computation into a process pool: every worker loads BLIP-ITM
+once, and masks are computed a bounded number of questions ahead of the
+consumer while it decodes. Results are yielded in question order.
+
+Consecutive questions about the same image go to the same worker as one task,
+so the worker's BLIP image encoding is reused for them (see utils.blip_saliency).
+Workers share the on-disk AGLA mask cache when one is configured.
+"""
+
+import itertools
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+from .prefix_cache import hash_image_file
+from .seeding import question_generator
+from .vcd_add_noise import add_diffusion_noise
+
+logger = logging.getLogger(__name__)
+
+_worker_provider = None
+
+
+def ordered_prefetch(executor, fn, tasks, depth):
+    """
+    Run ``fn`` over ``tasks`` on ``executor``, at most ``depth`` tasks ahead.
+
+    Yields:
+        The results of ``fn(task)`` in task order
+    """
+    pending = deque()
+    tasks = iter(tasks)
+    for task in itertools.islice(tasks, depth):
+        pending.append(executor.submit(fn, task))
+    while pending:
+        result = pending.popleft().result()
+        for task in itertools.islice(tasks, 1):
+            pending.append(executor.submit(fn, task))
+        yield result
+
+
+def _group_consecutive(items, key, max_group):
+    """Runs of consecutive items with the same key, at most ``max_group`` long."""
+    for value, group in itertools.groupby(items, key=key):
+        group = list(group)
+        for start in range(0, len(group), max_group):
+            yield value, group[start:start + max_group]
+
+
+def _init_worker(config):
+    """Build the worker's AGLAMaskProvider (BLIP-ITM is loaded on its first miss)."""
+    global _worker_provider
+    from .agla_cache import AGLAMaskCache, AGLAMaskProvider
+
+    cache_dir = config.pop("cache_dir")
+    cache = AGLAMaskCache(cache_dir) if cache_dir else None
+    _worker_provider = AGLAMaskProvider(cache, **config)
+
+
+def _compute_masks(task):
+    """
+    Masks for a run of questions about one image.
+
+    Args:
+        task: (image_path, [question, ...])
+
+    Returns:
+        list of (mask, ratio, error) with mask a bool np.ndarray, or None and
+        the error message if the question failed
+    """
+    image_path, questions = task
+    try:
+        raw_image = Image.open(image_path).convert('RGB')
+        image_hash = hash_image_file(image_path)
+    except Exception as e:
+        return [(None, None, f"Error loading image {image_path}: {e}")] * len(questions)
+
+    results = []
+    for question in questions:
+        try:
+            with torch.no_grad():
+                mask, ratio = _worker_provider.get_mask(raw_image, question, image_hash)
+            if torch.is_tensor(mask):
+                mask = mask.cpu().numpy()
+            results.append((mask, ratio, None))
+        except Exception as e:
+            results.append((None, None, str(e)))
+    return results
+
+
+class AGLAMaskPrefetcher:
+    """
+    Process pool computing AGLA masks ahead of the evaluation loop.
+
+    Args:
+        provider (AGLAMaskProvider): Provider whose settings the workers copy
+            (BLIP variant, precision, GradCAM block, mask pipeline, cache directory)
+        num_workers (int): Worker processes, each with its own BLIP-ITM
+        depth (int): Tasks (runs of same-image questions) in flight; defaults
+            to twice the number of workers
+        max_group (int): Maximum number of questions per task
+    """
+
+    def __init__(self, provider, num_workers=1, depth=None, max_group=8):
+        config = {
+            "cache_dir": provider.cache.cache_dir if provider.cache is not None else None,
+            "blip_variant": provider.blip_variant,
+            "device": provider.device,
+            "half": provider.half,
+            "block_num": provider.block_num,
+            "device_masks": provider.device_masks,
+        }
+        self.depth = depth or 2 * num_workers
+        self.max_group = max_group
+        # CUDA cannot be re-initialized in forked children
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(config,),
+        )
+
+    def _tasks(self, items):
+        for image_path, group in _group_consecutive(items, lambda item: item[0], self.max_group):
+            yield image_path, [question for _, question in group]
+
+    def iter_masks(self, items):
+        """
+        Prefetched masks for (image_path, question) items, in item order.
+
+        Yields:
+            (mask, ratio, error) per item; mask is None and error the message
+            when the mask could not be computed
+        """
+        for results in ordered_prefetch(self.executor, _compute_masks, self._tasks(items), self.depth):
+            yield from results
+
+    def close(self):
+        """Stop the workers, dropping tasks that have not started."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class ImagePrefetcher:
+    """
+    Thread pool loading the LVLM image inputs ahead of the evaluation loop.
+
+    For each question it decodes the image, applies ``preprocess`` and, with
+    a noise step, draws the VCD image. Consecutive questions about the same
+    image are decoded and preprocessed once. PIL decoding and the resize
+    release the GIL, so threads overlap them with the GPU work of the loop.
+
+    The VCD noise of each question comes from its own generator seeded from
+    (``seed``, noise key, "vcd") (see utils.seeding), which keeps it
+    independent of the thread schedule and of the question order.
+
+    Args:
+        preprocess (callable): PIL image -> pixel values [3, H, W]
+        num_workers (int): Loader threads
+        depth (int): Same-image question groups in flight (default: 2 x workers)
+        noise_step (int): VCD noise step, or None for no VCD image
+        seed (int): Run seed of the per-question VCD noise
+        hash_images (bool): Also compute the image content hash
+        pin_memory (bool): Pin the tensors for asynchronous host-to-device copies
+            (default: when CUDA is available)
+        max_group (int): Maximum number of questions per group
+    """
+
+    def __init__(self, preprocess, num_workers=4, depth=None, noise_step=None, seed=0,
+                 hash_images=False, pin_memory=None, max_group=8):
+        self.preprocess = preprocess
+        self.depth = depth or 2 * num_workers
+        self.noise_step = noise_step
+        self.seed = seed
+        self.hash_images = hash_images
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.max_group = max_group
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def _pin(self, tensor):
+        return tensor.pin_memory() if self.pin_memory else tensor
+
+    def _load(self, task):
+        image_path, keys = task
+        try:
+            raw_image = Image.open(image_path).convert('RGB')
+            pixel_values = self._pin(self.preprocess(raw_image))
+            image_hash = hash_image_file(image_path) if self.hash_images else None
+        except Exception as e:
+            error = f"Error loading image {image_path}: {e}"
+            return [{"error": error} for _ in keys]
+
+        loaded = []
+        for key in keys:
+            pixel_values_cd = None
+            if self.noise_step is not None:
+                generator = question_generator(self.seed, key, "vcd")
+                pixel_values_cd = self._pin(add_diffusion_noise(pixel_values, self.noise_step, generator=generator))
+            loaded.append({
+                "raw_image": raw_image,
+                "image_hash": image_hash,
+                "pixel_values": pixel_values,
+                "pixel_values_cd": pixel_values_cd,
+                "error": None,
+            })
+        return loaded
+
+    def iter_images(self, image_paths, noise_keys=None):
+        """
+        Loaded inputs for each question's image path, in order.
+
+        Args:
+            image_paths (list): Image path of each question
+            noise_keys (list): Key of each question's VCD noise generator,
+                usually the question id (default: the position in the list)
+
+        Yields:
+            dict with raw_image (PIL), image_hash, pixel_values [3, H, W],
+            pixel_values_cd [3, H, W] or None, and error (None, or the
+            message when the image could not be loaded)
+        """
+        if noise_keys is None:
+            noise_keys = range(len(image_paths))
+        tasks = (
+            (image_path, [key for key, _ in group])
+            for image_path, group in _group_consecutive(zip(noise_keys, image_paths), lambda item: item[1], self.max_group)
+        )
+        for loaded in ordered_prefetch(self.executor, self._load, tasks, self.depth):
+            yield from loaded
+
+    def close(self):
+        """Stop the loader threads, dropping groups that have not started."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,146 @@
+"""
+Prefix KV Cache Module
+Reuses the image-prefix KV cache across questions on the same image
+
+In both prompt formats the image comes before the question
+(LLaVA: ``... USER: <image>\\n{question}``, Qwen-VL: ``<img>path</img>{question}``),
+so the KV cache over the system text and the ~576 (LLaVA) / 256 (Qwen-VL)
+image positions is identical for every question asked about an image.
+POPE asks several questions per COCO image and the random / popular /
+adversarial splits share images, so most prefills only need the question
+suffix once the prefix of each branch is cached.
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def hash_image_file(image_path):
+    """
+    Content hash of an image file (SHA-1 of its bytes).
+
+    Args:
+        image_path (str): Path to the image file
+
+    Returns:
+        str: Hex digest identifying the image content
+    """
+    with open(image_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _past_nbytes(past_key_values):
+    """Total size in bytes of a tuple-of-tuples KV cache."""
+    return sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+
+class PrefixKVCache:
+    """
+    LRU cache of per-branch prefix KV caches under a byte budget.
+
+    Entries are keyed by a tuple built with :meth:`make_key`
+    (model, branch, image hash, and for the auxiliary branches the noise
+    seed/step or the AGLA mask id). Each entry also stores the prefix token
+    ids, so a lookup with a different prompt prefix is a miss rather than a
+    silent reuse.
+
+    Cached ``past_key_values`` are the legacy tuple-of-tuples format. The
+    LLaMA and Qwen-VL attention layers extend them with ``torch.cat``, so a
+    cached entry is never modified by the forwards that reuse it.
+
+    Args:
+        max_bytes (int): Budget for the cached tensors; least recently used
+            entries are evicted to stay under it
+    """
+
+    def __init__(self, max_bytes=4 * 1024 ** 3):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(model_id, branch, image_hash, noise_seed=None, noise_step=None, agla_mask_id=None):
+        """
+        Build the cache key of one branch's prefix.
+
+        Args:
+            model_id (str): Model name (caches from different models never mix)
+            branch (str): "original", "vcd" or "agla"
+            image_hash (str): Content hash of the source image
+            noise_seed / noise_step: VCD noise parameters (vcd branch)
+            agla_mask_id (str): Identifier of the AGLA mask (agla branch)
+        """
+        return (model_id, branch, image_hash, noise_seed, noise_step, agla_mask_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, prefix_ids):
+        """
+        Look up a prefix KV cache.
+
+        Args:
+            key: Key from :meth:`make_key`
+            prefix_ids (torch.Tensor): Prefix token ids [B, P] the cache must match
+
+        Returns:
+            The cached past_key_values, or None on a miss
+        """
+        entry = self._entries.get(key)
+        if entry is None or not torch.equal(entry[0], prefix_ids.to(entry[0].device)):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, prefix_ids, past_key_values):
+        """
+        Store a prefix KV cache, evicting least recently used entries.
+
+        Entries larger than the whole budget are not stored.
+        """
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        nbytes = _past_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            logger.debug(f"Prefix cache entry of {nbytes} bytes exceeds the budget, not cached")
+            return
+
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[2]
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            _, (_, _, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+            self.evictions += 1
+
+        self._entries[key] = (prefix_ids.clone(), past_key_values, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        """Drop all entries."""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Hit / miss / eviction counters and current size."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,118 @@
+"""
+Language-Prior Cache Module
+Caches the VCD branch's logits once per prompt instead of once per image
+
+At the default noise_step of 500 the diffusion noise removes most of the
+image content, so the VCD branch mainly measures the language prior of the
+question. In prior mode the noisy-image branch is replaced by a forward that
+does not depend on the image at all: either the prompt without the image
+("text") or the prompt with a fully noised stand-in image that is the same
+for every question ("noise"). Its next-token logits then only depend on the
+prompt and the tokens generated so far, and are cached under those tokens.
+POPE asks the same "Is there a ... in the image?" template about ~80 objects,
+so most lookups hit.
+"""
+
+from collections import OrderedDict
+
+import torch
+
+from .seeding import question_generator
+from .vcd_add_noise import add_diffusion_noise
+
+PRIOR_MODES = ("text", "noise")
+# Noise step of the stand-in image in "noise" mode (the end of the schedule)
+PRIOR_NOISE_STEP = 999
+
+
+def prior_noise_image(image_tensor, seed):
+    """
+    Stand-in image of the "noise" prior mode, shaped like ``image_tensor``.
+
+    Noise is drawn on a blank image with a generator that only depends on
+    ``seed``, so every question sees the same image.
+    """
+    return add_diffusion_noise(
+        torch.zeros_like(image_tensor), PRIOR_NOISE_STEP, generator=question_generator(seed, "image", "prior")
+    )
+
+
+class PriorLogitsCache:
+    """
+    LRU cache of language-prior next-token logits under a byte budget.
+
+    Entries are keyed by a namespace from :meth:`make_key` (model, prior
+    mode, noise seed) and the token ids of the prior sequence, i.e. the
+    prior prompt followed by the tokens generated so far.
+
+    Args:
+        max_bytes (int): Budget for the cached logits; least recently used
+            entries are evicted to stay under it
+    """
+
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(model_id, mode, noise_seed=None):
+        """
+        Namespace of the prior logits of one model and prior mode.
+
+        Args:
+            model_id (str): Model name (logits from different models never mix)
+            mode (str): "text" or "noise"
+            noise_seed (int): Seed of the stand-in image ("noise" mode)
+        """
+        return (model_id, mode, noise_seed)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, namespace, token_ids):
+        """
+        Look up the logits after ``token_ids`` (1-D tensor), or None on a miss.
+        """
+        key = (namespace, tuple(token_ids.tolist()))
+        logits = self._entries.get(key)
+        if logits is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return logits
+
+    def put(self, namespace, token_ids, logits):
+        """Store the logits after ``token_ids``, evicting least recently used entries."""
+        key = (namespace, tuple(token_ids.tolist()))
+        nbytes = logits.numel() * logits.element_size()
+        if key in self._entries:
+            old = self._entries.pop(key)
+            self.nbytes -= old.numel() * old.element_size()
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.numel() * evicted.element_size()
+            self.evictions += 1
+        self._entries[key] = logits
+        self.nbytes += nbytes
+
+    def clear(self):
+        """Drop all entries."""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Hit / miss / eviction counters and current size."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
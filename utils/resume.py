@@ -0,0 +1,76 @@
+"""
+Resume Module
+Picks up an interrupted run from its answers file
+
+The runners write one JSON line per question and flush after each, so an
+answers file left by a crash holds every finished question plus at most one
+partially written line. ``--resume`` drops that line, keeps the rest and
+appends only the questions that are still missing.
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def read_answered_ids(answers_file, repair=True):
+    """
+    Question ids already answered in a JSONL answers file.
+
+    A last line that is cut off (no trailing newline, or not valid JSON) is
+    treated as unanswered; with ``repair`` the file is truncated to the last
+    complete line so that appended answers start on a fresh line. A corrupt
+    line before the last one raises ValueError.
+
+    Args:
+        answers_file (str): Path to the answers file (missing = nothing answered)
+        repair (bool): Truncate a partial last line in place
+
+    Returns:
+        set: Answered question ids
+    """
+    answered = set()
+    if not os.path.exists(answers_file):
+        return answered
+
+    with open(answers_file, "rb") as f:
+        lines = f.readlines()
+
+    valid_bytes = 0
+    for i, raw in enumerate(lines):
+        try:
+            if not raw.endswith(b"\n"):
+                raise ValueError("no trailing newline")
+            if raw.strip():
+                answered.add(json.loads(raw)["question_id"])
+        except (ValueError, KeyError) as e:
+            if i < len(lines) - 1:
+                raise ValueError(f"Corrupt answer on line {i + 1} of {answers_file}: {e}")
+            logger.warning(f"Ignoring incomplete last line of {answers_file}: {e}")
+            break
+        valid_bytes += len(raw)
+
+    if repair and valid_bytes < os.path.getsize(answers_file):
+        with open(answers_file, "r+b") as f:
+            f.truncate(valid_bytes)
+    return answered
+
+
+def remaining_questions(questions, answers_file, resume):
+    """
+    Questions still to answer and the mode to open the answers file with.
+
+    Args:
+        questions (list): Question dicts with "question_id"
+        answers_file (str): Path to the answers file
+        resume (bool): Keep existing answers (otherwise start over)
+
+    Returns:
+        tuple: (questions without an answer, "a" or "w")
+    """
+    if not resume:
+        return questions, "w"
+    answered = read_answered_ids(answers_file)
+    return [q for q in questions if q["question_id"] not in answered], "a"
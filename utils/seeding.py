@@ -0,0 +1,57 @@
+"""
+Seeding Module
+Per-question random generators for order-independent runs
+
+``set_seed`` once at startup makes a run reproducible only in its own
+question order: the VCD noise and the token sampling draw from one global
+stream, so sharding a split, reordering it by image or batching it changes
+every answer after the first difference. Here each random draw gets its own
+``torch.Generator`` seeded from (run seed, question id, branch), so a question
+sees the same noise and the same sampled tokens wherever it runs.
+
+Branches in use:
+    "vcd"      VCD diffusion noise of the image
+    "sample"   Token sampling in sample_vcd_agla
+    "prior"    Stand-in image of the VCD language prior (utils.prior_cache)
+"""
+
+import hashlib
+
+import torch
+
+
+def question_seed(seed, question_id, branch):
+    """
+    64-bit seed derived from (seed, question_id, branch).
+
+    SHA-256 keeps it stable across processes and Python versions (``hash``
+    of a string is salted per process).
+
+    Args:
+        seed (int): Run seed (``--seed``)
+        question_id: Question identifier (or any key, e.g. an image file)
+        branch (str): Name of the random draw ("vcd", "sample", ...)
+
+    Returns:
+        int: Seed in [0, 2**63)
+    """
+    digest = hashlib.sha256(f"{seed}:{question_id}:{branch}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") & ((1 << 63) - 1)
+
+
+def question_generator(seed, question_id, branch, device="cpu"):
+    """
+    ``torch.Generator`` seeded with :func:`question_seed`.
+
+    Args:
+        device: Device of the generator; it must match the tensors it draws
+            (CPU for the noise of CPU images, CUDA for sampling on the GPU)
+    """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(question_seed(seed, question_id, branch))
+    return generator
+
+
+def sampling_generators(seed, question_ids, device="cpu"):
+    """One "sample" generator per row of a batch, for sample_vcd_agla."""
+    return [question_generator(seed, question_id, "sample", device) for question_id in question_ids]
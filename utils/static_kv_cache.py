@@ -0,0 +1,221 @@
+"""
+Static KV Cache Module
+Preallocated key/value buffers that decoding writes in place
+
+The default caches grow by ``torch.cat`` at every step, which reallocates the
+keys and values of every layer per token, once per branch with VCD and AGLA.
+A StaticKVCache allocates each layer's buffers once, sized from the prompt
+length plus ``max_new_tokens``, and appends in place; attention reads views of
+the filled part. ``reset()`` keeps the buffers, so one cache per branch serves
+every question of a run and only reallocates when a longer prompt or a larger
+batch arrives.
+
+QuantizedKVCache keeps the same buffers in int8 with a per-head, per-position
+scale and dequantizes on read. It is meant for the VCD and AGLA branches
+(AUX_BRANCHES), whose logits only enter the contrast terms, and roughly halves
+their memory.
+
+LLaVA uses it through the transformers Cache protocol (``update`` /
+``get_seq_length``, transformers >= 4.36); Qwen-VL's attention writes into it
+directly.
+"""
+
+import torch
+
+try:
+    from transformers.cache_utils import Cache
+    HF_CACHE_PROTOCOL = True
+except ImportError:  # transformers < 4.36: LlamaAttention only concatenates tuples
+    Cache = object
+    HF_CACHE_PROTOCOL = False
+
+BRANCHES = ("original", "vcd", "agla", "batched")
+# Branches that only feed the contrast terms (candidates for int8 caches)
+AUX_BRANCHES = ("vcd", "agla")
+
+
+class StaticKVCacheLayer:
+    """View of one layer of a StaticKVCache (the ``layer_past`` of Qwen-VL's attention)."""
+
+    def __init__(self, cache, layer_idx):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def update(self, key_states, value_states):
+        return self.cache.update(key_states, value_states, self.layer_idx)
+
+
+class StaticKVCache(Cache):
+    """
+    Per-layer key/value buffers with an in-place append.
+
+    Buffers are allocated at a layer's first update, with room for the
+    prompt plus ``max_new_tokens``. A sequence that still outgrows them (e.g.
+    a catch-up forward past the reserve) doubles the capacity.
+
+    Each of a layer's keys and values is stored as a tuple of planes
+    (``_encode`` / ``_decode``); here the single plane is the states
+    themselves, QuantizedKVCache stores int8 values plus scales.
+
+    Args:
+        max_new_tokens (int): Decode positions reserved after the prompt
+        seq_dim (int): Sequence dimension of the key/value tensors (2 for
+            LLaMA's [B, H, S, D], 1 for Qwen-VL's [B, S, H, D])
+    """
+
+    def __init__(self, max_new_tokens, seq_dim=2):
+        super().__init__()
+        self.max_new_tokens = max_new_tokens
+        self.seq_dim = seq_dim
+        self.key_buffers = []
+        self.value_buffers = []
+        self.lengths = []
+        self.batch_size = 0
+        self.allocations = 0
+
+    def _encode(self, states):
+        """Planes stored for ``states``."""
+        return (states,)
+
+    def _decode(self, planes):
+        """States read back from the stored planes."""
+        return planes[0]
+
+    def reset(self):
+        """Forget the cached positions; the buffers are kept for the next sequence."""
+        self.lengths = [0] * len(self.lengths)
+        self.batch_size = 0
+
+    def _grow(self, layer_idx, key_planes, value_planes, capacity):
+        """(Re)allocate a layer's buffers, keeping its filled part."""
+        start = self.lengths[layer_idx]
+        batch = max(key_planes[0].shape[0], self.batch_size)
+        grown = []
+        for old_planes, planes in ((self.key_buffers[layer_idx], key_planes), (self.value_buffers[layer_idx], value_planes)):
+            new_planes = []
+            for i, plane in enumerate(planes):
+                shape = list(plane.shape)
+                shape[0] = batch
+                shape[self.seq_dim] = capacity
+                buffer = plane.new_empty(shape)
+                if start > 0:
+                    old = old_planes[i][:batch].narrow(self.seq_dim, 0, start)
+                    buffer[:batch].narrow(self.seq_dim, 0, start).copy_(old)
+                new_planes.append(buffer)
+            grown.append(tuple(new_planes))
+        self.key_buffers[layer_idx], self.value_buffers[layer_idx] = grown
+        self.allocations += 1
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        """
+        Append ``key_states`` / ``value_states`` to layer ``layer_idx``.
+
+        Returns:
+            (keys, values): All cached positions of the layer (views of the
+            buffers, or their dequantized copy)
+        """
+        while len(self.lengths) <= layer_idx:
+            self.key_buffers.append(None)
+            self.value_buffers.append(None)
+            self.lengths.append(0)
+
+        start = self.lengths[layer_idx]
+        end = start + key_states.shape[self.seq_dim]
+        batch = key_states.shape[0]
+        if start == 0:
+            self.batch_size = batch
+        key_planes, value_planes = self._encode(key_states), self._encode(value_states)
+        buffers = self.key_buffers[layer_idx]
+        if (buffers is None or buffers[0].shape[0] < batch or buffers[0].shape[self.seq_dim] < end
+                or any(b.dtype != p.dtype or b.device != p.device for b, p in zip(buffers, key_planes))):
+            capacity = end + self.max_new_tokens if start == 0 else max(end, 2 * buffers[0].shape[self.seq_dim])
+            self._grow(layer_idx, key_planes, value_planes, capacity)
+
+        outputs = []
+        for buffers, planes in ((self.key_buffers[layer_idx], key_planes), (self.value_buffers[layer_idx], value_planes)):
+            for buffer, plane in zip(buffers, planes):
+                buffer[:batch].narrow(self.seq_dim, start, end - start).copy_(plane)
+            outputs.append(self._decode([buffer[:batch].narrow(self.seq_dim, 0, end) for buffer in buffers]))
+        self.lengths[layer_idx] = end
+        return tuple(outputs)
+
+    def layer(self, layer_idx):
+        return StaticKVCacheLayer(self, layer_idx)
+
+    def get_seq_length(self, layer_idx=0):
+        return self.lengths[layer_idx] if layer_idx < len(self.lengths) else 0
+
+    def get_max_length(self):
+        # The buffers grow on demand, so there is no hard limit
+        return None
+
+    def nbytes(self):
+        """Bytes held by the buffers."""
+        return sum(
+            t.numel() * t.element_size()
+            for planes in self.key_buffers + self.value_buffers if planes is not None for t in planes
+        )
+
+    def __getitem__(self, layer_idx):
+        length = self.lengths[layer_idx]
+        return tuple(
+            self._decode([t[:self.batch_size].narrow(self.seq_dim, 0, length) for t in planes])
+            for planes in (self.key_buffers[layer_idx], self.value_buffers[layer_idx])
+        )
+
+    def __iter__(self):
+        for layer_idx in range(len(self)):
+            yield self[layer_idx]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __bool__(self):
+        # An empty cache reads as "no past": the next forward is a prefill
+        return self.get_seq_length() > 0
+
+    def to_legacy_cache(self):
+        """Tuple-of-tuples view of the cache (aliases the buffers of a full-precision cache)."""
+        return tuple(self)
+
+
+class QuantizedKVCache(StaticKVCache):
+    """
+    StaticKVCache holding its keys and values in int8.
+
+    Every head and position has its own absmax scale over ``head_dim`` (the
+    last dimension in both layouts), stored in the states' dtype. With fp16
+    states and a head_dim of 128 this is 130 instead of 256 bytes per head
+    and position. ``update`` dequantizes the layer for the attention, so the
+    attention math stays in full precision and only the cached values carry
+    the rounding error.
+    """
+
+    def _encode(self, states):
+        scale = (states.abs().amax(dim=-1, keepdim=True).float() / 127).to(states.dtype)
+        scale = scale.clamp_min(torch.finfo(states.dtype).tiny)
+        quantized = torch.round(states.float() / scale.float()).clamp_(-127, 127).to(torch.int8)
+        return quantized, scale
+
+    def _decode(self, planes):
+        quantized, scale = planes
+        return quantized.to(scale.dtype) * scale
+
+
+def make_static_kv_caches(model, max_new_tokens, branches=BRANCHES, int8_branches=()):
+    """
+    One StaticKVCache per branch ("original", "vcd", "agla", and "batched"
+    for --batch-branches), laid out for ``model``. Buffers are only allocated
+    for the branches that run; branches without a cache keep the model's
+    default one.
+
+    Args:
+        branches: Branches to create a cache for
+        int8_branches: Branches whose cache is a QuantizedKVCache (e.g.
+            AUX_BRANCHES, which only contribute the contrast terms)
+    """
+    seq_dim = getattr(model, "kv_cache_seq_dim", 2)
+    return {
+        name: (QuantizedKVCache if name in int8_branches else StaticKVCache)(max_new_tokens, seq_dim)
+        for name in branches
+    }
@@ -11,13 +11,14 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def add_diffusion_noise(image_tensor, noise_step):
+def add_diffusion_noise(image_tensor, noise_step, generator=None):
     """
     Add diffusion noise to an image tensor using DDPM-style noise schedule.
     
     Args:
         image_tensor (torch.Tensor): Input image tensor of shape [C, H, W]
         noise_step (int): Noise step from 0-999, higher means more noise
+        generator (torch.Generator): RNG for the noise (default: global RNG)
         
     Returns:
         torch.Tensor: Noisy image tensor of the same shape
@@ -43,7 +44,7 @@ def add_diffusion_noise(image_tensor, noise_step):
 
         def q_x(x_0, t):
             """Forward diffusion process"""
-            noise = torch.randn_like(x_0)
+            noise = torch.randn(x_0.shape, generator=generator, dtype=x_0.dtype, device=x_0.device)
             alphas_t = alphas_bar_sqrt[t]
             alphas_1_m_t = one_minus_alphas_bar_sqrt[t]
             return (alphas_t * x_0 + alphas_1_m_t * noise)